@@ -14,3 +14,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'agencyGiuseppi.settings')
 
 application = get_asgi_application()
+
+# start the password hashing processes before the first request, the async view of
+# api/async/password/ (profiles.views.async_password) awaits them
+from profiles.passwords import hasher  # noqa: E402
+
+hasher.start()
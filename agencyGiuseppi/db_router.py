@@ -0,0 +1,116 @@
+"""
+Read replicas for the hit and profiles apps.
+
+The reads of the models in REPLICA_APPS go to a random alias of DATABASE_REPLICAS and
+everything else goes to default. After a write the request (and the next requests of
+the same browser, with the REPLICA_PIN_COOKIE cookie) read from default during
+REPLICA_PIN_SECONDS, so a user always reads his own writes even with replication lag.
+"""
+import asyncio
+import contextvars
+import random
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, router
+
+REPLICA_APPS = {'hit', 'profiles'}
+REPLICA_PIN_COOKIE = 'db_pin'
+
+# timestamp until the reads must go to default
+_pinned_until = contextvars.ContextVar('pinned_until', default=0.0)
+_wrote = contextvars.ContextVar('wrote', default=False)
+
+
+def pin_seconds() -> int:
+    return getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+
+
+def pin() -> None:
+    """
+    Send the next reads of this context to default
+    """
+    _pinned_until.set(time.time() + pin_seconds())
+    _wrote.set(True)
+
+
+def is_pinned() -> bool:
+    return _pinned_until.get() > time.time() or connections[DEFAULT_DB_ALIAS].in_atomic_block
+
+
+def write_db(queryset) -> str:
+    """
+    Alias of the writes of a queryset or a manager, their db is the alias of the reads
+    (a replica), the methods that write take this one for the transaction and the queries
+    """
+    return queryset._db or router.db_for_write(queryset.model, **queryset._hints)
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+        if not replicas or model._meta.app_label not in REPLICA_APPS or is_pinned():
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        # the other apps, e.g. the session saved in every request, don't need to read their writes
+        if model._meta.app_label in REPLICA_APPS:
+            pin()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas have the same data than default
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+class ReplicaPinMiddleware:
+    """
+    Keep the read your writes window between the requests of a browser
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # the handler awaits the middleware, like MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    @staticmethod
+    def start(request) -> tuple:
+        try:
+            pinned_until = float(request.COOKIES.get(REPLICA_PIN_COOKIE, 0))
+        except ValueError:
+            pinned_until = 0.0
+        return _pinned_until.set(pinned_until), _wrote.set(False)
+
+    @staticmethod
+    def finish(response):
+        if _wrote.get():
+            response.set_cookie(
+                REPLICA_PIN_COOKIE, str(_pinned_until.get()), max_age=pin_seconds(), httponly=True)
+        return response
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        pinned_token, wrote_token = self.start(request)
+        try:
+            return self.finish(self.get_response(request))
+        finally:
+            _pinned_until.reset(pinned_token)
+            _wrote.reset(wrote_token)
+
+    async def __acall__(self, request):
+        # the sync views and base.async_db bring back the values of their threads
+        pinned_token, wrote_token = self.start(request)
+        try:
+            return self.finish(await self.get_response(request))
+        finally:
+            _pinned_until.reset(pinned_token)
+            _wrote.reset(wrote_token)
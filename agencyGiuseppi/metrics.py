@@ -0,0 +1,308 @@
+"""
+Performance metrics of the requests in Prometheus text format.
+
+MetricsMiddleware measures every request by view: latency, SQL queries and SQL time
+and response size. The queries are measured by an execute wrapper of every connection
+that adds them to the QueryMeter of the context, so the queries of the request thread,
+of sync_to_async and of the pool of base.async_db count for their request. The values
+live in a registry of the process, with METRICS_MULTIPROCESS_DIR every process (e.g. the
+forked workers of gunicorn) writes its registry to a file of the directory once per
+second and the metrics view adds the files of all the processes.
+
+The metrics view answers the addresses of METRICS_ALLOWED_IPS and the requests with the
+header "Authorization: Bearer <METRICS_TOKEN>", the rest get a 403.
+"""
+import asyncio
+import atexit
+import contextvars
+import glob
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+from base.db.pool import pool_stats
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+WRITE_INTERVAL = 1.0
+
+# name: (type, help, buckets)
+METRICS = {
+    'http_requests_total': ('counter', "Requests by view, method and status", None),
+    'http_request_duration_seconds': ('histogram', "Latency of the requests by view", LATENCY_BUCKETS),
+    'http_request_db_queries': ('histogram', "SQL queries per request by view", QUERY_BUCKETS),
+    'http_request_db_duration_seconds': ('histogram', "SQL time per request by view", LATENCY_BUCKETS),
+    'http_response_size_bytes': ('histogram', "Size of the responses by view", SIZE_BUCKETS),
+}
+# gauges of the connection pools, see base.db.pool
+POOL_GAUGES = ('open', 'in_use', 'idle', 'waits', 'timeouts', 'ping_failures', 'recycled', 'overflows')
+for gauge in POOL_GAUGES:
+    METRICS['db_pool_' + gauge] = ('gauge', "Connection pool {}".format(gauge), None)
+
+
+class Registry:
+    """
+    {name: {labels: values}}, the labels are a tuple of (label, value) and the values
+    are [value] for counters and gauges or the bucket counts + [sum, count] for histograms
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values = {}
+        self.written_at = 0.0
+
+    def reset(self) -> None:
+        self._lock = threading.Lock()
+        self.values = {}
+        self.written_at = 0.0
+
+    def inc(self, name, labels, amount=1) -> None:
+        with self._lock:
+            values = self.values.setdefault(name, {}).setdefault(labels, [0])
+            values[0] += amount
+
+    def observe(self, name, labels, value) -> None:
+        buckets = METRICS[name][2]
+        with self._lock:
+            values = self.values.setdefault(name, {}).setdefault(labels, [0] * (len(buckets) + 2))
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    values[index] += 1
+                    break
+            values[-2] += value
+            values[-1] += 1
+
+    def snapshot(self) -> dict:
+        """
+        Copy of the values with the gauges of this moment
+        """
+        with self._lock:
+            snapshot = {name: {labels: list(values) for labels, values in series.items()}
+                        for name, series in self.values.items()}
+        for alias, stats in pool_stats().items():
+            for gauge in POOL_GAUGES:
+                snapshot.setdefault('db_pool_' + gauge, {})[(('alias', alias),)] = [stats[gauge]]
+        return snapshot
+
+
+registry = Registry()
+if hasattr(os, 'register_at_fork'):
+    # the parent keeps its own values, a child starts from zero
+    os.register_at_fork(after_in_child=registry.reset)
+
+
+def multiprocess_dir():
+    return getattr(settings, 'METRICS_MULTIPROCESS_DIR', None)
+
+
+def _path(directory, pid) -> str:
+    return os.path.join(directory, 'metrics_{}.json'.format(pid))
+
+
+def write_snapshot(force=False) -> None:
+    """
+    Write the values of the process to METRICS_MULTIPROCESS_DIR, at most once per WRITE_INTERVAL
+    """
+    directory = multiprocess_dir()
+    now = time.monotonic()
+    if not directory or (not force and now - registry.written_at < WRITE_INTERVAL):
+        return
+    registry.written_at = now
+    data = {name: [[list(labels), values] for labels, values in series.items()]
+            for name, series in registry.snapshot().items()}
+    path = _path(directory, os.getpid())
+    temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+    with open(temporary, 'w') as stream:
+        json.dump(data, stream)
+    os.replace(temporary, path)
+
+
+atexit.register(write_snapshot, True)
+
+
+def _is_alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect() -> dict:
+    """
+    Values of this process, or the sum of every process in multiprocess mode, the
+    gauges of the processes that are gone are ignored
+    """
+    directory = multiprocess_dir()
+    if not directory:
+        return registry.snapshot()
+    write_snapshot(force=True)
+    total = {}
+    for path in glob.glob(os.path.join(directory, 'metrics_*.json')):
+        pid = int(os.path.basename(path)[len('metrics_'):-len('.json')])
+        try:
+            with open(path) as stream:
+                data = json.load(stream)
+        except (OSError, ValueError):
+            continue
+        alive = _is_alive(pid)
+        for name, series in data.items():
+            if name not in METRICS or (METRICS[name][0] == 'gauge' and not alive):
+                continue
+            for labels, values in series:
+                labels = tuple(tuple(label) for label in labels)
+                current = total.setdefault(name, {}).setdefault(labels, [0] * len(values))
+                for index, value in enumerate(values):
+                    current[index] += value
+    return total
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(label, _escape(value)) for label, value in labels) + '}'
+
+
+def render(values) -> str:
+    """
+    Prometheus text exposition format
+    """
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        series = values.get(name)
+        if not series:
+            continue
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, data in sorted(series.items()):
+            if kind != 'histogram':
+                lines.append('{}{} {}'.format(name, _labels(labels), data[0]))
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), data[:len(buckets)] + [data[-1]]):
+                cumulative = count if bound == '+Inf' else cumulative + count
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', bound),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), data[-2]))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), data[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+def is_allowed(request) -> bool:
+    if request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_IPS', ['127.0.0.1']):
+        return True
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    return bool(token) and constant_time_compare(authorization, 'Bearer ' + token)
+
+
+def metrics_view(request):
+    if not is_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render(collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class QueryMeter:
+    """
+    execute_wrapper that counts the queries and their time, the threads of a request
+    share it
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self._lock:
+                self.duration += time.perf_counter() - start
+                self.count += 1
+
+
+# meter of the request
+_meter = contextvars.ContextVar('query_meter', default=None)
+
+
+def measure(execute, sql, params, many, context):
+    meter = _meter.get()
+    if meter is None:
+        return execute(sql, params, many, context)
+    return meter(execute, sql, params, many, context)
+
+
+def install(connection, **kwargs) -> None:
+    """
+    Add measure to the wrappers of the connection, first, execute_wrapper pops the last one
+    """
+    if measure not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, measure)
+
+
+# the connections of every thread, the ones opened before are added by the middleware
+connection_created.connect(install)
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # the handler awaits the middleware, like MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        for connection in connections.all():
+            install(connection)
+        meter = QueryMeter()
+        token = _meter.set(meter)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _meter.reset(token)
+        return self.observe(request, response, meter, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        meter = QueryMeter()
+        token = _meter.set(meter)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _meter.reset(token)
+        return self.observe(request, response, meter, time.perf_counter() - start)
+
+    @staticmethod
+    def observe(request, response, meter, duration):
+        match = getattr(request, 'resolver_match', None)
+        view = (match.view_name or match._func_path) if match else 'unresolved'
+        labels = (('view', view),)
+        registry.inc('http_requests_total', labels + (('method', request.method), ('status', response.status_code)))
+        registry.observe('http_request_duration_seconds', labels, duration)
+        registry.observe('http_request_db_queries', labels, meter.count)
+        registry.observe('http_request_db_duration_seconds', labels, meter.duration)
+        if not response.streaming:
+            registry.observe('http_response_size_bytes', labels, len(response.content))
+        write_snapshot()
+        return response
@@ -44,6 +44,16 @@ ALLOWED_HOSTS = [
 # SESSION_COOKIE_DOMAIN = env('CURRENT_HOST')
 # SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 SESSION_SAVE_EVERY_REQUEST = True
+# the sessions are written when they change or every SESSION_REFRESH_THRESHOLD seconds, see base.sessions
+SESSION_ENGINE = 'base.sessions'
+SESSION_REFRESH_THRESHOLD = env.int('SESSION_REFRESH_THRESHOLD', default=300)
+SESSION_LOCAL_CACHE_SIZE = env.int('SESSION_LOCAL_CACHE_SIZE', default=10000)
+SESSION_LOCAL_CACHE_TTL = env.int('SESSION_LOCAL_CACHE_TTL', default=5)
+# pages of the anonymous users, see base.page_cache
+PAGE_CACHE_ALIAS = env('PAGE_CACHE_ALIAS', default=None)
+PAGE_CACHE_SIZE = env.int('PAGE_CACHE_SIZE', default=1000)
+PAGE_CACHE_TIMEOUT = env.int('PAGE_CACHE_TIMEOUT', default=600)
+PAGE_CACHE_LOCK_TIMEOUT = env.int('PAGE_CACHE_LOCK_TIMEOUT', default=10)
 SECURE_BROWSER_XSS_FILTER = True
 SECURE_CONTENT_TYPE_NOSNIFF = True
 # SESSION_COOKIE_SECURE = True
@@ -58,7 +68,7 @@ CSRF_TRUSTED_ORIGINS = [
     env('CURRENT_HOST'),
 ]
 
-MB = env('UPLOAD_MAX_SIZE') if env('UPLOAD_MAX_SIZE') else 19
+MB = env.int('UPLOAD_MAX_SIZE', default=19)
 UPLOAD_MAX_SIZE = MB * (1024 ** 2)
 DATA_UPLOAD_MAX_MEMORY_SIZE = UPLOAD_MAX_SIZE
 
@@ -81,6 +91,8 @@ INSTALLED_APPS = [
 PROJECT_APPS = [
     # Third Party Apps
     # 'base',
+    'rest_framework',
+    'django_filters',
     "hit",
 ]
 
@@ -89,12 +101,18 @@ INSTALLED_APPS += PROJECT_APPS
 # use my custom user model
 AUTH_USER_MODEL = 'profiles.CustomUser'
 
+# unique ids of usernames, hashes and tokens, see profiles.identifiers
+ID_GENERATOR = 'profiles.identifiers.MonotonicIdGenerator'
+
 MIDDLEWARE = [
+    'agencyGiuseppi.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'agencyGiuseppi.db_router.ReplicaPinMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'hit.events.ActorMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -126,18 +144,53 @@ WSGI_APPLICATION = 'agencyGiuseppi.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql',
+        'ENGINE': env('DB_ENGINE', default='base.db.mysql_pool'),
         'NAME': env('DB_NAME'),
         'USER': env('DB_USERNAME'),
         'PASSWORD': env('DB_PASSWORD'),
         'HOST': env('DB_HOST'),
         'PORT': env('DB_PORT'),
+        # connections per process, see base.db.pool
+        'POOL': {
+            'SIZE': env.int('DB_POOL_SIZE', default=10),
+            'MAX_LIFETIME': env.int('DB_POOL_MAX_LIFETIME', default=1800),
+            'TIMEOUT': env.float('DB_POOL_TIMEOUT', default=5.0),
+            'EXHAUSTED': env('DB_POOL_EXHAUSTED', default='wait'),
+        },
         'TEST': {
             'NAME': 'hitmen_test',
         },
     }
 }
 
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'rest_framework.authentication.SessionAuthentication',
+    ],
+    'DEFAULT_PERMISSION_CLASSES': [
+        'rest_framework.permissions.IsAuthenticated',
+    ],
+}
+
+# Threads (and database connections) of the async views, see base.async_db
+ASYNC_DB_WORKERS = env.int('ASYNC_DB_WORKERS', default=8)
+
+# Directory shared by the worker processes to add their metrics, see agencyGiuseppi.metrics
+METRICS_MULTIPROCESS_DIR = env('METRICS_MULTIPROCESS_DIR', default=None)
+# clients of the metrics view: these addresses or "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_ALLOWED_IPS = env.list('METRICS_ALLOWED_IPS', default=['127.0.0.1'])
+METRICS_TOKEN = env('METRICS_TOKEN', default=None)
+
+# Read replicas, e.g. DB_REPLICA_HOSTS=replica1,replica2 with the rest of the default settings
+DATABASE_REPLICAS = []
+for index, host in enumerate(env.list('DB_REPLICA_HOSTS', default=[]), start=1):
+    alias = 'replica{}'.format(index)
+    DATABASES[alias] = dict(DATABASES['default'], HOST=host, TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append(alias)
+DATABASE_ROUTERS = ['agencyGiuseppi.db_router.ReplicaRouter']
+# seconds that a user reads from default after a write
+REPLICA_PIN_SECONDS = env.int('REPLICA_PIN_SECONDS', default=5)
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -157,6 +210,12 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Processes to hash and check passwords out of the request thread, see profiles.passwords
+# 0 hashes in the request thread
+PASSWORD_HASHING_WORKERS = env.int('PASSWORD_HASHING_WORKERS', default=2)
+PASSWORD_HASHING_QUEUE = env.int('PASSWORD_HASHING_QUEUE', default=64)
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.2/topics/i18n/
 
@@ -178,12 +237,33 @@ STATIC_URL = '/static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
+# translation catalogs of manage.py compile_js_catalogs, see base.js_catalog
+JS_CATALOG_ROOT = os.path.join(STATIC_ROOT, 'jsi18n')
+JS_CATALOG_URL = STATIC_URL + 'jsi18n/'
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# JSON lines of the logger module (logger.log), the records also reach the handlers of
+# the parent loggers
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'json': {
+            'class': 'logger.QueueJsonHandler',
+        },
+    },
+    'loggers': {
+        'logger': {
+            'handlers': ['json'],
+            'level': 'INFO',
+        },
+    },
+}
+
 RAVEN_CONFIG = {
     'dsn': env('SENTRY_URL'),
 }
@@ -23,8 +23,10 @@ from rest_framework import routers
 from django.contrib.admin.views.decorators import staff_member_required
 from profiles import views as profiles_views
 from base import views as base_views
+from hit import views as hit_views
 from django.views.i18n import JavaScriptCatalog
 from django.contrib.sitemaps.views import sitemap
+from agencyGiuseppi.metrics import metrics_view
 
 # from base import views as base
 
@@ -33,7 +35,15 @@ from django.contrib.sitemaps.views import sitemap
 # handler500 = 'base.views.handler500'
 
 
-urlpatterns = [] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) \
+router = routers.DefaultRouter()
+router.register('hits', hit_views.HitViewSet, basename='hit')
+
+urlpatterns = [
+    path('api/', include(router.urls)),
+    path('api/async/', include('hit.urls')),
+    path('api/async/', include('profiles.urls')),
+    path('metrics', metrics_view, name='metrics'),
+] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) \
   + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 
 
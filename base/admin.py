@@ -1,3 +1,49 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Max
+from django.utils.functional import cached_property
 
 # Register your models here.
+
+# under this number of rows the exact COUNT(*) is cheap enough
+ESTIMATE_THRESHOLD = 100000
+# rows counted at most in a filtered list, the pages after them aren't listed
+COUNT_LIMIT = 100000
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator of the admin changelists of big tables: without filters the number of
+    rows is the estimate of the table statistics (MySQL) or the last primary key
+    instead of a COUNT(*) that scans the whole table, with filters it's the exact count
+    up to COUNT_LIMIT rows (a COUNT over a LIMIT subquery), narrow the filters to see
+    the rest.
+    """
+
+    def estimate(self):
+        queryset = self.object_list
+        if queryset.query.where or queryset.query.distinct:
+            return None
+        connection = connections[queryset.db]
+        if connection.vendor == 'mysql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT TABLE_ROWS FROM information_schema.TABLES "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                    [queryset.model._meta.db_table]
+                )
+                row = cursor.fetchone()
+            return row[0] if row else None
+        if queryset.model._meta.pk.get_internal_type() in ('AutoField', 'BigAutoField'):
+            return queryset.model._base_manager.using(queryset.db).aggregate(last=Max('pk'))['last'] or 0
+        return None
+
+    @cached_property
+    def count(self):
+        estimate = self.estimate()
+        if estimate is not None and estimate >= ESTIMATE_THRESHOLD:
+            return estimate
+        if estimate is None and hasattr(self.object_list, 'query'):
+            return self.object_list[:COUNT_LIMIT].count()
+        return super(EstimatedCountPaginator, self).count
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+"""
+ORM access for the async views.
+
+The ORM is synchronous, so the async views send their queries to a bounded pool of
+threads (ASYNC_DB_WORKERS), every thread keeps its own database connection, the pool
+size is the maximum number of connections of the async views of the process.
+Every call is a hop to a thread, a view sends all the work of its request in one call
+(see run_as_user) unless its queries are independent and can run at the same time with
+gather.
+"""
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.db import close_old_connections
+
+_executor = None
+_missing = object()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'ASYNC_DB_WORKERS', 8),
+            thread_name_prefix='async-db'
+        )
+    return _executor
+
+
+def _call(function, *args, **kwargs):
+    # the connections of the pool never see a request_finished signal
+    close_old_connections()
+    return function(*args, **kwargs)
+
+
+async def run_query(function, *args, **kwargs):
+    """
+    Run a function with ORM work in the pool, the function must return evaluated
+    data (lists, dicts), a lazy queryset would be evaluated in the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    # the context of the request, e.g. the read your writes window of the database router
+    context = contextvars.copy_context()
+    try:
+        return await loop.run_in_executor(get_executor(), context.run, partial(_call, function, *args, **kwargs))
+    finally:
+        # the changes of the thread go back to the request, e.g. a write pins the reads, like sync_to_async
+        for variable, value in context.items():
+            if variable.get(_missing) is not value:
+                variable.set(value)
+
+
+async def gather(*calls):
+    """
+    Run independent queries at the same time.
+    :param calls: tuples (function, *args)
+    :return list: the results in the same order
+    """
+    return await asyncio.gather(*(run_query(*call) for call in calls))
+
+
+async def get_user(request):
+    """
+    Authenticated user of the request or None, the session and the user are read in the pool
+    """
+    def load():
+        return request.user if request.user.is_authenticated else None
+    return await run_query(load)
+
+
+async def run_as_user(request, function, *args):
+    """
+    Load the authenticated user of the request and run function(user, *args) with it,
+    the session, the user and the queries of the function cost a single hop to the pool.
+    :return tuple: (user or None, the result or None when there is no user)
+    """
+    def load():
+        user = request.user if request.user.is_authenticated else None
+        return user, function(user, *args) if user is not None else None
+    return await run_query(load)
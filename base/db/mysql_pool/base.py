@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+"""
+django.db.backends.mysql with the connection pool of base.db.pool
+"""
+from django.db.backends.mysql import base
+
+from base.db.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+
+    def ping_connection(self, connection) -> None:
+        connection.ping()
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+"""
+Pool of database connections of the process.
+
+Django opens a connection per thread and closes it at the end of the request (or after
+CONN_MAX_AGE), with the pool close() returns the connection to the pool and the next
+connect() of any thread of the process takes it again:
+
+* bounded: at most SIZE connections of the alias per process
+* health check: an idle connection is pinged on checkout, a dead one is replaced
+* recycling: the connections older than MAX_LIFETIME seconds are closed
+* exhaustion: EXHAUSTED = 'wait' (up to TIMEOUT seconds), 'error' or 'overflow'
+  (a temporary connection over SIZE that is closed on release)
+
+The options are the POOL key of the database settings, see PooledDatabaseWrapperMixin.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+from django.db.utils import OperationalError
+
+WAIT = 'wait'
+ERROR = 'error'
+OVERFLOW = 'overflow'
+EXHAUSTED_POLICIES = (WAIT, ERROR, OVERFLOW)
+
+
+class PoolExhausted(OperationalError):
+    pass
+
+
+class ConnectionPool:
+
+    def __init__(self, connect, ping, size=10, max_lifetime=1800, timeout=5.0, exhausted=WAIT):
+        """
+        :param connect: function without arguments that opens a connection
+        :param ping: function that receives a connection and raises an exception when it's dead
+        """
+        if exhausted not in EXHAUSTED_POLICIES:
+            raise ValueError("Unknown pool exhausted policy: {}".format(exhausted))
+        self.connect = connect
+        self.ping = ping
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.exhausted = exhausted
+        self._condition = threading.Condition()
+        # (connection, created), the last released is the first reused
+        self._idle = deque()
+        # id(connection): created, the connections checked out
+        self._in_use = {}
+        self._overflow = set()
+        self._open = 0
+        self.checkouts = 0
+        self.created = 0
+        self.recycled = 0
+        self.ping_failures = 0
+        self.overflows = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def stats(self) -> dict:
+        """
+        Size, usage and wait (seconds) metrics
+        """
+        with self._condition:
+            return {
+                'size': self.size,
+                'open': self._open,
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+                'checkouts': self.checkouts,
+                'created': self.created,
+                'recycled': self.recycled,
+                'ping_failures': self.ping_failures,
+                'overflows': self.overflows,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'avg_wait': self.total_wait / self.waits if self.waits else 0.0,
+                'max_wait': self.max_wait,
+            }
+
+    def _expired(self, created) -> bool:
+        return self.max_lifetime is not None and time.monotonic() - created >= self.max_lifetime
+
+    def _close(self, connection) -> None:
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _take(self):
+        """
+        :return tuple: (idle connection or None, True when a new connection must be opened,
+            True when it is an overflow connection, closed on release)
+        """
+        start = time.monotonic()
+        waited = False
+        with self._condition:
+            while True:
+                if self._idle:
+                    connection, created = self._idle.pop()
+                    self._in_use[id(connection)] = created
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    connection = None
+                    break
+                if self.exhausted == OVERFLOW:
+                    self.overflows += 1
+                    return None, True, True
+                remaining = self.timeout - (time.monotonic() - start)
+                if self.exhausted == ERROR or remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolExhausted("The pool of {} connections is exhausted".format(self.size))
+                waited = True
+                self._condition.wait(remaining)
+            if waited:
+                wait = time.monotonic() - start
+                self.waits += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            self.checkouts += 1
+        return connection, connection is None, False
+
+    def _discard(self, connection=None) -> None:
+        with self._condition:
+            if connection is not None:
+                self._in_use.pop(id(connection), None)
+            self._open -= 1
+            self._condition.notify()
+
+    def acquire(self):
+        while True:
+            connection, new, overflow = self._take()
+            if new:
+                try:
+                    connection = self.connect()
+                except Exception:
+                    if not overflow:
+                        self._discard()
+                    raise
+                with self._condition:
+                    self.created += 1
+                    if overflow:
+                        self._overflow.add(id(connection))
+                    else:
+                        self._in_use[id(connection)] = time.monotonic()
+                return connection
+            if self._expired(self._in_use[id(connection)]):
+                with self._condition:
+                    self.recycled += 1
+                self._close(connection)
+                self._discard(connection)
+                continue
+            try:
+                self.ping(connection)
+            except Exception:
+                with self._condition:
+                    self.ping_failures += 1
+                self._close(connection)
+                self._discard(connection)
+                continue
+            return connection
+
+    def release(self, connection, discard=False) -> None:
+        """
+        Return a connection to the pool, the open transaction is rolled back
+        :param bool discard: close the connection, e.g. it's broken
+        """
+        with self._condition:
+            if id(connection) in self._overflow:
+                self._overflow.discard(id(connection))
+                overflow = True
+            else:
+                overflow = False
+                created = self._in_use.get(id(connection))
+                if created is None:
+                    # it isn't a connection of the pool
+                    overflow = True
+        if not discard and not overflow:
+            try:
+                connection.rollback()
+            except Exception:
+                discard = True
+        if overflow:
+            self._close(connection)
+        elif discard or self._expired(created):
+            with self._condition:
+                self.recycled += not discard
+            self._close(connection)
+            self._discard(connection)
+        else:
+            with self._condition:
+                self._in_use.pop(id(connection), None)
+                self._idle.append((connection, created))
+                self._condition.notify()
+
+    def close_idle(self) -> None:
+        with self._condition:
+            idle, self._idle = self._idle, deque()
+            self._open -= len(idle)
+            self._condition.notify_all()
+        for connection, _ in idle:
+            self._close(connection)
+
+
+_pools = {}
+_lock = threading.Lock()
+if hasattr(os, 'register_at_fork'):
+    # the connections of the parent must not be used (or closed) by a child
+    os.register_at_fork(after_in_child=_pools.clear)
+
+
+def get_pool(key, connect, ping, options) -> ConnectionPool:
+    """
+    Pool of the process for the key, created the first time with the POOL options
+    """
+    pool = _pools.get(key)
+    if pool is None:
+        with _lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(
+                    connect,
+                    ping,
+                    size=options.get('SIZE', 10),
+                    max_lifetime=options.get('MAX_LIFETIME', 1800),
+                    timeout=options.get('TIMEOUT', 5.0),
+                    exhausted=options.get('EXHAUSTED', WAIT),
+                )
+    return pool
+
+
+def pool_stats() -> dict:
+    """
+    Metrics of every pool of the process by alias
+    """
+    return {alias: pool.stats() for (alias, _), pool in list(_pools.items())}
+
+
+class PooledDatabaseWrapperMixin:
+    """
+    Mixin for a DatabaseWrapper, e.g.
+
+        DATABASES = {'default': {
+            'ENGINE': 'base.db.mysql_pool',
+            'POOL': {'SIZE': 10, 'MAX_LIFETIME': 1800, 'TIMEOUT': 5, 'EXHAUSTED': 'wait'},
+            ...
+        }}
+    """
+
+    def ping_connection(self, connection) -> None:
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        finally:
+            cursor.close()
+
+    @property
+    def pool(self) -> ConnectionPool:
+        # the test runner changes the name of the database
+        key = (self.alias, self.settings_dict['NAME'])
+        return get_pool(key, self._connect_for_pool, self.ping_connection, self.settings_dict.get('POOL', {}))
+
+    def _connect_for_pool(self):
+        return super().get_new_connection(self.get_connection_params())
+
+    def get_new_connection(self, conn_params):
+        return self.pool.acquire()
+
+    def _close(self):
+        if self.connection is not None:
+            self.pool.release(self.connection, discard=self.errors_occurred and not self.is_usable())
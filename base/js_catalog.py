@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+"""
+JavaScript translation catalogs compiled to static files, see the command
+compile_js_catalogs and the template tag js_catalog_url (base.templatetags.js_catalog).
+
+The catalog of every language of LANGUAGES is rendered once by JavaScriptCatalog and
+written to JS_CATALOG_ROOT as <language>.<hash of the content>.js, a new translation
+gets a new name so the files can be cached forever. manifest.json maps the languages to
+their files, a language without file falls back to the dynamic view jsi18n/.
+"""
+import hashlib
+import json
+import os
+import threading
+
+from django.conf import settings
+from django.http import HttpRequest
+from django.urls import reverse
+from django.utils import translation
+from django.views.i18n import JavaScriptCatalog
+
+MANIFEST = 'manifest.json'
+HASH_LENGTH = 12
+_manifest = {'version': None, 'files': {}}
+_lock = threading.Lock()
+
+
+def catalog_root() -> str:
+    return getattr(settings, 'JS_CATALOG_ROOT', None) or os.path.join(settings.STATIC_ROOT, 'jsi18n')
+
+
+def catalog_url() -> str:
+    return getattr(settings, 'JS_CATALOG_URL', None) or settings.STATIC_URL + 'jsi18n/'
+
+
+def render(language) -> bytes:
+    """
+    Content of the dynamic view for the language
+    """
+    request = HttpRequest()
+    request.method = 'GET'
+    with translation.override(language):
+        return JavaScriptCatalog.as_view()(request).content
+
+
+def compile_catalogs(languages, root=None) -> dict:
+    """
+    :return dict: {language: file name}, the manifest written to the root
+    """
+    root = root or catalog_root()
+    os.makedirs(root, exist_ok=True)
+    # the other languages keep their files
+    try:
+        with open(os.path.join(root, MANIFEST)) as stream:
+            files = json.load(stream)
+    except (OSError, ValueError):
+        files = {}
+    for language in languages:
+        content = render(language)
+        name = '{}.{}.js'.format(language, hashlib.md5(content).hexdigest()[:HASH_LENGTH])
+        path = os.path.join(root, name)
+        if not os.path.exists(path):
+            with open(path, 'wb') as stream:
+                stream.write(content)
+        files[language] = name
+    temporary = os.path.join(root, MANIFEST + '.tmp')
+    with open(temporary, 'w') as stream:
+        json.dump(files, stream, indent=2, sort_keys=True)
+    os.replace(temporary, os.path.join(root, MANIFEST))
+    return files
+
+
+def manifest() -> dict:
+    """
+    The manifest of JS_CATALOG_ROOT, read again when the command writes a new one
+    """
+    path = os.path.join(catalog_root(), MANIFEST)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+    # the command replaces the file, a new inode
+    version = (stat.st_ino, stat.st_mtime_ns)
+    with _lock:
+        if _manifest['version'] != version:
+            try:
+                with open(path) as stream:
+                    _manifest['files'] = json.load(stream)
+            except (OSError, ValueError):
+                return {}
+            _manifest['version'] = version
+        return _manifest['files']
+
+
+def url(language=None) -> str:
+    """
+    URL of the compiled catalog of the language (the active one by default) or the
+    dynamic view when it isn't compiled
+    """
+    language = language or translation.get_language() or settings.LANGUAGE_CODE
+    files = manifest()
+    name = files.get(language) or files.get(language.split('-')[0])
+    if name:
+        return catalog_url() + name
+    with translation.override(language):
+        return reverse('javascript-catalog')
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+"""
+Benchmark of the hits and profiles operations over a synthetic organization.
+
+The command creates a test database (like manage.py test, the real data is never
+touched), loads a tree of users with FANOUT subordinates per boss and the hits with
+profiles.management.commands.load_data, then runs every operation ITERATIONS times and
+reports the throughput, the latency percentiles and the queries per operation. The
+search of hit.search is compared with an icontains scan over the same words and the
+session writes per SESSION_REQUESTS requests of a logged in user with base.sessions are
+compared with the database engine. The first page of hits of the DRF viewset (WSGI
+handler, CONCURRENCY threads like a threaded server) is compared with the async view of
+api/async/ (ASGI handler, CONCURRENCY requests at a time in the event loop), their
+queries per request come from the metrics of MetricsMiddleware.
+The random seed is fixed, two runs with the same arguments do the same work.
+
+    DB_ENGINE=django.db.backends.sqlite3 python manage.py benchmark --hits 1000000 --output bench.json
+    python manage.py benchmark --compare bench.json
+"""
+import asyncio
+import json
+import math
+import platform
+import queue
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from agencyGiuseppi import metrics
+from agencyGiuseppi.metrics import QueryMeter
+from hit.models import ASSIGNED, COMPLETED, FAILED, Hit, UNASSIGNED
+from hit.work_list import get_work_list
+from profiles.management.commands.load_data import Loader
+from profiles.models import CustomUser, Job
+
+PERCENTILES = (50, 90, 99)
+# status: weight of the synthetic hits
+STATUS_WEIGHTS = {UNASSIGNED: 10, ASSIGNED: 60, FAILED: 10, COMPLETED: 20}
+EMAIL = 'user{}@benchmark.test'
+SYLLABLES = ('ba', 'co', 'di', 'fe', 'ga', 'lo', 'mi', 'no', 'pe', 'ri', 'sa', 'to', 'vi', 'zu')
+VOCABULARY_SIZE = 5000
+# the icontains search is a table scan, a few runs are enough
+SEARCH_ITERATIONS = 20
+SEARCH_LIMIT = 20
+SESSION_REQUESTS = 1000
+SESSION_ENGINES = {'session.request': 'base.sessions', 'session.request_db': 'django.contrib.sessions.backends.db'}
+VIEW_REQUESTS = 1000
+CONCURRENCY = 8
+# name: (URL name, view name of the metrics, client class)
+VIEWS = {
+    'view.hits_wsgi': ('hit-list', 'hit-list', Client),
+    'view.hits_asgi': ('async-hit-list', 'async-hit-list', AsyncClient),
+}
+
+
+class Prehashed:
+    """
+    Stand-in of the password pool of the Loader, the hashes aren't measured here
+    """
+
+    def __init__(self):
+        self.password = None
+
+    def map(self, function, passwords, chunksize=1):
+        if self.password is None:
+            self.password = function('benchmark')
+        return [self.password for _ in passwords]
+
+
+def percentile(latencies, value) -> float:
+    return latencies[max(math.ceil(value / 100 * len(latencies)) - 1, 0)]
+
+
+class Command(BaseCommand):
+    help = "Benchmark the hits and profiles operations in a test database, see base.management.commands.benchmark"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--hits', type=int, default=10000)
+        parser.add_argument('--fanout', type=int, default=10, help="subordinates per boss")
+        parser.add_argument('--iterations', type=int, default=200, help="runs of every operation")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--output', help="write the results to this JSON file")
+        parser.add_argument('--compare', help="JSON file of a previous run to diff with")
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError("At least 2 users, the boss and a hitman")
+        self.random = random.Random(options['seed'])
+        self.iterations = options['iterations']
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            # every query to the test database, the replicas aren't created, and the
+            # host of the test clients is allowed like manage.py test does
+            with override_settings(DATABASE_REPLICAS=[], ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+                cache.clear()
+                start = time.perf_counter()
+                self.populate(options)
+                self.stdout.write("{} users and {} hits in {:.1f}s".format(
+                    options['users'], options['hits'], time.perf_counter() - start))
+                results = self.run_operations()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            'meta': {
+                'users': options['users'],
+                'hits': options['hits'],
+                'fanout': options['fanout'],
+                'iterations': self.iterations,
+                'seed': options['seed'],
+                'database': connection.vendor,
+                'django': django.get_version(),
+                'python': platform.python_version(),
+            },
+            'results': results,
+        }
+        self.print_results(results)
+        if options['compare']:
+            with open(options['compare']) as stream:
+                self.print_comparison(json.load(stream)['results'], results)
+        if options['output']:
+            with open(options['output'], 'w') as stream:
+                json.dump(report, stream, indent=2, sort_keys=True)
+
+    def populate(self, options) -> None:
+        """
+        Heap shaped organization: the boss of user i is the user (i - 1) // fanout and
+        the job of every level reports to the job of the level above.
+        """
+        fanout = options['fanout']
+        # words of 3 syllables for the names and the descriptions, e.g. "baditu"
+        self.vocabulary = sorted({
+            ''.join(self.random.choices(SYLLABLES, k=3)) for _ in range(VOCABULARY_SIZE)})
+        loader = Loader(options['batch_size'], Prehashed(), self.stdout)
+        levels = [0]
+        for index in range(1, options['users']):
+            levels.append(levels[(index - 1) // fanout] + 1)
+        for level in range(max(levels) + 1):
+            loader.add({'type': 'job', 'id': level, 'name': 'Level {}'.format(level),
+                        'report_to': level - 1 if level else None})
+        for index, level in enumerate(levels):
+            loader.add({
+                'type': 'user',
+                'email': EMAIL.format(index),
+                'is_superuser': index == 0,
+                'job': level,
+                'report_to': EMAIL.format((index - 1) // fanout) if index else None,
+            })
+        statuses, weights = list(STATUS_WEIGHTS), list(STATUS_WEIGHTS.values())
+        for number in range(options['hits']):
+            status = self.random.choices(statuses, weights)[0]
+            assignee = self.random.randrange(1, options['users'])
+            loader.add({
+                'type': 'hit',
+                'target_name': ' '.join(self.random.choices(self.vocabulary, k=2)),
+                'description': ' '.join(self.random.choices(self.vocabulary, k=6)),
+                'status': status,
+                'assigned_to': EMAIL.format(assignee) if status != UNASSIGNED else None,
+                'created_by': EMAIL.format((assignee - 1) // fanout),
+            })
+        loader.finish()
+
+    def sample(self, population) -> list:
+        population = list(population)
+        return self.random.sample(population, min(self.iterations, len(population)))
+
+    def run_operations(self) -> dict:
+        users = list(CustomUser.objects.filter(is_superuser=False))
+        boss_ids = set(CustomUser.objects.exclude(report_to=None).values_list('report_to_id', flat=True))
+        # the superuser too, the only boss of a small tree
+        bosses = list(CustomUser.objects.filter(pk__in=boss_ids))
+        # job of the subordinates of a job
+        child_jobs = dict(Job.objects.exclude(report_to=None).values_list('report_to_id', 'id'))
+        unassigned = Hit.objects.in_bulk(self.sample(
+            Hit.objects.filter(status=UNASSIGNED).values_list('id', flat=True)))
+        assigned = list(Hit.objects.in_bulk(self.sample(
+            Hit.objects.filter(status=ASSIGNED).values_list('id', flat=True))).values())
+        half = len(assigned) // 2
+        new_users = range(self.iterations)
+        # a manager looks for the target name of a past hit
+        searches = list(Hit.objects.filter(id__in=self.sample(
+            Hit.objects.values_list('id', flat=True))[:SEARCH_ITERATIONS]).values_list('target_name', flat=True))
+
+        def icontains(name):
+            queryset = Hit.objects.all()
+            for word in name.split():
+                queryset = queryset.filter(Q(target_name__icontains=word) | Q(description__icontains=word))
+            return list(queryset.order_by('-id')[:SEARCH_LIMIT])
+
+        def assign(hit):
+            hit.assign(self.random.choice(users))
+
+        def save_transition(hit):
+            hit.status = COMPLETED
+            hit.save()
+
+        def save_user(user):
+            user.first_name = 'Name'
+            user.save()
+
+        def create_user(number):
+            boss = self.random.choice(bosses)
+            CustomUser.objects.create_user(
+                'new{}'.format(number), email='new{}@benchmark.test'.format(number), password=None,
+                job_id=child_jobs[boss.job_id], report_to=boss)
+
+        operations = [
+            ('hit.assign', list(unassigned.values()), assign),
+            ('hit.save_transition', assigned[:half], save_transition),
+            ('hit.transition', assigned[half:], lambda hit: hit.transition(FAILED)),
+            ('user.save', self.sample(users), save_user),
+            ('user.create', new_users, create_user),
+            ('user.subordinates', self.sample(bosses),
+             lambda boss: list(CustomUser.objects.subordinates_of(boss).values_list('id', flat=True))),
+            ('hit.visible_to', self.sample(users), lambda user: list(
+                Hit.objects.visible_to(user).select_related('assigned_to', 'created_by').order_by('-created_at')[:50])),
+            ('hit.work_list', self.sample(users), lambda user: get_work_list(user.pk)),
+            ('hit.search', searches, lambda name: list(Hit.objects.search(name)[:SEARCH_LIMIT])),
+            ('hit.icontains', searches, icontains),
+        ]
+        results = {name: self.measure(name, items, operation) for name, items, operation in operations}
+        for name, engine in SESSION_ENGINES.items():
+            results[name] = self.measure_sessions(name, engine, users[0])
+        for name, view in VIEWS.items():
+            results[name] = self.measure_view(name, *view, self.sample(users)[:CONCURRENCY])
+        return results
+
+    def measure_view(self, name, url_name, view_name, client_class, users) -> dict:
+        """
+        VIEW_REQUESTS requests of the users, CONCURRENCY at a time
+        """
+        url = reverse(url_name)
+        clients = queue.Queue()
+        for user in users:
+            client = client_class()
+            client.force_login(user)
+            clients.put(client)
+
+        def get(_):
+            client = clients.get()
+            try:
+                start = time.perf_counter()
+                response = client.get(url)
+                if response.status_code != 200:
+                    raise CommandError("{}: status {}".format(name, response.status_code))
+                return time.perf_counter() - start
+            finally:
+                clients.put(client)
+
+        async def aget(_):
+            client = clients.get_nowait()
+            try:
+                start = time.perf_counter()
+                response = await client.get(url)
+                if response.status_code != 200:
+                    raise CommandError("{}: status {}".format(name, response.status_code))
+                return time.perf_counter() - start
+            finally:
+                clients.put_nowait(client)
+
+        async def run_async():
+            # a client per request in flight
+            semaphore = asyncio.Semaphore(len(users))
+
+            async def limited(index):
+                async with semaphore:
+                    return await aget(index)
+            return await asyncio.gather(*(limited(index) for index in range(VIEW_REQUESTS)))
+
+        metrics.registry.reset()
+        start = time.perf_counter()
+        if client_class is AsyncClient:
+            latencies = asyncio.run(run_async())
+        else:
+            with ThreadPoolExecutor(CONCURRENCY) as executor:
+                latencies = list(executor.map(get, range(VIEW_REQUESTS)))
+        elapsed = time.perf_counter() - start
+        queries = metrics.registry.snapshot().get('http_request_db_queries', {}).get((('view', view_name),))
+        return self.summarize(name, latencies, elapsed, queries[-2] if queries else 0)
+
+    def measure_sessions(self, name, engine, user) -> dict:
+        """
+        Requests of a logged in user, the result has the session writes per 1k requests
+        """
+        writes = QueryMeter()
+
+        def count_writes(execute, sql, params, many, context):
+            if 'django_session' in sql and not sql.startswith('SELECT'):
+                return writes(execute, sql, params, many, context)
+            return execute(sql, params, many, context)
+
+        with override_settings(SESSION_ENGINE=engine):
+            # a new client, the middleware reads the engine when it's loaded
+            client = Client()
+            client.force_login(user)
+            url = reverse('javascript-catalog')
+
+            def get(_):
+                response = client.get(url)
+                if response.status_code != 200:
+                    raise CommandError("{}: status {}".format(name, response.status_code))
+            with connection.execute_wrapper(count_writes):
+                result = self.measure(name, range(SESSION_REQUESTS), get)
+        result['session_writes_per_1k'] = writes.count * 1000 / SESSION_REQUESTS
+        return result
+
+    def measure(self, name, items, operation) -> dict:
+        latencies = []
+        meter = QueryMeter()
+        with connection.execute_wrapper(meter):
+            start = time.perf_counter()
+            for item in items:
+                operation_start = time.perf_counter()
+                operation(item)
+                latencies.append(time.perf_counter() - operation_start)
+            elapsed = time.perf_counter() - start
+        return self.summarize(name, latencies, elapsed, meter.count)
+
+    def summarize(self, name, latencies, elapsed, queries) -> dict:
+        if not latencies:
+            self.stdout.write(self.style.WARNING("{}: nothing to measure".format(name)))
+            return {}
+        latencies.sort()
+        result = {
+            'operations': len(latencies),
+            'ops_per_second': len(latencies) / elapsed,
+            'queries_per_operation': queries / len(latencies),
+            'max_ms': latencies[-1] * 1000,
+        }
+        for value in PERCENTILES:
+            result['p{}_ms'.format(value)] = percentile(latencies, value) * 1000
+        return result
+
+    def print_results(self, results) -> None:
+        self.stdout.write("{:<20} {:>8} {:>10} {:>9} {:>9} {:>9} {:>9}".format(
+            'operation', 'ops', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms', 'queries'))
+        for name, result in results.items():
+            if result:
+                self.stdout.write("{:<20} {:>8} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f}".format(
+                    name, result['operations'], result['ops_per_second'], result['p50_ms'],
+                    result['p90_ms'], result['p99_ms'], result['queries_per_operation']))
+        for name, result in results.items():
+            if 'session_writes_per_1k' in result:
+                self.stdout.write("{}: {:.0f} session writes per 1k requests".format(
+                    name, result['session_writes_per_1k']))
+
+    def print_comparison(self, baseline, results) -> None:
+        self.stdout.write("{:<20} {:>10} {:>10} {:>12}".format('change', 'ops/s', 'p50', 'queries'))
+        for name, result in results.items():
+            before = baseline.get(name)
+            if not result or not before:
+                continue
+            self.stdout.write("{:<20} {:>+9.1f}% {:>+9.1f}% {:>+12.1f}".format(
+                name,
+                (result['ops_per_second'] / before['ops_per_second'] - 1) * 100,
+                (result['p50_ms'] / before['p50_ms'] - 1) * 100 if before['p50_ms'] else 0,
+                result['queries_per_operation'] - before['queries_per_operation']))
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from base.js_catalog import catalog_root, compile_catalogs
+
+
+class Command(BaseCommand):
+    help = "Write the JavaScript translation catalog of every language to a static file, see base.js_catalog"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--language', action='append', dest='languages',
+                            help="compile only this language, can be repeated (default: LANGUAGES)")
+        parser.add_argument('--root', help="directory of the files (default: JS_CATALOG_ROOT)")
+
+    def handle(self, *args, **options):
+        languages = options['languages'] or [code for code, name in settings.LANGUAGES]
+        root = options['root'] or catalog_root()
+        files = compile_catalogs(languages, root)
+        self.stdout.write(self.style.SUCCESS("{} catalogs written to {}".format(len(files), root)))
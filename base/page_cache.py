@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+"""
+Full page cache of the anonymous GET requests, see cache_anonymous_page.
+
+The key of a page is the full URL (with the language prefix of i18n_patterns), the
+active language and the values of the request headers named in the Vary of the
+response, learned from the first response of the URL like django.utils.cache does. The
+pages live in a bounded LRU of the process (PAGE_CACHE_SIZE pages) and, with
+PAGE_CACHE_ALIAS, in that shared cache too, for PAGE_CACHE_TIMEOUT seconds.
+
+A missing page is rendered once: the other requests of the process wait for it (single
+flight) and, with a shared cache, a lock in it does the same across the processes, up to
+PAGE_CACHE_LOCK_TIMEOUT seconds. invalidate() drops every page now and again on commit,
+invalidate_on(*models) connects it to the changes of the models.
+
+Never cached: authenticated users, responses that set cookies, use the CSRF token or
+change the session, status other than 200, streaming and private or no-store responses.
+"""
+import hashlib
+import threading
+import time
+from functools import partial, wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.http import HttpResponse
+from django.utils.cache import cc_delim_re
+from django.utils.translation import get_language
+
+from base.lru import LRUCache
+
+KEY_PREFIX = 'page'
+GENERATION_KEY = 'page:generation'
+# seconds a process trusts its copy of the generation of the shared cache
+GENERATION_TTL = 1
+POLL_INTERVAL = 0.05
+UNCACHEABLE = ('private', 'no-store', 'no-cache')
+
+
+def _hash(value) -> str:
+    return hashlib.md5(value.encode()).hexdigest()
+
+
+class PageCache:
+
+    def __init__(self, size):
+        self.local = LRUCache(size, ttl=0)
+        self._generation = 1
+        self._lock = threading.Lock()
+        # path key: threading.Event set when its page is rendered
+        self._flights = {}
+
+    @property
+    def shared(self):
+        alias = getattr(settings, 'PAGE_CACHE_ALIAS', None)
+        return caches[alias] if alias else None
+
+    @property
+    def lock_timeout(self):
+        return getattr(settings, 'PAGE_CACHE_LOCK_TIMEOUT', 10)
+
+    def generation(self) -> int:
+        shared = self.shared
+        if shared is None:
+            return self._generation
+        generation = self.local.get(GENERATION_KEY)
+        if generation is None:
+            generation = shared.get(GENERATION_KEY)
+            if generation is None:
+                shared.add(GENERATION_KEY, 1, None)
+                generation = shared.get(GENERATION_KEY)
+            self.local.set(GENERATION_KEY, generation, GENERATION_TTL)
+        return generation
+
+    def invalidate(self) -> None:
+        shared = self.shared
+        if shared is not None:
+            try:
+                shared.incr(GENERATION_KEY)
+            except ValueError:
+                self.generation()
+        else:
+            self._generation += 1
+        self.local.clear()
+
+    def _get(self, key):
+        value = self.local.get(key)
+        shared = self.shared
+        if value is None and shared is not None:
+            entry = shared.get(key)
+            if entry is not None:
+                value, expires = entry
+                self.local.set(key, value, expires - time.time())
+        return value
+
+    def _set(self, key, value, timeout) -> None:
+        self.local.set(key, value, timeout)
+        shared = self.shared
+        if shared is not None:
+            shared.set(key, (value, time.time() + timeout), timeout)
+
+    def _path_key(self, request) -> str:
+        return '{}:{}:{}:{}'.format(KEY_PREFIX, self.generation(), get_language(),
+                                    _hash(request.build_absolute_uri()))
+
+    @staticmethod
+    def _page_key(request, path_key, headers) -> str:
+        values = '\n'.join(request.META.get('HTTP_' + header.upper().replace('-', '_'), '') for header in headers)
+        return '{}:{}:{}'.format(path_key, request.method, _hash(values))
+
+    def get(self, request):
+        """
+        The cached response of the request or None
+        """
+        path_key = self._path_key(request)
+        headers = self._get(path_key + ':headers')
+        if headers is None:
+            return None
+        page = self._get(self._page_key(request, path_key, headers))
+        if page is None:
+            return None
+        status, items, content = page
+        response = HttpResponse(content, status=status)
+        for header, value in items:
+            response[header] = value
+        return response
+
+    @staticmethod
+    def cacheable(request, response) -> bool:
+        session = getattr(request, 'session', None)
+        cache_control = response.get('Cache-Control', '').lower()
+        return (response.status_code == 200 and not response.streaming and not response.cookies
+                and not request.META.get('CSRF_COOKIE_USED')
+                and not (session is not None and session.modified)
+                and not any(directive in cache_control for directive in UNCACHEABLE))
+
+    def store(self, request, response, timeout):
+        if not self.cacheable(request, response):
+            return response
+        headers = sorted({header.lower() for header in cc_delim_re.split(response.get('Vary', '')) if header})
+        if '*' in headers:
+            return response
+        path_key = self._path_key(request)
+        self._set(path_key + ':headers', headers, timeout)
+        self._set(self._page_key(request, path_key, headers),
+                  (response.status_code, list(response.items()), response.content), timeout)
+        return response
+
+    def _render(self, request, render, timeout):
+        response = render()
+        if hasattr(response, 'render') and not response.is_rendered:
+            response.render()
+        return self.store(request, response, timeout)
+
+    def _wait(self, request, seconds):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            response = self.get(request)
+            if response is not None:
+                return response
+        return None
+
+    def regenerate(self, request, render, timeout):
+        """
+        Render the missing page of the request once, the concurrent requests get its copy
+        """
+        key = self._path_key(request)
+        with self._lock:
+            event = self._flights.get(key)
+            leader = event is None
+            if leader:
+                event = self._flights[key] = threading.Event()
+        if not leader:
+            event.wait(self.lock_timeout)
+            response = self.get(request)
+            # e.g. a response that can't be cached
+            return response if response is not None else self._render(request, render, timeout)
+
+        shared = self.shared
+        locked = False
+        try:
+            if shared is not None:
+                locked = shared.add(key + ':lock', 1, self.lock_timeout)
+                if not locked:
+                    response = self._wait(request, self.lock_timeout)
+                    if response is not None:
+                        return response
+            return self._render(request, render, timeout)
+        finally:
+            if locked:
+                shared.delete(key + ':lock')
+            with self._lock:
+                del self._flights[key]
+            event.set()
+
+
+page_cache = PageCache(getattr(settings, 'PAGE_CACHE_SIZE', 1000))
+
+
+def cache_anonymous_page(view=None, timeout=None):
+    """
+    Decorator of the views of the anonymous users, e.g. cache_anonymous_page(Index.as_view())
+    """
+    if view is None:
+        return partial(cache_anonymous_page, timeout=timeout)
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        user = getattr(request, 'user', None)
+        if request.method not in ('GET', 'HEAD') or (user is not None and user.is_authenticated):
+            return view(request, *args, **kwargs)
+        response = page_cache.get(request)
+        if response is None:
+            seconds = timeout if timeout is not None else getattr(settings, 'PAGE_CACHE_TIMEOUT', 600)
+            response = page_cache.regenerate(request, lambda: view(request, *args, **kwargs), seconds)
+        return response
+    return wrapper
+
+
+def invalidate(**kwargs) -> None:
+    """
+    Drop every page now and again on commit, a page rendered in the middle would have
+    the data before the commit. The keyword arguments of the signals are ignored.
+    """
+    page_cache.invalidate()
+    transaction.on_commit(page_cache.invalidate)
+
+
+def invalidate_on(*models) -> None:
+    """
+    Invalidate the pages when an instance of the models is saved or deleted
+    """
+    for model in models:
+        for signal in (post_save, post_delete):
+            signal.connect(invalidate, sender=model, weak=False,
+                           dispatch_uid='page_cache:{}'.format(model._meta.label))
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+"""
+Session engine that coalesces the writes of SESSION_SAVE_EVERY_REQUEST.
+
+The sessions are read from an in-process LRU, then from the cache SESSION_CACHE_ALIAS and
+last from django_session, like cached_db. With SESSION_SAVE_EVERY_REQUEST the middleware
+saves the session of every request to slide its expiry, here the save only writes when:
+* the data changed (or the session is new), or
+* the stored expiry is older than SESSION_REFRESH_THRESHOLD seconds, i.e. less than
+  SESSION_COOKIE_AGE - SESSION_REFRESH_THRESHOLD seconds remain.
+The cookie still slides on every request, the stored expiry lags at most the threshold.
+
+The LRU keeps SESSION_LOCAL_CACHE_SIZE anonymous sessions for SESSION_LOCAL_CACHE_TTL
+seconds, a change made by another process is seen after that time at most (0 disables
+the LRU). The authenticated sessions are never kept in the LRU, they are read from the
+shared cache, so a logout, flush or cycle_key in one process ends them in every process.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.contrib.sessions.backends import db
+from django.core.cache import caches
+from django.utils import timezone
+
+from base.lru import LRUCache
+
+KEY_PREFIX = 'base.sessions'
+local_cache = LRUCache(getattr(settings, 'SESSION_LOCAL_CACHE_SIZE', 10000),
+                       getattr(settings, 'SESSION_LOCAL_CACHE_TTL', 5))
+
+
+class SessionStore(db.SessionStore):
+    cache_key_prefix = KEY_PREFIX
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        self._cache = caches[settings.SESSION_CACHE_ALIAS]
+        # expiry stored in the database, None until the session is loaded or saved
+        self._expire_date = None
+        self._entry = None
+
+    @property
+    def cache_key(self):
+        return self.cache_key_prefix + self._get_or_create_session_key()
+
+    def _remember_local(self, entry, data) -> None:
+        # a logout in another process must end an authenticated session at once
+        if SESSION_KEY not in data:
+            local_cache.set(self.session_key, entry)
+
+    def _remember(self, entry) -> None:
+        self._cache.set(self.cache_key, entry, max(int((entry[1] - timezone.now()).total_seconds()), 1))
+
+    def _get_entry(self):
+        """
+        :return tuple: (entry, True if it comes from the LRU) or (None, False)
+        """
+        entry = local_cache.get(self.session_key)
+        if entry is not None:
+            return entry, True
+        try:
+            entry = self._cache.get(self.cache_key)
+        except Exception:
+            # some backends (e.g. memcache) raise an exception on invalid cache keys
+            entry = None
+        if entry is None:
+            session = self._get_session_from_db()
+            if session is not None:
+                entry = (session.session_data, session.expire_date)
+                self._remember(entry)
+        return entry, False
+
+    def load(self):
+        entry, local = self._get_entry() if self.session_key else (None, False)
+        if entry is None or entry[1] <= timezone.now():
+            self._session_key = None
+            self._expire_date = None
+            return {}
+        self._expire_date = entry[1]
+        data = self.decode(entry[0])
+        if not local:
+            self._remember_local(entry, data)
+        return data
+
+    def exists(self, session_key):
+        return (local_cache.get(session_key) is not None or self.cache_key_prefix + session_key in self._cache
+                or super().exists(session_key))
+
+    def needs_save(self) -> bool:
+        """
+        True when the data changed or the stored expiry has to slide
+        """
+        if self.modified:
+            return True
+        # the middleware saves the sessions that the request didn't read too
+        self._get_session()
+        if self._expire_date is None:
+            return True
+        threshold = getattr(settings, 'SESSION_REFRESH_THRESHOLD', 300)
+        remaining = self._expire_date - timezone.now()
+        return remaining < timedelta(seconds=self.get_expiry_age() - threshold)
+
+    def create_model_instance(self, data):
+        instance = super().create_model_instance(data)
+        self._entry = (instance.session_data, instance.expire_date)
+        return instance
+
+    def save(self, must_create=False):
+        if not must_create and self.session_key is not None and not self.needs_save():
+            return
+        super().save(must_create=must_create)
+        self._expire_date = self._entry[1]
+        self._remember(self._entry)
+        # e.g. the anonymous copy of a session that is authenticated now
+        local_cache.delete(self.session_key)
+        self._remember_local(self._entry, self._session)
+
+    def delete(self, session_key=None):
+        super().delete(session_key)
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        self._cache.delete(self.cache_key_prefix + session_key)
+        local_cache.delete(session_key)
+
+    def flush(self):
+        self.clear()
+        self.delete(self.session_key)
+        self._session_key = None
+        self._expire_date = None
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+from django import template
+
+from base import js_catalog
+
+register = template.Library()
+
+
+@register.simple_tag
+def js_catalog_url(language=None):
+    """
+    <script src="{% js_catalog_url %}"></script>, see base.js_catalog
+    """
+    return js_catalog.url(language)
@@ -1,3 +1,455 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from functools import partial
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import call_command
+from django.db import connection
+from django.db.backends.sqlite3 import base as sqlite3
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone, translation
+from django.utils.cache import patch_vary_headers
+
+from agencyGiuseppi import metrics
+from base import js_catalog
+from base.admin import EstimatedCountPaginator
+from base.page_cache import cache_anonymous_page, invalidate, page_cache
+from logger import Logger, QueueJsonHandler
+from base.db.pool import ConnectionPool, OVERFLOW, ERROR, PoolExhausted, PooledDatabaseWrapperMixin
+
+
+class StandInConnection:
+    def __init__(self):
+        self.alive = True
+        self.closed = False
+        self.rollbacks = 0
+
+    def close(self):
+        self.closed = True
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def ping(connection):
+    if not connection.alive:
+        raise ConnectionError("dead")
+
+
+class PooledSqliteWrapper(PooledDatabaseWrapperMixin, sqlite3.DatabaseWrapper):
+    pass
+
+
+class ConnectionPoolTestCase(SimpleTestCase):
+
+    def test_reuse_and_health_check(self):
+        pool = ConnectionPool(StandInConnection, ping, size=2)
+        first = pool.acquire()
+        pool.release(first)
+        self.assertIs(pool.acquire(), first, "the idle connection must be reused")
+        self.assertEqual(first.rollbacks, 1, "the transaction must be rolled back on release")
+        first.alive = False
+        pool.release(first)
+        second = pool.acquire()
+        self.assertIsNot(second, first)
+        self.assertTrue(first.closed)
+        stats = pool.stats()
+        self.assertEqual((stats['created'], stats['ping_failures'], stats['open'], stats['in_use']), (2, 1, 1, 1))
+
+    def test_max_lifetime(self):
+        pool = ConnectionPool(StandInConnection, ping, size=1, max_lifetime=0)
+        first = pool.acquire()
+        pool.release(first)
+        self.assertTrue(first.closed, "an old connection must be recycled")
+        self.assertIsNot(pool.acquire(), first)
+        self.assertEqual(pool.stats()['recycled'], 1)
+
+    def test_exhausted(self):
+        pool = ConnectionPool(StandInConnection, ping, size=1, timeout=0.05)
+        first = pool.acquire()
+        with self.assertRaises(PoolExhausted):
+            pool.acquire()
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+        threading.Timer(0.05, pool.release, [first]).start()
+        pool.timeout = 5
+        self.assertIs(pool.acquire(), first, "the waiting thread must get the released connection")
+        stats = pool.stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertGreater(stats['max_wait'], 0)
+
+        pool.exhausted = ERROR
+        with self.assertRaises(PoolExhausted):
+            pool.acquire()
+
+        pool.exhausted = OVERFLOW
+        overflow = pool.acquire()
+        pool.release(overflow)
+        self.assertTrue(overflow.closed, "an overflow connection must be closed on release")
+        self.assertEqual(pool.stats()['open'], 1)
+
+    def test_database_wrapper(self):
+        handle, name = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        self.addCleanup(os.remove, name)
+        settings_dict = {
+            'ENGINE': 'django.db.backends.sqlite3', 'NAME': name, 'POOL': {'SIZE': 1}, 'ATOMIC_REQUESTS': False,
+            'AUTOCOMMIT': True, 'CONN_MAX_AGE': 0, 'OPTIONS': {}, 'TIME_ZONE': None, 'TEST': {},
+            'USER': '', 'PASSWORD': '', 'HOST': '', 'PORT': '',
+        }
+        wrapper = PooledSqliteWrapper(settings_dict, alias='pool_test')
+        wrapper.ensure_connection()
+        connection = wrapper.connection
+        wrapper.close()
+        other = PooledSqliteWrapper(settings_dict, alias='pool_test')
+        with other.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        self.assertIs(other.connection, connection, "the connection must be reused by another wrapper")
+        other.close()
+        other.pool.close_idle()
+        self.assertEqual(other.pool.stats()['open'], 0)
+
+
+class LoggerTestCase(SimpleTestCase):
+
+    def setUp(self) -> None:
+        self.stream = io.StringIO()
+        self.handler = QueueJsonHandler(self.stream, queue_size=10, batch_size=3, flush_interval=0.01)
+        self.addCleanup(self.handler.close)
+        log_lib = logging.getLogger('tests.logger')
+        log_lib.propagate = False
+        log_lib.setLevel(logging.INFO)
+        log_lib.addHandler(self.handler)
+        self.addCleanup(log_lib.removeHandler, self.handler)
+        self.log = Logger(log_lib)
+
+    def lines(self) -> list:
+        self.handler.flush()
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_json_lines(self):
+        self.log.info("hit %s", 7, hit=7)
+        try:
+            raise ValueError("wrong status")
+        except ValueError as exception:
+            self.log.error(exception)
+        self.log.error("plain message")
+        self.log.error(KeyError('hit'), is_message=True)
+        info, error, message, described = self.lines()
+        self.assertEqual((info['level'], info['message'], info['hit']), ('INFO', 'hit 7', 7))
+        self.assertEqual((error['exc_type'], error['exc_message']), ('ValueError', 'wrong status'))
+        self.assertIn('raise ValueError', error['traceback'])
+        self.assertEqual(message['message'], 'plain message')
+        self.assertNotIn('exc_type', message)
+        self.assertEqual(described['message'], "Exception: KeyError Exception message: 'hit'")
+
+    def test_format_in_caller(self):
+        hit = {'status': 'open'}
+        self.log.info("hit %s", hit)
+        hit['status'] = 'closed'
+        self.assertEqual(self.lines()[0]['message'], "hit {'status': 'open'}")
+
+    def test_settings_handler(self):
+        log_lib = logging.getLogger('logger')
+        self.assertTrue(log_lib.propagate)
+        self.assertTrue(any(isinstance(handler, QueueJsonHandler) for handler in log_lib.handlers))
+
+    def test_drop_when_full(self):
+        blocked = threading.Event()
+        release = threading.Event()
+        write = self.stream.write
+
+        def slow_write(data):
+            blocked.set()
+            release.wait(5)
+            return write(data)
+        self.stream.write = slow_write
+        self.log.info("first")
+        blocked.wait(5)
+        for index in range(20):
+            self.log.info("message %s", index)
+        self.assertEqual(self.handler.dropped, 10, "the queue must keep at most 10 records")
+        release.set()
+        self.assertEqual(len(self.lines()), 11)
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self) -> None:
+        metrics.registry.reset()
+
+    def test_request_metrics(self):
+        self.client.get('/api/hits/')
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('http_requests_total{view="hit-list",method="GET",status="403"} 1', body)
+        self.assertIn('http_request_duration_seconds_count{view="hit-list"} 1', body)
+        self.assertIn('http_request_db_queries_bucket{view="hit-list",le="+Inf"} 1', body)
+        self.assertIn('# TYPE http_response_size_bytes histogram', body)
+
+    async def test_async_request_metrics(self):
+        response = await self.async_client.get('/api/hits/')
+        self.assertEqual(response.status_code, 403)
+        body = metrics.render(metrics.collect())
+        self.assertIn('http_requests_total{view="hit-list",method="GET",status="403"} 1', body)
+
+    def test_hybrid(self):
+        async def get_response(request):
+            return HttpResponse()
+        self.assertTrue(asyncio.iscoroutinefunction(metrics.MetricsMiddleware(get_response)))
+        self.assertFalse(asyncio.iscoroutinefunction(metrics.MetricsMiddleware(lambda request: HttpResponse())))
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_access(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 403)
+        response = self.client.get('/metrics', REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get('/metrics', REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+    def test_query_meter(self):
+        from django.db import connection
+        meter = metrics.QueryMeter()
+        with connection.execute_wrapper(meter):
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+                cursor.execute('SELECT 2')
+        self.assertEqual(meter.count, 2)
+
+    def test_multiprocess(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        labels = [['view', 'index']]
+        with open(os.path.join(directory, 'metrics_999999999.json'), 'w') as stream:
+            json.dump({
+                'http_request_db_queries': [[labels, [0, 1, 0, 0, 0, 0, 0, 0, 1, 1]]],
+                'db_pool_open': [[[['alias', 'default']], [3]]],
+            }, stream)
+        with override_settings(METRICS_MULTIPROCESS_DIR=directory):
+            metrics.registry.observe('http_request_db_queries', (('view', 'index'),), 4)
+            values = metrics.collect()
+        self.assertEqual(values['http_request_db_queries'][(('view', 'index'),)], [0, 1, 0, 1, 0, 0, 0, 0, 5, 2])
+        self.assertNotIn('db_pool_open', values, "the gauges of a dead process must be ignored")
+        self.assertTrue(os.path.exists(os.path.join(directory, 'metrics_{}.json'.format(os.getpid()))))
+
+
+class EstimatedCountPaginatorTestCase(TestCase):
+
+    def test_estimate(self):
+        from hit.models import Hit
+        Hit.objects.bulk_create([Hit(target_name="Target", description="Test") for _ in range(10)])
+        Hit.objects.filter(id__lte=5).delete()
+        with mock.patch('base.admin.ESTIMATE_THRESHOLD', 5):
+            self.assertEqual(EstimatedCountPaginator(Hit.objects.order_by('id'), 2).count, 10,
+                             "the table without filters must be estimated")
+            self.assertEqual(EstimatedCountPaginator(Hit.objects.filter(id__gt=7).order_by('id'), 2).count, 3)
+            with mock.patch('base.admin.COUNT_LIMIT', 2):
+                self.assertEqual(EstimatedCountPaginator(Hit.objects.filter(id__gt=7).order_by('id'), 2).count, 2,
+                                 "a filtered list must be counted up to the limit")
+        self.assertEqual(EstimatedCountPaginator(Hit.objects.order_by('id'), 2).count, 5, "a small table is counted")
+
+
+class SessionStoreTestCase(TestCase):
+
+    def setUp(self) -> None:
+        from base.sessions import local_cache
+        local_cache.clear()
+        self.addCleanup(local_cache.clear)
+        self.user = get_user_model().objects.create_user('session', email='session@example.com', password=None)
+
+    def writes(self, requests) -> int:
+        from django.db import connection
+        url = reverse('javascript-catalog')
+        statements = []
+
+        def count(execute, sql, params, many, context):
+            if 'django_session' in sql and not sql.startswith('SELECT'):
+                statements.append(sql)
+            return execute(sql, params, many, context)
+        with connection.execute_wrapper(count):
+            for _ in range(requests):
+                self.assertEqual(self.client.get(url).status_code, 200)
+        return len(statements)
+
+    def test_writes_per_1k_requests(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.writes(1000), 0, "a session without changes must not be written")
+        with override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db'):
+            # the middleware reads the engine when it's loaded
+            self.client = self.client_class()
+            self.client.force_login(self.user)
+            self.assertEqual(self.writes(100), 100)
+
+    def test_sliding_expiry(self):
+        from django.contrib.sessions.models import Session
+        self.client.force_login(self.user)
+        key = self.client.session.session_key
+        expire_date = Session.objects.get(pk=key).expire_date
+        self.assertEqual(self.writes(1), 0)
+        later = timezone.now() + timedelta(seconds=settings.SESSION_REFRESH_THRESHOLD + 1)
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            self.assertEqual(self.writes(1), 1, "the expiry must slide after the threshold")
+            self.assertEqual(self.writes(1), 0)
+        self.assertGreater(Session.objects.get(pk=key).expire_date, expire_date)
+
+    def test_changes_and_logout(self):
+        from base.sessions import SessionStore
+        self.client.force_login(self.user)
+        session = self.client.session
+        session['language'] = 'es'
+        session.save()
+        self.assertEqual(SessionStore(session.session_key)['language'], 'es')
+        self.client.logout()
+        self.assertFalse(SessionStore().exists(session.session_key))
+        self.assertNotIn('_auth_user_id', SessionStore(session.session_key).load())
+
+    def test_logout_in_other_process(self):
+        from base import sessions
+        from base.lru import LRUCache
+        self.client.force_login(self.user)
+        key = self.client.session.session_key
+        other = LRUCache(100, 60)
+        # another process reads the session, the shared cache is the same
+        with mock.patch.object(sessions, 'local_cache', other):
+            self.assertIn('_auth_user_id', sessions.SessionStore(key).load())
+        self.assertIsNone(other.get(key), "an authenticated session must not be kept in the process")
+        self.client.logout()
+        with mock.patch.object(sessions, 'local_cache', other):
+            self.assertNotIn('_auth_user_id', sessions.SessionStore(key).load())
+
+    def test_anonymous_local_copy(self):
+        from base.sessions import SessionStore, local_cache
+        session = SessionStore()
+        session['language'] = 'es'
+        session.save()
+        self.assertIsNotNone(local_cache.get(session.session_key))
+        self.assertEqual(SessionStore(session.session_key)['language'], 'es')
+
+
+class PageCacheTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.renders = 0
+        self.factory = RequestFactory()
+        page_cache.invalidate()
+        self.addCleanup(page_cache.invalidate)
+
+    def view(self, request, cookie=False, delay=0):
+        self.renders += 1
+        time.sleep(delay)
+        response = HttpResponse("page {}".format(self.renders))
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if cookie:
+            response.set_cookie('tracking', '1')
+        return response
+
+    def get(self, view, path='/en-us/', user=None, **headers):
+        request = self.factory.get(path, **headers)
+        request.user = user or AnonymousUser()
+        return view(request)
+
+    def test_key(self):
+        view = cache_anonymous_page(self.view)
+        self.assertEqual(self.get(view).content, b"page 1")
+        self.assertEqual(self.get(view).content, b"page 1", "the page must be cached")
+        self.assertEqual(self.get(view, HTTP_ACCEPT_ENCODING='gzip').content, b"page 2", "Vary")
+        self.assertEqual(self.get(view, '/es/').content, b"page 3", "language prefix")
+        with translation.override('es'):
+            self.assertEqual(self.get(view).content, b"page 4", "language")
+        user = get_user_model().objects.create_user('page', email='page@example.com', password=None)
+        self.assertEqual(self.get(view, user=user).content, b"page 5", "an authenticated user is never cached")
+        invalidate()
+        self.assertEqual(self.get(view).content, b"page 6")
+
+    def test_cookies(self):
+        view = cache_anonymous_page(partial(self.view, cookie=True))
+        self.get(view)
+        self.get(view)
+        self.assertEqual(self.renders, 2, "a response that sets cookies must not be cached")
+
+    def test_single_flight(self):
+        view = cache_anonymous_page(partial(self.view, delay=0.2))
+        responses = []
+        threads = [threading.Thread(target=lambda: responses.append(self.get(view))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.renders, 1, "the page must be rendered once")
+        self.assertEqual({response.content for response in responses}, {b"page 1"})
+
+    def test_shared_cache(self):
+        caches = {
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'pages': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'pages'},
+        }
+        with override_settings(CACHES=caches, PAGE_CACHE_ALIAS='pages'):
+            view = cache_anonymous_page(self.view)
+            self.get(view)
+            page_cache.local.clear()
+            self.assertEqual(self.get(view).content, b"page 1", "the page must be read from the shared cache")
+            invalidate()
+            self.assertEqual(self.get(view).content, b"page 2")
+
+
+class JsCatalogTestCase(SimpleTestCase):
+
+    def setUp(self) -> None:
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        override = override_settings(JS_CATALOG_ROOT=self.root, JS_CATALOG_URL='/static/jsi18n/')
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_compile(self):
+        self.assertEqual(js_catalog.url('es'), '/es/jsi18n/', "the dynamic view is the fallback")
+        call_command('compile_js_catalogs', language=['en', 'es'], stdout=io.StringIO())
+        files = js_catalog.manifest()
+        self.assertEqual(set(files), {'en', 'es'})
+        with open(os.path.join(self.root, files['es']), 'rb') as stream:
+            self.assertEqual(stream.read(), js_catalog.render('es'))
+        self.assertRegex(files['es'], r'^es\.[0-9a-f]{12}\.js$')
+
+        # a language keeps the others and the same content keeps the same name
+        self.assertEqual(js_catalog.compile_catalogs(['es'], self.root), files)
+        template = Template('{% load js_catalog %}{% js_catalog_url %}')
+        with translation.override('es'):
+            self.assertEqual(template.render(Context()), '/static/jsi18n/' + files['es'])
+        with translation.override('en-us'):
+            self.assertEqual(template.render(Context()), '/static/jsi18n/' + files['en'])
+
+
+class BenchmarkCommandTestCase(TransactionTestCase):
+    """
+    Smoke test, the command runs in the test database instead of creating its own one
+    """
+
+    # the ALLOWED_HOSTS of settings, not the testserver added by the test runner
+    @override_settings(ALLOWED_HOSTS=['localhost'])
+    @mock.patch('base.management.commands.benchmark.VIEW_REQUESTS', 4)
+    @mock.patch('base.management.commands.benchmark.SESSION_REQUESTS', 4)
+    def test_benchmark(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        output = os.path.join(root, 'benchmark.json')
+        with mock.patch.object(connection.creation, 'create_test_db'), \
+                mock.patch.object(connection.creation, 'destroy_test_db'):
+            call_command('benchmark', users=3, hits=10, iterations=2, output=output, stdout=io.StringIO())
+        with open(output) as stream:
+            results = json.load(stream)['results']
+        self.assertEqual(results['hit.search']['operations'], 2)
+        self.assertEqual(results['view.hits_asgi']['operations'], 4)
 
-# Create your tests here.
@@ -1,3 +1,69 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
+from django.utils.translation import ugettext_lazy as _
+
+from base.admin import EstimatedCountPaginator
+from hit.models import COMPLETED, FAILED, Hit
 
 # Register your models here.
+
+
+class HitActionForm(ActionForm):
+    assigned_to = forms.IntegerField(label=_("User id"), required=False)
+
+
+@admin.register(Hit)
+class HitAdmin(admin.ModelAdmin):
+    """
+    Changelist with a fixed number of queries: the users in the same query than the
+    hits, an estimated count, filters over indexed columns and set based actions.
+    """
+    list_display = ('id', 'target_name', 'status', 'assigned_to', 'created_by', 'created_at')
+    list_select_related = ('assigned_to', 'created_by')
+    list_filter = ('status',)
+    search_fields = ('target_name',)
+    ordering = ('-created_at',)
+    raw_id_fields = ('assigned_to', 'created_by')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    action_form = HitActionForm
+    actions = ('assign', 'fail', 'complete')
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        # the creator of an old hit can be a deleted user, the assignee must be active (see Hit.save)
+        if db_field.name == 'created_by':
+            kwargs['queryset'] = db_field.related_model.objects.all_with_deleted()
+        return super(HitAdmin, self).formfield_for_foreignkey(db_field, request, **kwargs)
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Full text search, see HitQuerySet.search, in the same query than the filters of
+        the list, the ordering of the list goes before the rank
+        """
+        if not search_term:
+            return queryset, False
+        return queryset.search(search_term), False
+
+    @admin.action(description=_("Assign the selected hits to the user id"))
+    def assign(self, request, queryset):
+        user_id = request.POST.get('assigned_to', '')
+        if not user_id.isdigit():
+            self.message_user(request, _("Write the id of the user"), messages.ERROR)
+            return
+        results = Hit.objects.bulk_assign({hit_id: int(user_id) for hit_id in queryset.values_list('id', flat=True)})
+        errors = {message for message in results.values() if message}
+        assigned = sum(1 for message in results.values() if message is None)
+        self.message_user(request, _("%(count)d hits assigned") % {'count': assigned}, messages.SUCCESS)
+        for error in errors:
+            self.message_user(request, error, messages.WARNING)
+
+    @admin.action(description=_("Mark the selected hits as failed"))
+    def fail(self, request, queryset):
+        changed = queryset.transition(FAILED)
+        self.message_user(request, _("%(count)d hits failed") % {'count': changed}, messages.SUCCESS)
+
+    @admin.action(description=_("Mark the selected hits as completed"))
+    def complete(self, request, queryset):
+        changed = queryset.transition(COMPLETED)
+        self.message_user(request, _("%(count)d hits completed") % {'count': changed}, messages.SUCCESS)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+"""
+History of the hits, see HitEvent.
+
+The changes record their events here and they are inserted after the commit of the
+transaction, all the events of a transaction with a single bulk INSERT, so a change
+doesn't pay a round trip for its history. Every record is an on_commit callback that
+Django discards with the rollback of its transaction (or savepoint), the surviving ones
+add their events to the batch of the connection. Every record also adds a callback at
+the outermost level, never discarded, and the one of the last record inserts the batch.
+The set based changes (see HitQuerySet.release) insert their events with one INSERT ...
+SELECT in the transaction instead, see record_query.
+
+The actor of the events is the user of the request (ActorMiddleware) or the user of
+acting_as, e.g. in a management command.
+"""
+import asyncio
+import contextvars
+import itertools
+import threading
+from contextlib import contextmanager
+from functools import partial
+
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from django.db.models import Value
+from django.utils import timezone
+
+# function that returns the id of the user doing the changes or None
+_actor = contextvars.ContextVar('hit_event_actor', default=None)
+# events of the committed records by database alias, the connections are per thread too
+_batches = threading.local()
+_tokens = itertools.count()
+BATCH_SIZE = 1000
+
+
+def actor_id():
+    get_actor = _actor.get()
+    return get_actor() if get_actor is not None else None
+
+
+@contextmanager
+def acting_as(user):
+    token = _actor.set(lambda: user.pk if user is not None else None)
+    try:
+        yield
+    finally:
+        _actor.reset(token)
+
+
+class ActorMiddleware:
+    """
+    The user of the request is the actor of its events, read only if there are events
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # the handler awaits the middleware, like MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    @staticmethod
+    def get_actor(request):
+        def get_actor():
+            user = getattr(request, 'user', None)
+            return user.pk if user is not None and user.is_authenticated else None
+        return get_actor
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        token = _actor.set(self.get_actor(request))
+        try:
+            return self.get_response(request)
+        finally:
+            _actor.reset(token)
+
+    async def __acall__(self, request):
+        token = _actor.set(self.get_actor(request))
+        try:
+            return await self.get_response(request)
+        finally:
+            _actor.reset(token)
+
+
+def _batch(using) -> dict:
+    if not hasattr(_batches, 'pending'):
+        _batches.pending = {}
+        _batches.last = {}
+    return _batches.pending.setdefault(using, [])
+
+
+def _keep(using, events) -> None:
+    _batch(using).extend(events)
+
+
+def _flush(using, token) -> None:
+    # import here, the model module imports this one
+    from hit.models import HitEvent
+
+    if token != _batches.last.get(using):
+        return
+    pending = _batch(using)
+    events, pending[:] = list(pending), []
+    if events:
+        HitEvent.objects.using(using).bulk_create(events, batch_size=BATCH_SIZE)
+
+
+def record(changes, using=DEFAULT_DB_ALIAS) -> None:
+    """
+    Insert the events of the changes after the commit of their transaction
+    :param changes: (hit_id, from_status or None for a new hit, to_status, assigned_to_id)
+    """
+    from hit.models import HitEvent
+
+    now = timezone.now()
+    actor = actor_id()
+    events = [
+        HitEvent(hit_id=hit_id, from_status=from_status, to_status=to_status,
+                 assigned_to_id=assigned_to_id, actor_id=actor, created_at=now)
+        for hit_id, from_status, to_status, assigned_to_id in changes
+    ]
+    if not events:
+        return
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        HitEvent.objects.using(using).bulk_create(events, batch_size=BATCH_SIZE)
+        return
+    _batch(using)
+    token = _batches.last[using] = next(_tokens)
+    transaction.on_commit(partial(_keep, using, events), using=using)
+    # on_commit at the outermost level (no savepoint ids), after the callback above:
+    # a rolled back savepoint can't discard the insert of the batch
+    connection.run_on_commit.append((set(), partial(_flush, using, token)))
+
+
+def record_query(hits, from_status, to_status, assigned_to_id, using=DEFAULT_DB_ALIAS) -> int:
+    """
+    Insert the same change for every hit of a queryset with one INSERT ... SELECT, call
+    it before the UPDATE that moves the hits out of the queryset
+    :param hits: queryset of the hits
+    :return int: number of events
+    """
+    from hit.models import HitEvent
+
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    select = hits.using(using).order_by().values_list(
+        'id',
+        Value(from_status, output_field=models.PositiveSmallIntegerField()),
+        Value(to_status, output_field=models.PositiveSmallIntegerField()),
+        Value(assigned_to_id, output_field=models.BigIntegerField()),
+        Value(actor_id(), output_field=models.BigIntegerField()),
+        Value(timezone.now(), output_field=models.DateTimeField()),
+    )
+    sql, params = select.query.get_compiler(using).as_sql()
+    columns = ', '.join(
+        quote_name(HitEvent._meta.get_field(name).column)
+        for name in ('hit', 'from_status', 'to_status', 'assigned_to', 'actor', 'created_at')
+    )
+    with connection.cursor() as cursor:
+        cursor.execute('INSERT INTO {} ({}) {}'.format(quote_name(HitEvent._meta.db_table), columns, sql), params)
+        return cursor.rowcount
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+from django.core.management.base import BaseCommand, CommandError
+
+from hit.models import HitStat
+
+
+class Command(BaseCommand):
+    help = "Verify the HitStat counters against the hit table, or rebuild them from scratch"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help="delete the counters and calculate them again")
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            self.stdout.write("{} counters rebuilt".format(HitStat.objects.rebuild()))
+        errors = HitStat.objects.verify()
+        for (assignee, status, day), (stored, real) in sorted(errors.items()):
+            self.stdout.write("assignee {} status {} day {}: {} instead of {}".format(
+                assignee, status, day, stored, real))
+        if errors:
+            raise CommandError("{} wrong counters, run it with --rebuild".format(len(errors)))
+        self.stdout.write(self.style.SUCCESS("The counters are right"))
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from hit.models import HitEvent
+
+
+class Command(BaseCommand):
+    help = "Delete the hit history older than a number of days, in chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365, help="keep the events of the last days")
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        deleted = HitEvent.objects.prune(before, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS("{} events before {} deleted".format(deleted, before)))
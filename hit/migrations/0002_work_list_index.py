@@ -0,0 +1,21 @@
+# Generated by Django 3.2.3 on 2026-10-18 15:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hit', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='hit',
+            index=models.Index(fields=['assigned_to', 'status', '-created_at'], name='hit_hit_assigne_114b9c_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='hit',
+            name='hit_hit_assigne_a65921_idx',
+        ),
+    ]
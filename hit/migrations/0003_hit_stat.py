@@ -0,0 +1,35 @@
+# Generated by Django 3.2.3 on 2026-10-18 15:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hit', '0002_work_list_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HitStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('assignee', models.BigIntegerField(default=0, verbose_name='Assigned to')),
+                ('status', models.PositiveSmallIntegerField(choices=[(1, 'Unassigned'), (2, 'Assigned'), (3, 'Failed'), (4, 'Completed')], verbose_name='Status')),
+                ('day', models.DateField(verbose_name='Day')),
+                ('count', models.IntegerField(default=0, verbose_name='Count')),
+            ],
+            options={
+                'verbose_name': 'hit statistic',
+                'verbose_name_plural': 'hit statistics',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='hitstat',
+            index=models.Index(fields=['day'], name='hit_hitstat_day_4c43d6_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='hitstat',
+            constraint=models.UniqueConstraint(fields=('assignee', 'status', 'day'), name='hit_stat_unique'),
+        ),
+    ]
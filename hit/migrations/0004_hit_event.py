@@ -0,0 +1,49 @@
+# Generated by Django 3.2.3 on 2026-10-18 15:46
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('hit', '0003_hit_stat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HitEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_status', models.PositiveSmallIntegerField(choices=[(1, 'Unassigned'), (2, 'Assigned'), (3, 'Failed'), (4, 'Completed')], null=True, verbose_name='From status')),
+                ('to_status', models.PositiveSmallIntegerField(choices=[(1, 'Unassigned'), (2, 'Assigned'), (3, 'Failed'), (4, 'Completed')], verbose_name='To status')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Created at')),
+                ('actor', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Changed by')),
+                ('assigned_to', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Assigned to')),
+                ('hit', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='events', to='hit.hit', verbose_name='Hit')),
+            ],
+            options={
+                'verbose_name': 'hit event',
+                'verbose_name_plural': 'hit events',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='hitevent',
+            index=models.Index(fields=['hit', 'created_at'], name='hit_hiteven_hit_id_f7099b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='hitevent',
+            index=models.Index(fields=['actor', 'created_at'], name='hit_hiteven_actor_i_e25be8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='hitevent',
+            index=models.Index(fields=['assigned_to', 'created_at'], name='hit_hiteven_assigne_534697_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='hitevent',
+            index=models.Index(fields=['created_at'], name='hit_hiteven_created_b7f9b2_idx'),
+        ),
+    ]
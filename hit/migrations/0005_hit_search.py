@@ -0,0 +1,48 @@
+from django.db import migrations
+
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE hit_search USING fts5(target_name, description, content='hit_hit', "
+    "content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER hit_search_insert AFTER INSERT ON hit_hit BEGIN "
+    "INSERT INTO hit_search(rowid, target_name, description) VALUES (new.id, new.target_name, new.description); END",
+    "CREATE TRIGGER hit_search_delete AFTER DELETE ON hit_hit BEGIN "
+    "INSERT INTO hit_search(hit_search, rowid, target_name, description) "
+    "VALUES ('delete', old.id, old.target_name, old.description); END",
+    "CREATE TRIGGER hit_search_update AFTER UPDATE OF target_name, description ON hit_hit BEGIN "
+    "INSERT INTO hit_search(hit_search, rowid, target_name, description) "
+    "VALUES ('delete', old.id, old.target_name, old.description); "
+    "INSERT INTO hit_search(rowid, target_name, description) VALUES (new.id, new.target_name, new.description); END",
+    "INSERT INTO hit_search(hit_search) VALUES ('rebuild')",
+]
+SQLITE_BACKWARD = [
+    "DROP TRIGGER hit_search_update",
+    "DROP TRIGGER hit_search_delete",
+    "DROP TRIGGER hit_search_insert",
+    "DROP TABLE hit_search",
+]
+MYSQL_FORWARD = ["CREATE FULLTEXT INDEX hit_hit_search ON hit_hit (target_name, description)"]
+MYSQL_BACKWARD = ["DROP INDEX hit_hit_search ON hit_hit"]
+
+
+def run(statements):
+    """
+    The search index of the vendor, see hit.search
+    """
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hit', '0004_hit_event'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'mysql': MYSQL_FORWARD}),
+            run({'sqlite': SQLITE_BACKWARD, 'mysql': MYSQL_BACKWARD}),
+        ),
+    ]
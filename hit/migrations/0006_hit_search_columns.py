@@ -0,0 +1,32 @@
+from django.db import migrations
+
+MYSQL_FORWARD = [
+    "CREATE FULLTEXT INDEX hit_hit_search_target_name ON hit_hit (target_name)",
+    "CREATE FULLTEXT INDEX hit_hit_search_description ON hit_hit (description)",
+]
+MYSQL_BACKWARD = [
+    "DROP INDEX hit_hit_search_description ON hit_hit",
+    "DROP INDEX hit_hit_search_target_name ON hit_hit",
+]
+
+
+def run(statements):
+    """
+    The FULLTEXT indexes of the weighted rank of MySQL, see hit.search
+    """
+    def operation(apps, schema_editor):
+        if schema_editor.connection.vendor == 'mysql':
+            for statement in statements:
+                schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hit', '0005_hit_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(run(MYSQL_FORWARD), run(MYSQL_BACKWARD)),
+    ]
@@ -1,6 +1,13 @@
-from django.db import models, transaction
+from collections import Counter
+
+from django.db import connections, models, router, transaction
+from django.db.models import DEFERRED, Count, F, Sum
+from django.db.models.functions import TruncDate
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
+from agencyGiuseppi.db_router import write_db
+from hit import events, search, work_list
 
 # use numbers for performance reasons in queries
 UNASSIGNED = 1
@@ -14,6 +21,196 @@ STATES = (
     (FAILED, _("Failed")),
     (COMPLETED, _("Completed"))
 )
+# a hit in one of these states is closed forever
+FINAL_STATES = (FAILED, COMPLETED)
+
+FINAL_STATUS_ERROR = "A Hit in a end status can't be changed"
+BIG_BOSS_ERROR = "You can assign a hit to Big boss"
+INACTIVE_USER_ERROR = "You can't assign a hit to an inactive user"
+UNKNOWN_USER_ERROR = "The user doesn't exist"
+UNKNOWN_HIT_ERROR = "The hit doesn't exist"
+STALE_HIT_ERROR = "The hit was changed by another request, load it again"
+
+# counters of the unassigned hits in HitStat, a NULL would break the unique constraint
+NO_ASSIGNEE = 0
+
+
+def stat_day(created_at):
+    """
+    day of the HitStat counters of a hit, always in UTC
+    """
+    return created_at.astimezone(timezone.utc).date() if timezone.is_aware(created_at) else created_at.date()
+
+
+class HitQuerySet(models.QuerySet):
+
+    def transition(self, to) -> int:
+        """
+        Move every hit of the queryset to a new status with a single conditional UPDATE,
+        the hits in a final status are skipped by the WHERE clause instead of a previous read.
+        :param int to: new status, one of STATES
+        :return int: number of rows changed
+        """
+        using = write_db(self)
+        queryset = self.using(using)
+        with transaction.atomic(using=using):
+            # lock the rows to move their counters, FOR UPDATE is not allowed with a GROUP BY
+            deltas = Counter()
+            changes = []
+            for hit_id, assigned_to_id, status, created_at in queryset.exclude(status__in=FINAL_STATES).select_for_update(
+                    ).values_list('id', 'assigned_to_id', 'status', 'created_at').iterator():
+                deltas[(assigned_to_id, status, stat_day(created_at))] -= 1
+                deltas[(assigned_to_id, to, stat_day(created_at))] += 1
+                changes.append((hit_id, status, to, assigned_to_id))
+            changed = queryset._transition(to)
+            HitStat.objects.using(using).apply(deltas)
+            events.record(changes, using=using)
+        if changed:
+            # the users of the hits are unknown without a read
+            work_list.invalidate_all()
+        return changed
+
+    def release(self, users, replacement=None) -> int:
+        """
+        Move the ASSIGNED hits of the users back to UNASSIGNED, or to a replacement, set
+        based: after locking the rows one GROUP BY gives the HitStat deltas, one INSERT ...
+        SELECT writes the events and one UPDATE moves the hits, e.g. when the users are
+        deactivated.
+        :param users: ids or a queryset of users
+        :param CustomUser replacement: new assignee, None to leave the hits unassigned
+        :return int: number of hits moved
+        """
+        new_id = replacement.pk if replacement is not None else None
+        new_status = ASSIGNED if replacement is not None else UNASSIGNED
+        using = write_db(self)
+        queryset = self.using(using).filter(assigned_to__in=users, status=ASSIGNED)
+        with transaction.atomic(using=using):
+            # FOR UPDATE is not allowed with a GROUP BY, only the ids are read to lock the rows
+            for _ in queryset.select_for_update().values_list('id', flat=True).iterator():
+                pass
+            deltas = Counter()
+            for row in queryset.annotate(day=TruncDate('created_at', tzinfo=timezone.utc)).values(
+                    'assigned_to_id', 'day').annotate(total=Count('id')).order_by():
+                deltas[(row['assigned_to_id'], ASSIGNED, row['day'])] -= row['total']
+                deltas[(new_id, new_status, row['day'])] += row['total']
+            events.record_query(queryset, ASSIGNED, new_status, new_id, using=using)
+            changed = queryset.update(assigned_to_id=new_id, status=new_status, updated_at=timezone.now())
+            HitStat.objects.using(using).apply(deltas)
+            work_list.invalidate(new_id, *{key[0] for key in deltas})
+        return changed
+
+    def bulk_create(self, objs, *args, **kwargs):
+        """
+        Insert the hits and add them to the HitStat counters in the same transaction, no
+        HitEvent is recorded (the ids of the hits can be unknown). With ignore_conflicts
+        the skipped rows would be counted too, the hits have no unique field but the id.
+        """
+        using = write_db(self)
+        with transaction.atomic(using=using):
+            hits = super(HitQuerySet, self.using(using)).bulk_create(objs, *args, **kwargs)
+            HitStat.objects.using(using).apply(Counter(
+                (hit.assigned_to_id, hit.status, stat_day(hit.created_at)) for hit in hits))
+        return hits
+
+    def _transition(self, to) -> int:
+        if to not in dict(STATES):
+            raise ValidationError("Unknown hit status: {}".format(to))
+        return self.exclude(status__in=FINAL_STATES).update(status=to, updated_at=timezone.now())
+
+    def visible_to(self, user):
+        """
+        Hits of the Big boss: all of them, the others: the hits they created and the
+        hits assigned to them or to their subordinates.
+        """
+        if user.is_superuser:
+            return self
+        return self.filter(
+            models.Q(assigned_to=user) | models.Q(created_by=user) |
+            models.Q(assigned_to__path__startswith=user.subtree_path)
+        )
+
+    def search(self, query):
+        """
+        Hits with every word of the query in the target name or the description, see
+        hit.search. The queryset is annotated with the rank and ordered by it, the best
+        first, slice it for the limit and the pagination.
+        :param str query: words of the search
+        """
+        words = search.terms(query)
+        if not words:
+            return self.none()
+        return search.get_backend(self.db).search(self, words).order_by('-rank', '-id')
+
+    def assign_many(self, hits, user) -> dict:
+        """
+        Assign a batch of hits to the same user, see bulk_assign.
+        :param list hits: Hit instances or ids
+        :param CustomUser user: User instance
+        :return dict: {hit_id: None if it was assigned or the rejection message}
+        """
+        if not hasattr(user, 'is_active'):
+            raise ValidationError("user parameter must be an User instance")
+        return self.bulk_assign({getattr(hit, 'pk', hit): user.pk for hit in hits})
+
+    def bulk_assign(self, assignments) -> dict:
+        """
+        Assign many hits at once with set based validations, instead of a Hit.assign per hit:
+        one query validates all the users, one query locks the open hits and one
+        bulk UPDATE writes the assignments, all of them in the same transaction.
+        :param dict assignments: {hit_id: user_id}
+        :return dict: {hit_id: None if it was assigned or the rejection message}
+        """
+        user_model = self.model._meta.get_field('assigned_to').related_model
+        results = {}
+        using = write_db(self)
+        with transaction.atomic(using=using):
+            users = {
+                pk: (is_active, is_superuser)
+                for pk, is_active, is_superuser in user_model._base_manager.using(using).filter(
+                    id__in=set(assignments.values())).values_list('id', 'is_active', 'is_superuser')
+            }
+            hits = {
+                pk: (status, assigned_to_id, created_at)
+                for pk, status, assigned_to_id, created_at in self.using(using).select_for_update().filter(
+                    id__in=assignments).values_list('id', 'status', 'assigned_to_id', 'created_at')
+            }
+            now = timezone.now()
+            to_update = {}
+            for hit_id, user_id in assignments.items():
+                if hit_id not in hits:
+                    results[hit_id] = UNKNOWN_HIT_ERROR
+                elif hits[hit_id][0] in FINAL_STATES:
+                    results[hit_id] = FINAL_STATUS_ERROR
+                elif user_id not in users:
+                    results[hit_id] = UNKNOWN_USER_ERROR
+                elif users[user_id][1]:
+                    results[hit_id] = BIG_BOSS_ERROR
+                elif not users[user_id][0]:
+                    results[hit_id] = INACTIVE_USER_ERROR
+                else:
+                    results[hit_id] = None
+                    to_update[hit_id] = user_id
+            base_qs = self.model._base_manager.using(using)
+            if len(set(to_update.values())) == 1:
+                base_qs.filter(id__in=to_update).update(
+                    assigned_to_id=next(iter(to_update.values())), status=ASSIGNED, updated_at=now)
+            elif to_update:
+                base_qs.bulk_update([
+                    self.model(id=hit_id, assigned_to_id=user_id, status=ASSIGNED, updated_at=now)
+                    for hit_id, user_id in to_update.items()
+                ], ['assigned_to', 'status', 'updated_at'])
+            deltas = Counter()
+            for hit_id, user_id in to_update.items():
+                status, assigned_to_id, created_at = hits[hit_id]
+                deltas[(assigned_to_id, status, stat_day(created_at))] -= 1
+                deltas[(user_id, ASSIGNED, stat_day(created_at))] += 1
+            HitStat.objects.using(using).apply(deltas)
+            events.record(
+                [(hit_id, hits[hit_id][0], ASSIGNED, user_id) for hit_id, user_id in to_update.items()],
+                using=using
+            )
+            work_list.invalidate(*to_update.values(), *(hits[hit_id][1] for hit_id in to_update))
+        return results
 
 
 # Create your models here.
@@ -48,6 +245,7 @@ class Hit(models.Model):
         editable=False,
         auto_now=True
     )
+    objects = HitQuerySet.as_manager()
 
     class Meta:
         verbose_name = _("hit")
@@ -55,12 +253,12 @@ class Hit(models.Model):
         indexes = [
             models.Index(fields=['status']),
             models.Index(fields=['created_by']),
-            models.Index(fields=['assigned_to']),
+            # the upcoming work of a hitman, see hit.work_list
+            models.Index(fields=['assigned_to', 'status', '-created_at']),
             models.Index(fields=['-created_at']),
             models.Index(fields=['-updated_at']),
         ]
 
-
     def assign(self, user) -> None:
         # Check if is an user instance without the isinstance to prevent the importation
         if not hasattr(user, 'is_active'):
@@ -69,14 +267,328 @@ class Hit(models.Model):
         self.status = ASSIGNED
         return self.save()
 
-    def save(self, *args, **kwargs) -> None:
-        with transaction.atomic():
+    def transition(self, to) -> int:
+        """
+        Change only the status of the hit, it costs one UPDATE and no read: the WHERE
+        clause checks the status and assignee loaded in this instance, so the counters
+        and the history move from them.
+        :param int to: new status, one of STATES
+        :raise ValidationError: the hit is in a final status, doesn't exist or was changed
+            by another request since it was loaded
+        :return int: number of rows changed
+        """
+        using = router.db_for_write(Hit, instance=self)
+        with transaction.atomic(using=using):
+            loaded = self._stored(using)
+            if loaded is None or loaded[1] in FINAL_STATES:
+                raise ValidationError(FINAL_STATUS_ERROR)
+            assigned_to_id, status = loaded
+            changed = Hit.objects.using(using).filter(
+                id=self.id, assigned_to_id=assigned_to_id, status=status)._transition(to)
+            if not changed:
+                raise ValidationError(STALE_HIT_ERROR)
+            HitStat.objects.using(using).move(self.created_at, loaded, (assigned_to_id, to))
+            events.record([(self.id, status, to, assigned_to_id)], using=using)
+        self.status = to
+        self._loaded = (assigned_to_id, to)
+        work_list.invalidate(assigned_to_id)
+        return changed
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Hit, cls).from_db(db, field_names, values)
+        instance._loaded = instance._snapshot()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super(Hit, self).refresh_from_db(using, fields)
+        if fields is None or {'status', 'assigned_to', 'assigned_to_id'} & set(fields):
+            self._loaded = self._snapshot()
+
+    def _snapshot(self):
+        """
+        (assigned_to_id, status) of the last load, None when one of them is deferred
+        """
+        values = (self.__dict__.get('assigned_to_id', DEFERRED), self.__dict__.get('status', DEFERRED))
+        return None if DEFERRED in values else values
+
+    def _stored(self, using):
+        """
+        (assigned_to_id, status) stored in the database or None: the values of the last
+        load or save, a locked read only for an instance that was never loaded
+        """
+        loaded = getattr(self, '_loaded', None)
+        if loaded is None:
+            loaded = Hit._base_manager.using(using).select_for_update().filter(pk=self.pk).values_list(
+                'assigned_to_id', 'status').first()
+        return loaded
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        # The guard goes in the WHERE of the UPDATE instead of a read: nothing is updated
+        # when the hit is in a final status or was changed since it was loaded.
+        loaded = getattr(self, '_loaded', None)
+        if loaded is not None:
+            base_qs = base_qs.filter(assigned_to_id=loaded[0], status=loaded[1])
+        updated = super(Hit, self)._do_update(
+            base_qs.exclude(status__in=FINAL_STATES), using, pk_val, values, update_fields, forced_update)
+        if not updated and loaded is not None:
+            raise ValidationError(STALE_HIT_ERROR)
+        return updated
+
+    def save(self, force_insert=False, *args, **kwargs) -> None:
+        if self.pk and not self._state.adding:
+            # a stored hit is never inserted again, it always goes through the guarded UPDATE
+            force_insert = False
+        using = kwargs.get('using') or router.db_for_write(Hit, instance=self)
+        with transaction.atomic(using=using):
             if self.assigned_to and self.assigned_to.is_superuser:
-                raise ValidationError("You can assign a hit to Big boss")
+                raise ValidationError(BIG_BOSS_ERROR)
             if self.assigned_to and not self.assigned_to.is_active:
-                raise ValidationError("You can't assign a hit to an inactive user")
-            if self.id:
-                current = Hit.objects.get(id=self.id)
-                if current.status in [FAILED, COMPLETED]:
-                    raise ValidationError("A Hit in a end status can't be changed")
-            return super(Hit, self).save(*args, **kwargs)
+                raise ValidationError(INACTIVE_USER_ERROR)
+            # the counters and the history move from the stored values and the previous
+            # user must know that the hit is not in his work list anymore
+            loaded = self._stored(using) if self.pk is not None and not force_insert else None
+            if loaded is not None and loaded[1] in FINAL_STATES:
+                raise ValidationError(FINAL_STATUS_ERROR)
+            self._loaded = loaded
+            result = super(Hit, self).save(force_insert, *args, **kwargs)
+            current = (self.assigned_to_id, self.status)
+            HitStat.objects.using(using).move(self.created_at, loaded, current)
+            if loaded != current:
+                events.record([(self.pk, loaded[1] if loaded else None, self.status, self.assigned_to_id)],
+                              using=using)
+            work_list.invalidate(loaded[0] if loaded else None, self.assigned_to_id)
+            self._loaded = current
+            return result
+
+
+# upsert of the HitStat counters by database vendor, see HitStatQuerySet.apply
+UPSERTS = {
+    'mysql': "INSERT INTO {table} ({columns}) VALUES {values} "
+             "ON DUPLICATE KEY UPDATE {count} = {count} + VALUES({count})",
+    'sqlite': "INSERT INTO {table} ({columns}) VALUES {values} "
+              "ON CONFLICT ({key}) DO UPDATE SET {count} = {count} + excluded.{count}",
+    'postgresql': "INSERT INTO {table} ({columns}) VALUES {values} "
+                  "ON CONFLICT ({key}) DO UPDATE SET {count} = {table}.{count} + excluded.{count}",
+}
+# 4 parameters per counter, under the 999 variables of SQLite
+UPSERT_BATCH_SIZE = 200
+
+
+class HitStatQuerySet(models.QuerySet):
+
+    def apply(self, deltas) -> None:
+        """
+        Add the deltas to the counters with one upsert (INSERT ... ON DUPLICATE KEY UPDATE
+        in MySQL, ON CONFLICT in SQLite and PostgreSQL) per UPSERT_BATCH_SIZE counters, it
+        must run in the transaction of the change. The other databases pay an UPDATE per
+        counter, plus an INSERT and an UPDATE for a new one.
+        :param dict deltas: {(user_id or None, status, day): delta}
+        """
+        using = write_db(self)
+        connection = connections[using]
+        # the same order in every transaction, the locks of two changes can't cross
+        rows = sorted(
+            (user_id or NO_ASSIGNEE, status, day, delta)
+            for (user_id, status, day), delta in deltas.items() if delta
+        )
+        template = UPSERTS.get(connection.vendor)
+        if template is None:
+            for assignee, status, day, delta in rows:
+                lookup = {'assignee': assignee, 'status': status, 'day': day}
+                if not self.using(using).filter(**lookup).update(count=F('count') + delta):
+                    self.using(using).bulk_create([HitStat(count=0, **lookup)], ignore_conflicts=True)
+                    self.using(using).filter(**lookup).update(count=F('count') + delta)
+            return
+        quote_name = connection.ops.quote_name
+        columns = [quote_name(HitStat._meta.get_field(name).column) for name in ('assignee', 'status', 'day', 'count')]
+        with connection.cursor() as cursor:
+            for index in range(0, len(rows), UPSERT_BATCH_SIZE):
+                batch = rows[index:index + UPSERT_BATCH_SIZE]
+                cursor.execute(template.format(
+                    table=quote_name(HitStat._meta.db_table),
+                    columns=', '.join(columns),
+                    values=', '.join(['(%s, %s, %s, %s)'] * len(batch)),
+                    key=', '.join(columns[:3]),
+                    count=columns[3],
+                ), [
+                    value for assignee, status, day, delta in batch
+                    for value in (assignee, status, connection.ops.adapt_datefield_value(day), delta)
+                ])
+
+    def move(self, created_at, old, new) -> None:
+        """
+        Move one hit from a (user_id, status) counter to another one.
+        :param datetime created_at: creation of the hit
+        :param tuple old: (user_id, status) before the change, None for a new hit
+        :param tuple new: (user_id, status) after the change
+        """
+        if old == new:
+            return
+        deltas = Counter({(*new, stat_day(created_at)): 1})
+        if old is not None:
+            deltas[(*old, stat_day(created_at))] -= 1
+        self.apply(deltas)
+
+    def compute(self):
+        """
+        Counters from the hit table, the slow path used to rebuild or verify the rollup
+        """
+        return Hit.objects.using(self._db).annotate(day=TruncDate('created_at', tzinfo=timezone.utc)).values(
+            'assigned_to_id', 'status', 'day').annotate(total=Count('id')).order_by()
+
+    def rebuild(self) -> int:
+        using = write_db(self)
+        with transaction.atomic(using=using):
+            self.using(using).delete()
+            stats = self.using(using).bulk_create([
+                HitStat(assignee=row['assigned_to_id'] or NO_ASSIGNEE, status=row['status'],
+                        day=row['day'], count=row['total'])
+                for row in self.using(using).compute().iterator()
+            ], batch_size=1000)
+        return len(stats)
+
+    def verify(self) -> dict:
+        """
+        Every stored counter is compared, a negative or an orphan one is a drift too.
+        :return dict: {(assignee, status, day): (counter, real value)} of the wrong counters
+        """
+        real = {
+            (row['assigned_to_id'] or NO_ASSIGNEE, row['status'], row['day']): row['total']
+            for row in self.compute().iterator()
+        }
+        stored = {
+            (assignee, status, day): count
+            for assignee, status, day, count in self.values_list(
+                'assignee', 'status', 'day', 'count').iterator()
+        }
+        return {
+            key: (stored.get(key, 0), real.get(key, 0))
+            for key in set(real) | set(stored) if stored.get(key, 0) != real.get(key, 0)
+        }
+
+    def dashboard(self, users=None, since=None, until=None, group_by=('assignee', 'status')):
+        """
+        Number of hits by assignee and/or status, it reads only the counters of the
+        users and days asked, never the hit table.
+        :param users: ids or a queryset of users (e.g. a team), None for everybody
+        :param date since: first day of creation of the hits
+        :param date until: last day of creation of the hits
+        :param tuple group_by: fields of the result, assignee and/or status
+        """
+        queryset = self
+        if users is not None:
+            queryset = queryset.filter(assignee__in=users)
+        if since is not None:
+            queryset = queryset.filter(day__gte=since)
+        if until is not None:
+            queryset = queryset.filter(day__lte=until)
+        # a negative total is a drift of the counters, hide only the empty ones
+        return queryset.values(*group_by).annotate(total=Sum('count')).exclude(total=0).order_by(*group_by)
+
+
+
+class HitStat(models.Model):
+    """
+    Rollup of the hits: number of hits by assignee, status and day of creation,
+    it's updated in the same transaction than the hit, see HitStatQuerySet.apply.
+    """
+    assignee = models.BigIntegerField(verbose_name=_("Assigned to"), default=NO_ASSIGNEE)
+    status = models.PositiveSmallIntegerField(choices=STATES, verbose_name=_("Status"))
+    day = models.DateField(verbose_name=_("Day"))
+    count = models.IntegerField(verbose_name=_("Count"), default=0)
+    objects = HitStatQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _("hit statistic")
+        verbose_name_plural = _("hit statistics")
+        constraints = [
+            models.UniqueConstraint(fields=['assignee', 'status', 'day'], name='hit_stat_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['day']),
+        ]
+
+
+class HitEventQuerySet(models.QuerySet):
+
+    def timeline(self, hit=None, user=None):
+        """
+        Events of a hit or of a user (the changes he did and the hits assigned to him), oldest first
+        """
+        queryset = self
+        if hit is not None:
+            queryset = queryset.filter(hit=hit)
+        if user is not None:
+            queryset = queryset.filter(models.Q(actor=user) | models.Q(assigned_to=user))
+        return queryset.order_by('created_at', 'id')
+
+    def prune(self, before, batch_size=10000) -> int:
+        """
+        Delete the events older than a date in chunks over the created_at index, so the
+        table doesn't grow forever and no chunk holds the locks for long.
+        :return int: number of events deleted
+        """
+        using = write_db(self)
+        deleted = 0
+        while True:
+            ids = list(self.using(using).filter(created_at__lt=before).order_by('created_at').values_list(
+                'id', flat=True)[:batch_size])
+            if not ids:
+                return deleted
+            deleted += self.model._base_manager.using(using).filter(id__in=ids).delete()[0]
+
+
+class HitEvent(models.Model):
+    """
+    Append only history of the hits: one row per creation, assignment or status change,
+    inserted in batches on the commit of the change, see hit.events. The foreign keys
+    have no constraint so the history survives the rows it points to.
+    """
+    hit = models.ForeignKey(
+        Hit,
+        related_name="events",
+        verbose_name=_("Hit"),
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        db_index=False,
+    )
+    from_status = models.PositiveSmallIntegerField(choices=STATES, null=True, verbose_name=_("From status"))
+    to_status = models.PositiveSmallIntegerField(choices=STATES, verbose_name=_("To status"))
+    assigned_to = models.ForeignKey(
+        "profiles.CustomUser",
+        related_name="+",
+        verbose_name=_("Assigned to"),
+        null=True,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        db_index=False,
+    )
+    actor = models.ForeignKey(
+        "profiles.CustomUser",
+        related_name="+",
+        verbose_name=_("Changed by"),
+        null=True,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        db_index=False,
+    )
+    created_at = models.DateTimeField(verbose_name=_("Created at"), default=timezone.now)
+    objects = HitEventQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _("hit event")
+        verbose_name_plural = _("hit events")
+        indexes = [
+            # the timelines of a hit and of a user
+            models.Index(fields=['hit', 'created_at']),
+            models.Index(fields=['actor', 'created_at']),
+            models.Index(fields=['assigned_to', 'created_at']),
+            # pruning by time range
+            models.Index(fields=['created_at']),
+        ]
+
+    def save(self, *args, **kwargs) -> None:
+        if not self._state.adding:
+            raise ValidationError("The hit history can't be changed")
+        return super(HitEvent, self).save(*args, **kwargs)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+"""
+Full text search over the target_name and the description of the hits, see HitQuerySet.search.
+
+The backend is the HIT_SEARCH_BACKEND setting (dotted path of a class) or the one of
+the database vendor, the migration 0005_hit_search creates its index:
+* MySQL: FULLTEXT indexes, MATCH ... AGAINST in boolean mode over both columns to filter
+  and one MATCH per column to rank (migration 0006_hit_search_columns)
+* SQLite: FTS5 table hit_search, an inverted index kept up to date by triggers on every
+  INSERT, UPDATE and DELETE of hit_hit (bulk_create and queryset updates too)
+* others: icontains, a table scan
+
+A hit matches when every word of the query is a word (or the prefix of a word) of its
+target name or description, the target name weights more in the rank.
+"""
+import re
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import FloatField, Q, Value
+from django.utils.module_loading import import_string
+
+TERMS = re.compile(r'\w+', re.UNICODE)
+MAX_TERMS = 10
+TARGET_NAME_WEIGHT = 5.0
+DESCRIPTION_WEIGHT = 1.0
+
+
+def terms(query) -> list:
+    """
+    Words of the query, the operators of the engines are dropped
+    """
+    return TERMS.findall(query.lower())[:MAX_TERMS]
+
+
+class IContainsBackend:
+
+    def search(self, queryset, words):
+        for word in words:
+            queryset = queryset.filter(Q(target_name__icontains=word) | Q(description__icontains=word))
+        return queryset.annotate(rank=Value(0.0, output_field=FloatField()))
+
+
+class MySQLFullTextBackend:
+    MATCH = "MATCH (hit_hit.target_name, hit_hit.description) AGAINST (%s IN BOOLEAN MODE)"
+    RANK = "{} * MATCH (hit_hit.target_name) AGAINST (%s IN BOOLEAN MODE) + " \
+           "{} * MATCH (hit_hit.description) AGAINST (%s IN BOOLEAN MODE)".format(
+               TARGET_NAME_WEIGHT, DESCRIPTION_WEIGHT)
+
+    def search(self, queryset, words):
+        query = ' '.join('+{}*'.format(word) for word in words)
+        # without +, a column that has only some of the words still adds to the rank
+        rank = ' '.join('{}*'.format(word) for word in words)
+        return queryset.extra(
+            select={'rank': self.RANK}, select_params=[rank, rank], where=[self.MATCH], params=[query])
+
+
+class SQLiteFTSBackend:
+
+    def search(self, queryset, words):
+        query = ' '.join('"{}"*'.format(word) for word in words)
+        # bm25 is lower for the better matches
+        return queryset.extra(
+            tables=['hit_search'],
+            where=['hit_search.rowid = hit_hit.id', 'hit_search MATCH %s'],
+            params=[query],
+            select={'rank': '-bm25(hit_search, {}, {})'.format(TARGET_NAME_WEIGHT, DESCRIPTION_WEIGHT)},
+        )
+
+
+VENDOR_BACKENDS = {
+    'mysql': MySQLFullTextBackend,
+    'sqlite': SQLiteFTSBackend,
+}
+_backends = {}
+
+
+def get_backend(using):
+    backend = _backends.get(using)
+    if backend is None:
+        path = getattr(settings, 'HIT_SEARCH_BACKEND', None)
+        backend_class = import_string(path) if path else VENDOR_BACKENDS.get(
+            connections[using].vendor, IContainsBackend)
+        backend = _backends[using] = backend_class()
+    return backend
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+from rest_framework import serializers
+
+from hit.models import Hit, HitEvent
+from profiles.serializers import UserSummarySerializer
+
+
+class HitSerializer(serializers.ModelSerializer):
+    status_display = serializers.CharField(source='get_status_display', read_only=True)
+    assigned_to = UserSummarySerializer(read_only=True)
+    created_by = UserSummarySerializer(read_only=True)
+
+    class Meta:
+        model = Hit
+        fields = ('id', 'target_name', 'description', 'status', 'status_display',
+                  'assigned_to', 'created_by', 'created_at', 'updated_at')
+
+
+class HitEventSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = HitEvent
+        fields = ('id', 'from_status', 'to_status', 'assigned_to_id', 'actor_id', 'created_at')
@@ -1,8 +1,23 @@
-from django.test import TestCase
+import asyncio
+from datetime import timedelta
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection, connections, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 from profiles.models import CustomUser, Job
-from hit.models import Hit
+from agencyGiuseppi import metrics
+from agencyGiuseppi.db_router import REPLICA_PIN_COOKIE, ReplicaPinMiddleware, ReplicaRouter, _pinned_until
+from base.async_db import run_query
+from hit.work_list import get_work_list
+from hit.events import ActorMiddleware, acting_as, actor_id
+from hit.models import Hit, HitEvent, HitStat, ASSIGNED, COMPLETED, FAILED, FINAL_STATUS_ERROR, BIG_BOSS_ERROR, STALE_HIT_ERROR
 
 
 # Create your tests here.
@@ -83,3 +98,480 @@ class HitTestCase(TestCase):
         hit.refresh_from_db()
         hit.status = 2
         self.assertRaises(ValidationError, hit.save, "Its suppose to raise a ValidationError for final state")
+
+    def test_transition_is_a_single_update(self) -> None:
+        hit = Hit.objects.create(**self.hit_data_base)
+        hit.assign(self.hitman)
+        with CaptureQueriesContext(connection) as context:
+            changed = hit.transition(COMPLETED)
+        statements = [query['sql'].split()[0] for query in context.captured_queries
+                      if 'hit_hitstat' not in query['sql'] and not query['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+        # the hit is changed in one UPDATE and never read, the rest is the HitStat upsert
+        self.assertEqual(statements, ['UPDATE'], "a transition is a single UPDATE")
+        self.assertEqual(changed, 1, "It's supposed to change one row")
+        hit.refresh_from_db()
+        self.assertEqual(hit.status, COMPLETED, "the transition doesn't work")
+        with CaptureQueriesContext(connection) as context:
+            self.assertRaises(ValidationError, hit.transition, ASSIGNED)
+        self.assertFalse([query for query in context.captured_queries if 'hit_hit' in query['sql']],
+                         "the loaded final status is enough to reject the transition")
+
+    def test_queryset_transition_skips_final_status(self) -> None:
+        open_hit = Hit.objects.create(**self.hit_data_base)
+        closed_hit = Hit.objects.create(**self.hit_data_base)
+        closed_hit.transition(COMPLETED)
+        changed = Hit.objects.filter(id__in=[open_hit.id, closed_hit.id]).transition(FAILED)
+        self.assertEqual(changed, 1, "Only the open hit can be changed")
+        closed_hit.refresh_from_db()
+        self.assertEqual(closed_hit.status, COMPLETED, "A final status can't be changed")
+
+    def test_assign_many(self) -> None:
+        Hit.objects.bulk_create([Hit(**self.hit_data_base) for _ in range(10)])
+        hits = list(Hit.objects.all())
+        hits[0].transition(FAILED)
+        with CaptureQueriesContext(connection) as context:
+            results = Hit.objects.assign_many(hits, self.hitman)
+        statements = [query['sql'].split()[0] for query in context.captured_queries
+                      if 'hit_hitstat' not in query['sql']]
+        # users validation, hits lock and one UPDATE, plus the savepoint and the HitStat counters
+        # (the events are inserted on commit)
+        self.assertEqual(statements, ['SAVEPOINT', 'SELECT', 'SELECT', 'UPDATE', 'RELEASE'])
+        self.assertEqual(results[hits[0].pk], FINAL_STATUS_ERROR, "A final hit can't be assigned")
+        self.assertEqual(
+            Hit.objects.filter(assigned_to=self.hitman, status=ASSIGNED).count(), 9, "The open hits must be assigned")
+
+    def test_bulk_assign_rejects_big_boss(self) -> None:
+        first = Hit.objects.create(**self.hit_data_base)
+        second = Hit.objects.create(**self.hit_data_base)
+        results = Hit.objects.bulk_assign({first.pk: self.hitman.pk, second.pk: self.big_boss.pk})
+        self.assertEqual(results, {first.pk: None, second.pk: BIG_BOSS_ERROR})
+        second.refresh_from_db()
+        self.assertIsNone(second.assigned_to, "The big boss can't be assigned")
+
+
+class HitApiTestCase(TestCase):
+    def setUp(self) -> None:
+        # the work lists of the previous tests
+        cache.clear()
+        self.big_boss = CustomUser.objects.create_superuser(email="sergio@test.com", username="bigboss", password="zxczxc.123")
+        self.hitman = CustomUser.objects.create(email="hitman@test.com")
+        Hit.objects.bulk_create([Hit(target_name="Target {}".format(index), description="Test") for index in range(25)])
+        Hit.objects.filter(id__lte=5).update(assigned_to=self.hitman, status=ASSIGNED)
+        self.client.force_login(self.big_boss)
+
+    def test_cursor_pagination(self) -> None:
+        ids = []
+        url = reverse('hit-list') + '?page_size=10'
+        while url:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            selects = [query for query in context.captured_queries if query['sql'].startswith('SELECT')]
+            # user and the page, whatever the depth of the page (the session is cached, see base.sessions)
+            self.assertEqual(len(selects), 2, "wrong number of queries")
+            self.assertEqual(response.status_code, 200)
+            ids += [item['id'] for item in response.json()['results']]
+            url = response.json()['next']
+        self.assertEqual(len(ids), 25, "every hit must be in one page")
+        self.assertEqual(len(set(ids)), 25, "a hit can't be in two pages")
+
+    def test_cursor_pagination_ties(self) -> None:
+        Hit.objects.update(created_at=timezone.now())
+        response = self.client.get(reverse('hit-list'), {'page_size': 10})
+        ids = [item['id'] for item in response.json()['results']]
+        self.assertEqual(ids, sorted(ids, reverse=True), "the id must break the ties of created_at")
+        response = self.client.get(response.json()['next'])
+        self.assertLess(response.json()['results'][0]['id'], ids[-1])
+
+    def test_search(self) -> None:
+        Hit.objects.create(target_name="Vito Corleone", description="Olive oil business")
+        Hit.objects.create(target_name="Olive Garden", description="Restaurant")
+        hit = Hit.objects.create(target_name="Tom Hagen", description="Lawyer of the Corleone family")
+        self.assertEqual([found.target_name for found in Hit.objects.search("olive")], ["Olive Garden", "Vito Corleone"],
+                         "the target name must weight more than the description")
+        self.assertEqual(Hit.objects.search("corl vito").count(), 1, "every word (or prefix) must match")
+        self.assertEqual(Hit.objects.search("\"*:(").count(), 0)
+        hit.description = "Consigliere"
+        hit.save()
+        self.assertEqual(Hit.objects.search("corleone").count(), 1, "the index must follow the changes")
+
+        response = self.client.get(reverse('hit-search'), {'q': 'target', 'limit': 20})
+        self.assertEqual(len(response.json()['results']), 20)
+        self.assertEqual(response.json()['next_offset'], 20)
+        response = self.client.get(reverse('hit-search'), {'q': 'target', 'limit': 20, 'offset': 20})
+        self.assertEqual(len(response.json()['results']), 5)
+        self.assertIsNone(response.json()['next_offset'])
+        response = self.client.get(reverse('hit-search'), {'q': 'target', 'limit': 0, 'offset': 3})
+        self.assertEqual((len(response.json()['results']), response.json()['next_offset']), (1, 4),
+                         "the limit must be at least 1")
+        self.client.force_login(self.hitman)
+        response = self.client.get(reverse('hit-search'), {'q': 'target'})
+        self.assertEqual(len(response.json()['results']), 5, "only the visible hits")
+
+    def test_filters(self) -> None:
+        response = self.client.get(reverse('hit-list'), {'assigned_to': self.hitman.pk, 'status': ASSIGNED})
+        results = response.json()['results']
+        self.assertEqual(len(results), 5, "wrong filter")
+        self.assertEqual(results[0]['assigned_to']['id'], self.hitman.pk, "wrong assignment")
+
+    def test_hitman_only_sees_his_hits(self) -> None:
+        self.client.force_login(self.hitman)
+        response = self.client.get(reverse('hit-list'))
+        self.assertEqual(len(response.json()['results']), 5, "the hitman only sees his hits")
+
+    def test_stats(self) -> None:
+        HitStat.objects.rebuild()
+        response = self.client.get(reverse('hit-stats'), {'group_by': 'status'})
+        self.assertEqual(response.json(), [{'status': 1, 'total': 20}, {'status': ASSIGNED, 'total': 5}])
+
+    def test_upcoming_work_list(self) -> None:
+        self.client.force_login(self.hitman)
+        response = self.client.get(reverse('hit-upcoming'))
+        self.assertEqual(len(response.json()), 5, "the hitman has 5 assigned hits")
+        with self.assertNumQueries(0):
+            self.assertEqual(len(get_work_list(self.hitman.pk)), 5, "the list must be in the cache")
+
+        Hit.objects.get(id=1).transition(COMPLETED)
+        self.assertEqual(len(get_work_list(self.hitman.pk)), 4, "a completed hit is not upcoming work")
+        Hit.objects.get(id=10).assign(self.hitman)
+        self.assertEqual(get_work_list(self.hitman.pk)[0]['id'], 10, "the list wasn't refreshed")
+        Hit.objects.filter(assigned_to=self.hitman).transition(FAILED)
+        self.assertEqual(get_work_list(self.hitman.pk), [], "the list wasn't refreshed")
+
+
+class HitStatTestCase(TestCase):
+    def setUp(self) -> None:
+        self.manager = CustomUser.objects.create(email="manager@test.com")
+        self.hitman = CustomUser.objects.create(email="hitman@test.com")
+
+    def test_counters_follow_the_hits(self) -> None:
+        hits = [Hit.objects.create(target_name="Target", description="Test", created_by=self.manager)
+                for _ in range(4)]
+        hits[0].assign(self.hitman)
+        hits[1].assign(self.hitman)
+        hits[1].transition(COMPLETED)
+        Hit.objects.bulk_assign({hits[2].pk: self.manager.pk})
+        Hit.objects.filter(id=hits[3].pk).transition(FAILED)
+        self.assertEqual(HitStat.objects.verify(), {}, "the counters must be the same as the hit table")
+        rows = list(HitStat.objects.dashboard(users=[self.hitman.pk], group_by=('status',)))
+        self.assertEqual(rows, [{'status': ASSIGNED, 'total': 1}, {'status': COMPLETED, 'total': 1}])
+
+    def test_apply_upsert(self) -> None:
+        day = timezone.now().date()
+        HitStat.objects.create(assignee=self.hitman.pk, status=ASSIGNED, day=day, count=2)
+        with CaptureQueriesContext(connection) as context:
+            HitStat.objects.apply({(self.hitman.pk, ASSIGNED, day): -1, (self.hitman.pk, COMPLETED, day): 1,
+                                   (None, ASSIGNED, day): 0})
+        self.assertEqual(len(context.captured_queries), 1, "the counters must be written with one upsert")
+        self.assertEqual(sorted(HitStat.objects.values_list('status', 'count')), [(ASSIGNED, 1), (COMPLETED, 1)])
+
+    def test_bulk_create_and_drift(self) -> None:
+        Hit.objects.bulk_create([Hit(target_name="Target", description="Test") for _ in range(4)])
+        Hit.objects.assign_many(Hit.objects.all(), self.hitman)
+        self.assertEqual(HitStat.objects.verify(), {}, "bulk_create must add the counters")
+        key = (0, ASSIGNED, timezone.now().date())
+        HitStat.objects.create(assignee=key[0], status=key[1], day=key[2], count=-2)
+        self.assertEqual(HitStat.objects.verify(), {key: (-2, 0)}, "a negative counter is a drift")
+        self.assertEqual(list(HitStat.objects.dashboard(group_by=('assignee',))),
+                         [{'assignee': 0, 'total': -2}, {'assignee': self.hitman.pk, 'total': 4}])
+
+    def test_stale_instance(self) -> None:
+        with self.captureOnCommitCallbacks(execute=True):
+            hit = Hit.objects.create(target_name="Target", description="Test", created_by=self.manager)
+            stale = Hit.objects.get(pk=hit.pk)
+            hit.assign(self.hitman)
+            self.assertRaisesMessage(ValidationError, STALE_HIT_ERROR, stale.transition, COMPLETED)
+            stale.description = "Changed"
+            self.assertRaisesMessage(ValidationError, STALE_HIT_ERROR, stale.save)
+            stale.refresh_from_db()
+            stale.transition(COMPLETED)
+        self.assertEqual(HitStat.objects.verify(), {}, "the counters must move from the stored values")
+        self.assertEqual(list(HitEvent.objects.timeline(hit=hit).values_list('from_status', 'to_status')),
+                         [(None, 1), (1, ASSIGNED), (ASSIGNED, COMPLETED)])
+
+    def test_rebuild_command(self) -> None:
+        Hit.objects.create(target_name="Target", description="Test")
+        HitStat.objects.all().delete()
+        self.assertRaises(CommandError, call_command, 'hit_stats', stdout=StringIO())
+        call_command('hit_stats', rebuild=True, stdout=StringIO())
+        self.assertEqual(HitStat.objects.verify(), {}, "the counters were not rebuilt")
+
+
+class AsyncHitViewsTestCase(TransactionTestCase):
+    """
+    The async views read in other threads, so the data must be committed
+    """
+    reset_sequences = True
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.hitman = CustomUser.objects.create_user(username="hitman", email="hitman@test.com", password="pass")
+        Hit.objects.bulk_create([Hit(target_name="Target", description="Test") for _ in range(60)])
+        Hit.objects.filter(id__lte=55).update(assigned_to=self.hitman, status=ASSIGNED)
+        self.client.force_login(self.hitman)
+
+    def test_hit_list_and_detail(self) -> None:
+        response = self.client.get(reverse('async-hit-list'))
+        page = response.json()
+        self.assertEqual(len(page['results']), 50, "wrong page size")
+        response = self.client.get(reverse('async-hit-list'), {'before': page['next']})
+        self.assertEqual(len(response.json()['results']), 5, "wrong second page")
+        response = self.client.get(reverse('async-hit-detail', args=[1]))
+        self.assertEqual(response.json()['assigned_to']['id'], self.hitman.pk, "wrong hit")
+        response = self.client.get(reverse('async-hit-detail', args=[60]))
+        self.assertEqual(response.status_code, 404, "the hit is not visible for the hitman")
+
+    def test_profile(self) -> None:
+        HitStat.objects.rebuild()
+        response = self.client.get(reverse('async-profile'))
+        data = response.json()
+        self.assertEqual(data['user']['id'], self.hitman.pk)
+        self.assertEqual(len(data['upcoming']), 55, "wrong upcoming work")
+        self.assertEqual(data['stats'], [{'status': ASSIGNED, 'total': 55}])
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('async-profile')).status_code, 401)
+
+    def test_metrics(self) -> None:
+        metrics.registry.reset()
+        self.client.get(reverse('async-hit-list'))
+        queries = metrics.registry.snapshot()['http_request_db_queries'][(('view', 'async-hit-list'),)]
+        self.assertGreaterEqual(queries[-2], 2, "the queries of the pool threads must be counted")
+
+
+class HitAdminTestCase(TestCase):
+    def setUp(self) -> None:
+        self.big_boss = CustomUser.objects.create_superuser(email="sergio@test.com", username="bigboss", password="pass")
+        self.hitman = CustomUser.objects.create(email="hitman@test.com")
+        self.client.force_login(self.big_boss)
+        self.url = reverse('admin:hit_hit_changelist')
+
+    def changelist_queries(self, **params) -> int:
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_query_budget(self) -> None:
+        Hit.objects.bulk_create([
+            Hit(target_name="Target", description="Test", assigned_to=self.hitman, created_by=self.big_boss)
+            for _ in range(10)
+        ])
+        queries = self.changelist_queries()
+        Hit.objects.bulk_create([
+            Hit(target_name="Target", description="Test", assigned_to=self.hitman, created_by=self.big_boss)
+            for _ in range(150)
+        ])
+        self.assertEqual(self.changelist_queries(), queries, "the queries must not grow with the rows")
+        self.assertLessEqual(self.changelist_queries(status=ASSIGNED), queries)
+        self.assertLessEqual(self.changelist_queries(q="target"), queries)
+
+    def test_search_with_filters(self) -> None:
+        Hit.objects.bulk_create(
+            [Hit(target_name="Vito Corleone", description="Test", status=ASSIGNED, assigned_to=self.hitman)
+             for _ in range(3)] +
+            [Hit(target_name="Vito Corleone", description="Test") for _ in range(2)] +
+            [Hit(target_name="Tom Hagen", description="Test", status=ASSIGNED, assigned_to=self.hitman)]
+        )
+        response = self.client.get(self.url, {'q': 'vito', 'status__exact': ASSIGNED})
+        self.assertEqual(response.context['cl'].result_count, 3, "the search must be applied with the filters")
+
+    def test_actions(self) -> None:
+        hits = Hit.objects.bulk_create([Hit(target_name="Target", description="Test") for _ in range(4)])
+        ids = list(Hit.objects.values_list('id', flat=True))
+        self.client.post(self.url, {'action': 'assign', '_selected_action': ids, 'assigned_to': self.hitman.pk})
+        self.assertEqual(Hit.objects.filter(assigned_to=self.hitman, status=ASSIGNED).count(), 4)
+        self.client.post(self.url, {'action': 'complete', '_selected_action': ids[:2]})
+        self.client.post(self.url, {'action': 'fail', '_selected_action': ids})
+        self.assertEqual(sorted(Hit.objects.values_list('status', flat=True)), [FAILED, FAILED, COMPLETED, COMPLETED])
+        self.assertEqual(HitStat.objects.verify(), {})
+
+
+class HitEventTestCase(TransactionTestCase):
+    """
+    The events are written on commit, on_commit runs only in a TransactionTestCase
+    """
+
+    def setUp(self) -> None:
+        cache.clear()
+        manager_job = Job.objects.create(name="Manager")
+        hitman_job = Job.objects.create(name="Hitman", report_to=manager_job)
+        self.manager = CustomUser.objects.create_user(
+            username="manager", email="manager@test.com", password="pass", job=manager_job)
+        self.hitman = CustomUser.objects.create_user(
+            username="hitman", email="hitman@test.com", password="pass", job=hitman_job, report_to=self.manager)
+
+    def test_timeline(self) -> None:
+        with acting_as(self.manager):
+            hit = Hit.objects.create(target_name="Target", description="Test", created_by=self.manager)
+            hit.assign(self.hitman)
+            hit.save()
+        with acting_as(self.hitman):
+            hit.transition(COMPLETED)
+        events = list(HitEvent.objects.timeline(hit=hit).values_list(
+            'from_status', 'to_status', 'assigned_to_id', 'actor_id'))
+        self.assertEqual(events, [
+            (None, 1, None, self.manager.pk),
+            (1, ASSIGNED, self.hitman.pk, self.manager.pk),
+            (ASSIGNED, COMPLETED, self.hitman.pk, self.hitman.pk),
+        ], "a save without changes must not be recorded")
+        self.assertEqual(HitEvent.objects.timeline(user=self.hitman).count(), 2)
+
+    def test_rollback(self) -> None:
+        hits = Hit.objects.bulk_create([Hit(target_name="Target", description="Test") for _ in range(3)])
+        hits = list(Hit.objects.all())
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                hits[0].assign(self.hitman)
+                Hit.objects.filter(id=hits[2].id).transition(FAILED)
+                # the last record is rolled back, the batch must be inserted anyway
+                try:
+                    with transaction.atomic():
+                        hits[1].assign(self.hitman)
+                        raise ValueError
+                except ValueError:
+                    pass
+        inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "hit_hitevent"')]
+        self.assertEqual(len(inserts), 1, "the events of a transaction must be inserted with one INSERT")
+        self.assertTrue(queries.captured_queries[-1]['sql'].startswith('INSERT INTO "hit_hitevent"'),
+                        "the events must be inserted after the commit")
+        self.assertEqual(set(HitEvent.objects.values_list('hit_id', flat=True)), {hits[0].id, hits[2].id},
+                         "the event of a rolled back change was recorded")
+
+    async def test_async_actor(self) -> None:
+        async def view(request):
+            return HttpResponse(str(actor_id()))
+        middleware = ActorMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        request = RequestFactory().get('/')
+        request.user = self.manager
+        response = await middleware(request)
+        self.assertEqual(response.content.decode(), str(self.manager.pk))
+        self.assertIsNone(actor_id(), "the actor of a request leaked")
+
+    def test_release(self) -> None:
+        Hit.objects.bulk_create([
+            Hit(target_name="Target", description="Test", status=ASSIGNED, assigned_to=self.hitman) for _ in range(5)
+        ])
+        Hit.objects.bulk_create([Hit(target_name="Target", description="Test", status=COMPLETED, assigned_to=self.hitman)])
+        with CaptureQueriesContext(connection) as queries:
+            with acting_as(self.manager):
+                self.assertEqual(Hit.objects.release([self.hitman.pk], self.manager), 5)
+        inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "hit_hitevent"')]
+        self.assertEqual(len(inserts), 1, "the events must be inserted with one INSERT ... SELECT")
+        self.assertEqual(set(HitEvent.objects.values_list('from_status', 'to_status', 'assigned_to_id', 'actor_id')),
+                         {(ASSIGNED, ASSIGNED, self.manager.pk, self.manager.pk)})
+        self.assertEqual(HitEvent.objects.count(), 5)
+        self.assertEqual(HitStat.objects.verify(), {})
+
+    def test_prune(self) -> None:
+        hit = Hit.objects.create(target_name="Target", description="Test")
+        HitEvent.objects.filter(hit=hit).update(created_at=timezone.now() - timedelta(days=400))
+        hit.assign(self.hitman)
+        call_command('prune_hit_events', days=365, stdout=StringIO())
+        self.assertEqual(list(HitEvent.objects.values_list('to_status', flat=True)), [ASSIGNED])
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], REPLICA_PIN_SECONDS=5)
+class ReplicaRouterTestCase(SimpleTestCase):
+    def setUp(self) -> None:
+        self.router = ReplicaRouter()
+        # the writes of the other tests pin this thread
+        token = _pinned_until.set(0.0)
+        self.addCleanup(_pinned_until.reset, token)
+
+    def test_read_your_writes(self):
+        def view(request):
+            response = HttpResponse()
+            response.databases = [self.router.db_for_read(Hit)]
+            if request.method == 'POST':
+                self.router.db_for_write(Hit)
+                response.databases.append(self.router.db_for_read(Hit))
+            return response
+        middleware = ReplicaPinMiddleware(view)
+        factory = RequestFactory()
+
+        response = middleware(factory.get('/'))
+        self.assertEqual(response.databases, ['replica'])
+        self.assertNotIn(REPLICA_PIN_COOKIE, response.cookies)
+
+        response = middleware(factory.post('/'))
+        self.assertEqual(response.databases, ['replica', 'default'], "the write must pin the request")
+        cookie = response.cookies[REPLICA_PIN_COOKIE]
+
+        request = factory.get('/')
+        request.COOKIES[REPLICA_PIN_COOKIE] = cookie.value
+        self.assertEqual(middleware(request).databases, ['default'], "the next request must read the write")
+        request.COOKIES[REPLICA_PIN_COOKIE] = '0'
+        self.assertEqual(middleware(request).databases, ['replica'], "the window is over")
+        self.assertEqual(self.router.db_for_read(Hit), 'replica', "the pin of a request leaked")
+
+    async def test_async_read_your_writes(self):
+        async def view(request):
+            await run_query(self.router.db_for_write, Hit)
+            response = HttpResponse()
+            response.databases = [self.router.db_for_read(Hit)]
+            return response
+        middleware = ReplicaPinMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = await middleware(RequestFactory().post('/'))
+        self.assertEqual(response.databases, ['default'], "the write of the pool must pin the request")
+        self.assertIn(REPLICA_PIN_COOKIE, response.cookies)
+        self.assertEqual(self.router.db_for_read(Hit), 'replica', "the pin of a request leaked")
+
+    def test_other_apps(self):
+        from django.contrib.sessions.models import Session
+        self.assertEqual(self.router.db_for_read(Session), 'default')
+        self.assertFalse(self.router.allow_migrate('replica', 'hit'))
+        self.assertTrue(self.router.allow_migrate('default', 'hit'))
+
+
+@override_settings(DATABASE_REPLICAS=['replica'], REPLICA_PIN_SECONDS=0)
+class ReplicaWriteTestCase(TransactionTestCase):
+    """
+    The writes outside of a pinned request (e.g. a command) go to default in one
+    transaction, the replica is an empty database that fails any query
+    """
+
+    def setUp(self) -> None:
+        cache.clear()
+        connections.databases['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        connections.ensure_defaults('replica')
+        connections.prepare_test_settings('replica')
+        self.addCleanup(connections.databases.pop, 'replica')
+        self.addCleanup(connections['replica'].close)
+        manager_job = Job.objects.create(name="Manager")
+        hitman_job = Job.objects.create(name="Hitman", report_to=manager_job)
+        self.manager = CustomUser.objects.create_user(
+            username="manager", email="manager@test.com", password="pass", job=manager_job)
+        self.hitmen = [
+            CustomUser.objects.create_user(username="hitman{}".format(index), email="hitman{}@test.com".format(index),
+                                           password="pass", job=hitman_job, report_to=self.manager)
+            for index in range(2)
+        ]
+        Hit.objects.bulk_create([Hit(target_name="Target", description="Test") for _ in range(4)])
+        self.ids = list(Hit.objects.using('default').order_by('id').values_list('id', flat=True))
+        self.writes = []
+
+        def record(execute, sql, params, many, context):
+            if sql.startswith(('INSERT', 'UPDATE', 'DELETE')):
+                self.writes.append((sql, context['connection'].in_atomic_block))
+            return execute(sql, params, many, context)
+        wrapper = connection.execute_wrapper(record)
+        wrapper.__enter__()
+        self.addCleanup(wrapper.__exit__, None, None, None)
+
+    def test_writes(self) -> None:
+        self.assertEqual(Hit.objects.db, 'replica', "the reads must go to the replica")
+        ids = self.ids
+        results = Hit.objects.bulk_assign({ids[0]: self.hitmen[0].pk, ids[1]: self.hitmen[1].pk, ids[2]: self.hitmen[0].pk})
+        self.assertEqual(set(results.values()), {None})
+        self.assertEqual(Hit.objects.filter(id=ids[2]).transition(FAILED), 1)
+        result = CustomUser.objects.deactivate(CustomUser.objects.filter(pk=self.hitmen[0].pk), self.hitmen[1])
+        self.assertEqual(result, {'users': 1, 'hits': 1})
+        self.assertEqual(Hit.objects.release([self.hitmen[1].pk]), 2)
+
+        self.assertIsNone(connections['replica'].connection, "a write path used the replica")
+        self.assertTrue(self.writes)
+        self.assertEqual([sql for sql, in_atomic_block in self.writes if not in_atomic_block], [],
+                         "the writes must be in the transaction")
+        self.assertEqual(HitStat.objects.using('default').verify(), {})
+        self.assertEqual(HitEvent.objects.using('default').count(), 3 + 1 + 1 + 2)
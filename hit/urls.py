@@ -0,0 +1,9 @@
+from django.urls import path
+
+from hit import views
+
+# async views for the ASGI deployment, the DRF api is in agencyGiuseppi.urls
+urlpatterns = [
+    path('hits/', views.async_hit_list, name="async-hit-list"),
+    path('hits/<int:pk>/', views.async_hit_detail, name="async-hit-detail"),
+]
@@ -1,3 +1,159 @@
-from django.shortcuts import render
+from django.http import JsonResponse
+from django.utils.dateparse import parse_date
+from django_filters import rest_framework as filters
+from rest_framework import permissions, viewsets
+from rest_framework.decorators import action
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
 
-# Create your views here.
+from base.async_db import run_as_user
+from hit.models import Hit, HitEvent, HitStat
+from hit.serializers import HitEventSerializer, HitSerializer
+from hit.work_list import get_work_list
+
+
+def team_of(user):
+    """
+    ids of the user and his subordinates, None (everybody) for the Big boss, the
+    deleted subordinates too, their old hits are still part of the team
+    """
+    if user.is_superuser:
+        return None
+    return [user.pk, *user._meta.model.objects.all_with_deleted().subordinates_of(user).values_list('id', flat=True)]
+
+
+class HitCursorPagination(CursorPagination):
+    """
+    Keyset pagination, the cursor is the created_at (or updated_at) of the last hit,
+    so a deep page is a range scan over the index like the first one, never an OFFSET.
+    The id breaks the ties of created_at, the index of created_at has the primary key.
+    """
+    ordering = ('-created_at', '-id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+
+class HitFilter(filters.FilterSet):
+    # filter by id, a ModelChoiceFilter would read the user to validate it
+    assigned_to = filters.NumberFilter(field_name='assigned_to_id')
+    created_by = filters.NumberFilter(field_name='created_by_id')
+
+    class Meta:
+        model = Hit
+        fields = ('status', 'assigned_to', 'created_by')
+
+
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+
+def _int_param(request, name, default, minimum=0, maximum=None) -> int:
+    value = request.query_params.get(name, '')
+    value = max(int(value) if value.isdigit() else default, minimum)
+    return min(value, maximum) if maximum is not None else value
+
+
+class HitViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Hits visible for the user: Big boss all of them, the others the hits they created
+    and the hits assigned to them or to their subordinates.
+    """
+    serializer_class = HitSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+    pagination_class = HitCursorPagination
+    filter_backends = (OrderingFilter, filters.DjangoFilterBackend)
+    filterset_class = HitFilter
+    # only the orderings with an index
+    ordering_fields = ('created_at', 'updated_at')
+    ordering = ('-created_at', '-id')
+
+    def get_queryset(self):
+        return Hit.objects.select_related('assigned_to', 'created_by').visible_to(self.request.user)
+
+    @action(detail=False)
+    def upcoming(self, request):
+        """
+        Upcoming work of the user, from the cache
+        """
+        return Response(get_work_list(request.user.pk))
+
+    @action(detail=True)
+    def history(self, request, pk=None):
+        """
+        Creation, assignments and status changes of the hit, oldest first
+        """
+        return Response(HitEventSerializer(
+            HitEvent.objects.timeline(hit=self.get_object()), many=True).data)
+
+    @action(detail=False)
+    def search(self, request):
+        """
+        Full text search over the visible hits, the best matches first, see
+        HitQuerySet.search. Query params: q, limit and offset.
+        """
+        # a limit of 0 would return the same next_offset forever
+        limit = _int_param(request, 'limit', SEARCH_LIMIT, minimum=1, maximum=MAX_SEARCH_LIMIT)
+        offset = _int_param(request, 'offset', 0)
+        hits = list(self.get_queryset().search(request.query_params.get('q', ''))[offset:offset + limit + 1])
+        return Response({
+            'results': self.get_serializer(hits[:limit], many=True).data,
+            'next_offset': offset + limit if len(hits) > limit else None,
+        })
+
+    @action(detail=False)
+    def stats(self, request):
+        """
+        Number of hits by assignee and status of the user's team (everybody for the
+        Big boss), from the HitStat counters. Query params: since, until (dates of
+        creation) and group_by (assignee, status or both, the default).
+        """
+        group_by = [field for field in request.query_params.get('group_by', 'assignee,status').split(',')
+                    if field in ('assignee', 'status')] or ['assignee', 'status']
+        return Response(list(HitStat.objects.dashboard(
+            users=team_of(request.user),
+            since=parse_date(request.query_params.get('since', '')),
+            until=parse_date(request.query_params.get('until', '')),
+            group_by=group_by
+        )))
+
+
+ASYNC_PAGE_SIZE = 50
+
+
+def _hit_page(user, before=None) -> dict:
+    queryset = Hit.objects.select_related('assigned_to', 'created_by').visible_to(user).order_by('-id')
+    if before:
+        queryset = queryset.filter(id__lt=before)
+    hits = list(queryset[:ASYNC_PAGE_SIZE])
+    return {
+        'results': HitSerializer(hits, many=True).data,
+        # keyset over the primary key, the id of the last hit is the next cursor
+        'next': hits[-1].pk if len(hits) == ASYNC_PAGE_SIZE else None,
+    }
+
+
+def _hit_detail(user, pk) -> dict:
+    hit = Hit.objects.select_related('assigned_to', 'created_by').visible_to(user).filter(pk=pk).first()
+    return HitSerializer(hit).data if hit else None
+
+
+async def async_hit_list(request):
+    """
+    Async version of the hit list for the ASGI deployment, ?before=<id> for the next page
+    """
+    before = request.GET.get('before')
+    user, page = await run_as_user(request, _hit_page, int(before) if before and before.isdigit() else None)
+    if user is None:
+        return JsonResponse({'detail': 'Authentication required'}, status=401)
+    return JsonResponse(page)
+
+
+async def async_hit_detail(request, pk):
+    user, data = await run_as_user(request, _hit_detail, pk)
+    if user is None:
+        return JsonResponse({'detail': 'Authentication required'}, status=401)
+    if data is None:
+        return JsonResponse({'detail': 'Not found'}, status=404)
+    return JsonResponse(data)
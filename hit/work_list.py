@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+"""
+Upcoming work of a hitman: his ASSIGNED hits, newest first.
+
+The list is read with one range scan over the (assigned_to, status, -created_at) index
+and kept in the cache until a hit of the user changes its assignment or its status.
+The hits changed by a queryset (unknown users) increase a generation number that
+invalidates every list.
+"""
+from django.core.cache import cache
+from django.db import transaction
+
+WORK_LIST_SIZE = 100
+WORK_LIST_FIELDS = ('id', 'target_name', 'description', 'created_at', 'created_by_id')
+GENERATION_KEY = 'hit:work_list:generation'
+
+
+def _generation() -> int:
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, 1, None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def _key(user_id, generation) -> str:
+    return 'hit:work_list:{}:{}'.format(generation, user_id)
+
+
+def get_work_list(user_id) -> list:
+    """
+    :param int user_id: assigned user
+    :return list: dicts with the WORK_LIST_FIELDS of the ASSIGNED hits of the user
+    """
+    # import here, the model module imports this one
+    from hit.models import ASSIGNED, Hit
+
+    key = _key(user_id, _generation())
+    work_list = cache.get(key)
+    if work_list is None:
+        work_list = list(
+            Hit.objects.filter(assigned_to_id=user_id, status=ASSIGNED)
+            .order_by('-created_at')
+            .values(*WORK_LIST_FIELDS)[:WORK_LIST_SIZE]
+        )
+        cache.set(key, work_list, None)
+    return work_list
+
+
+def invalidate(*user_ids) -> None:
+    """
+    Drop the lists of the users now and again on commit, a list read in the middle
+    would have the data before the commit.
+    """
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return
+
+    def delete():
+        generation = _generation()
+        cache.delete_many([_key(user_id, generation) for user_id in user_ids])
+    delete()
+    transaction.on_commit(delete)
+
+
+def invalidate_all() -> None:
+    def bump():
+        try:
+            cache.incr(GENERATION_KEY)
+        except ValueError:
+            _generation()
+    bump()
+    transaction.on_commit(bump)
@@ -1,10 +1,132 @@
 # -*- coding: utf-8 -*-
 __author__ = 'Sergio Dzul'
 
+"""
+Application log.
+
+The caller thread formats the record as a JSON line (like QueueHandler.prepare, the
+arguments of the message are read now, e.g. a model instance that changes later) and puts
+it in a bounded queue, a background thread writes the lines in batches. When the queue
+is full the line is dropped and counted in QueueJsonHandler.dropped, a slow stream never
+blocks a request.
+
+The handler is configured in settings.LOGGING, the records also propagate to the
+handlers of the parent loggers.
+"""
+import json
 import logging
+import queue
+import sys
+import threading
+import time
 import traceback
 
-# default django logger
+QUEUE_SIZE = 10000
+BATCH_SIZE = 100
+FLUSH_INTERVAL = 0.5
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, message, the extra data and the
+    exception fields exc_type, exc_message and traceback.
+    """
+
+    def format(self, record) -> str:
+        line = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        line.update(getattr(record, 'data', None) or {})
+        if record.exc_info and record.exc_info[0] is not None:
+            exc_type, exception, exc_traceback = record.exc_info
+            line['exc_type'] = exc_type.__name__
+            line['exc_message'] = str(exception)
+            line['traceback'] = ''.join(traceback.format_exception(exc_type, exception, exc_traceback))
+        return json.dumps(line, default=str)
+
+
+class QueueJsonHandler(logging.Handler):
+    """
+    Handler with a bounded queue and a writer thread that flushes the stream after
+    every batch (BATCH_SIZE lines or FLUSH_INTERVAL seconds), logging.shutdown closes it
+    at exit after the queued lines are written.
+    """
+
+    def __init__(self, stream=None, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        super().__init__()
+        self.stream = stream or sys.stderr
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self.setFormatter(JsonFormatter())
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def _start(self) -> None:
+        with self._writer_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write, name='log-writer', daemon=True)
+                self._writer.start()
+
+    def emit(self, record) -> None:
+        if self._writer is None or not self._writer.is_alive():
+            self._start()
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def _write(self) -> None:
+        while True:
+            line = self.queue.get()
+            batch = [line]
+            deadline = time.monotonic() + self.flush_interval
+            while line is not None and len(batch) < self.batch_size:
+                try:
+                    line = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                batch.append(line)
+            lines = [line for line in batch if line is not None]
+            if lines:
+                try:
+                    self.stream.write('\n'.join(lines) + '\n')
+                    self.stream.flush()
+                except Exception:
+                    # the records are gone, report the error with the first line
+                    self.handleError(logging.makeLogRecord({'msg': lines[0]}))
+            for _ in batch:
+                self.queue.task_done()
+            if batch[-1] is None:
+                return
+
+    def flush(self) -> None:
+        """
+        Wait until the queued records are written
+        """
+        if self._writer is not None and self._writer.is_alive():
+            self.queue.join()
+
+    def close(self) -> None:
+        if self._writer is not None and self._writer.is_alive():
+            # the stop mark can wait for space, the writer is emptying the queue
+            self.queue.put(None)
+            self._writer.join()
+        super().close()
+
+
+# default django logger, its QueueJsonHandler is in settings.LOGGING
 logger = logging.getLogger(__name__)
 
 
@@ -12,41 +134,45 @@ class Logger:
     """
     Custom log class, in the future it can be change the log library
     or a services like aws cloudwatch.
-    :param log_lib: log instance class, by default use the django logger
+    :param log_lib: log instance class, by default the logger of the queue handler
     """
 
     def __init__(self, log_lib=logger):
         self.log = log_lib
 
-    def info(self, message):
+    def _extra(self, data) -> dict:
+        return {'extra': {'data': data}} if data else {}
+
+    def info(self, message, *args, **data):
         """
-        :param string message:
+        :param string message: message, formatted with args
+        :param data: extra fields of the JSON line
         """
-        self.log.info(message)
+        self.log.info(message, *args, **self._extra(data))
 
-    def warning(self, message):
+    def warning(self, message, *args, **data):
         """
-        :param message: string
+        :param string message: message, formatted with args
+        :param data: extra fields of the JSON line
         """
-        self.log.warning(message)
-
+        self.log.warning(message, *args, **self._extra(data))
 
-    def error(self, exception, is_message=False):
+    def error(self, exception, is_message=False, **data):
         """
         We except an Exception or an inherent instance
         :param :class:Exception exception: Exception instance or a simple string
         :param is_message: Boolean, in case of exception parameter is a string pass this value in True
+        :param data: extra fields of the JSON line
         """
-        if not is_message:
-            message = exception
+        # the traceback of an exception goes in the JSON line, a string has none
+        exc_info = None
+        if isinstance(exception, BaseException):
+            exc_info = (type(exception), exception, exception.__traceback__)
+        if is_message:
+            self.log.error("Exception: %s Exception message: %s", type(exception).__name__, exception,
+                           exc_info=exc_info, **self._extra(data))
         else:
-            name = "Exception: {}".format(type(exception).__name__)
-            body = "Exception message: {}".format(exception)
-            message = f"""
-            ${name}
-            ${body}
-            """
-        self.log.error(message)
+            self.log.error("%s", exception, exc_info=exc_info, **self._extra(data))
 
 
 log = Logger()
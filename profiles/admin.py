@@ -1,3 +1,58 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.utils.translation import ugettext_lazy as _
+
+from base.admin import EstimatedCountPaginator
+from profiles.models import CustomUser
 
 # Register your models here.
+
+
+@admin.register(CustomUser)
+class CustomUserAdmin(admin.ModelAdmin):
+    """
+    The active users, the deleted ones with the active filter, the job and the boss in
+    the same query and no hard delete: the users are deactivated.
+    """
+    list_display = ('id', 'email', 'first_name', 'last_name', 'job', 'report_to', 'is_active')
+    list_select_related = ('job', 'report_to')
+    list_filter = ('is_active', 'gender', 'country')
+    # exact email or username prefix, both indexed
+    search_fields = ('=email', '^username')
+    ordering = ('-created_at',)
+    fields = ('email', 'first_name', 'last_name', 'gender', 'birthday', 'country', 'state', 'job', 'report_to',
+              'is_active', 'is_staff', 'is_superuser', 'groups', 'user_permissions', 'deleted_at')
+    readonly_fields = ('deleted_at',)
+    raw_id_fields = ('job', 'report_to')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ('deactivate',)
+
+    def get_queryset(self, request):
+        """
+        The default manager (the active users) in the list, every user when the list is
+        filtered by the deleted ones and in the views of one user, e.g. to reactivate him
+        """
+        match = request.resolver_match
+        in_list = match is not None and match.url_name == '{}_{}_changelist'.format(
+            self.opts.app_label, self.opts.model_name)
+        if in_list and request.GET.get('is_active__exact') != '0':
+            queryset = self.model.objects.all()
+        else:
+            queryset = self.model.objects.all_with_deleted()
+        ordering = self.get_ordering(request)
+        return queryset.order_by(*ordering) if ordering else queryset
+
+    def get_actions(self, request):
+        actions = super(CustomUserAdmin, self).get_actions(request)
+        # the users are deactivated, never deleted
+        actions.pop('delete_selected', None)
+        return actions
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    @admin.action(description=_("Deactivate the selected users and unassign their hits"))
+    def deactivate(self, request, queryset):
+        result = CustomUser.objects.deactivate(queryset)
+        self.message_user(request, _("%(users)d users deactivated, %(hits)d hits unassigned") % result,
+                          messages.SUCCESS)
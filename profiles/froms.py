@@ -15,6 +15,7 @@ from django.core.validators import RegexValidator
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from profiles.models import CustomUser
+from profiles.passwords import check_password, set_password
 from profiles.utils import create_hash
 
 USER_MODEL = get_user_model()
@@ -69,7 +70,7 @@ class CustomUserForm(forms.ModelForm):
         user = super(CustomUserForm, self).save(commit=False)
         _password = self.cleaned_data["password1"]
         user.username = create_hash()
-        user.set_password(_password)
+        set_password(user, _password)
         user.save()
         return user
 
@@ -93,7 +94,7 @@ class CustomSignupForm(UserCreationForm):
                 message=_(u"Your username must be at least 3 letters"),
                 code='invalid')
 
-        if CustomUser.objects.filter(username=username).exists():
+        if CustomUser.objects.all_with_deleted().filter(username=username).exists():
             raise forms.ValidationError(
                 message=_('The username exist. Try with another'),
                 code='invalid')
@@ -102,7 +103,10 @@ class CustomSignupForm(UserCreationForm):
 
 
 class EditProfileForm(forms.Form):
-    user = {'username': None}
+    """
+    Edit the profile of one user, the user is passed in (e.g. request.user) or
+    loaded once by username and reused in the validations and the save.
+    """
     error_messages = {
         'password_mismatch': _("The two passwords must match"),
     }
@@ -140,9 +144,16 @@ class EditProfileForm(forms.Form):
         help_text=_("Enter the same password as before, for verification."),
     )
 
-    def __init__(self, username=None, **kwargs):
+    def __init__(self, username=None, user=None, **kwargs):
         super(EditProfileForm, self).__init__(**kwargs)
-        self.user.update({'username': username})
+        self.username = username
+        self._user = user
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = USER_MODEL.objects.get(username=self.username)
+        return self._user
 
     class Meta:
         fields = ("first_name", "last_name",
@@ -151,10 +162,8 @@ class EditProfileForm(forms.Form):
 
     def clean_password(self):
         password = self.cleaned_data.get("password")
-        username = self.user.get("username")
         if password:
-            user = USER_MODEL.objects.get(username=username)
-            if not user.check_password(password):
+            if not check_password(password, self.user.password):
                 raise forms.ValidationError(_("Wrong password"))
         return password
 
@@ -168,18 +177,19 @@ class EditProfileForm(forms.Form):
                 self.error_messages['password_mismatch'],
                 code='password_mismatch',
             )
-        username = self.user.get("username")
-        user = USER_MODEL.objects.get(username=username)
-        password_validation.validate_password(self.cleaned_data.get('password2'), user)
+        password_validation.validate_password(self.cleaned_data.get('password2'), self.user)
         return password2
 
     def save(self):
-        username = self.user.get("username")
-        user = USER_MODEL.objects.get(username=username)
+        user = self.user
         user.first_name = self.cleaned_data.get("first_name")
         user.last_name = self.cleaned_data.get("last_name")
-        user.set_password(self.cleaned_data.get("password"))
-        user.save()
+        fields = ['first_name', 'last_name', 'updated_at']
+        if self.cleaned_data.get("password2"):
+            set_password(user, self.cleaned_data.get("password2"))
+            fields.append('password')
+        user.save(update_fields=fields)
+        return user
 
 
 class RecoverPasswordForm(forms.Form):
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+"""
+Unique identifiers for usernames, hashes and tokens.
+
+The generator is configurable with the ID_GENERATOR setting (dotted path of a class
+with a next_id method), by default MonotonicIdGenerator.
+"""
+import itertools
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULT_ID_GENERATOR = 'profiles.identifiers.MonotonicIdGenerator'
+
+
+class MonotonicIdGenerator:
+    """
+    128 bits ids: 48 bits of milliseconds | 48 bits of node | 32 bits of counter.
+
+    The node is random per process and it's changed after a fork, the counter is
+    shared by all the threads of the process (itertools.count is atomic), so two ids
+    are only equal if the same process generates 2 ** 32 ids in the same millisecond.
+    """
+    TIME_BITS = 48
+    NODE_BITS = 48
+    COUNTER_BITS = 32
+
+    def __init__(self):
+        self.reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self) -> None:
+        self.node = int.from_bytes(os.urandom(self.NODE_BITS // 8), 'big')
+        self._counter = itertools.count(int.from_bytes(os.urandom(4), 'big'))
+        self._prefix_shift = self.NODE_BITS + self.COUNTER_BITS
+        self._node_prefix = self.node << self.COUNTER_BITS
+
+    def next_id(self) -> int:
+        millis = time.time_ns() // 1000000 & ((1 << self.TIME_BITS) - 1)
+        counter = next(self._counter) & ((1 << self.COUNTER_BITS) - 1)
+        return (millis << self._prefix_shift) | self._node_prefix | counter
+
+    def next_bytes(self) -> bytes:
+        return self.next_id().to_bytes(16, 'big')
+
+
+_generator = None
+_lock = threading.Lock()
+
+
+def get_id_generator():
+    """
+    Generator of the process, created once from the ID_GENERATOR setting
+    """
+    global _generator
+    if _generator is None:
+        with _lock:
+            if _generator is None:
+                path = getattr(settings, 'ID_GENERATOR', DEFAULT_ID_GENERATOR)
+                _generator = import_string(path)()
+    return _generator
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from profiles.identifiers import get_id_generator
+from profiles.utils import create_hash
+
+EMAIL = 'benchmark{}-{}@benchmark-ids.test'
+
+
+def generate(size, raw=False) -> list:
+    if raw:
+        next_id = get_id_generator().next_id
+        return [next_id() for _ in range(size)]
+    return [create_hash() for _ in range(size)]
+
+
+def generate_in_threads(args) -> list:
+    size, threads, raw = args
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        chunks = executor.map(lambda _: generate(size, raw), range(threads))
+        return [item for chunk in chunks for item in chunk]
+
+
+def create_users(args) -> int:
+    """
+    Bulk create users with the default username and hash in a forked process, committed
+    """
+    # import here, the id benchmark doesn't need the database
+    from profiles.models import CustomUser
+
+    process, size = args
+    return len(CustomUser.objects.bulk_create(
+        [CustomUser(email=EMAIL.format(process, index)) for index in range(size)], batch_size=1000))
+
+
+class Command(BaseCommand):
+    help = "Generate ids from many processes and threads at the same time, report the rate and the collisions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=100000, help="ids per thread")
+        parser.add_argument('--threads', type=int, default=4, help="threads per process")
+        parser.add_argument('--processes', type=int, default=4)
+        parser.add_argument('--raw', action='store_true', help="measure the integer ids, not create_hash")
+        parser.add_argument('--users', type=int, default=0,
+                            help="bulk create this number of users per process at the end, in the database")
+
+    def handle(self, *args, **options):
+        size, threads, processes = options['size'], options['threads'], options['processes']
+        total = size * threads * processes
+        start = time.perf_counter()
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            chunks = pool.map(generate_in_threads, [(size, threads, options['raw'])] * processes)
+        elapsed = time.perf_counter() - start
+        collisions = total - len({item for chunk in chunks for item in chunk})
+        self.stdout.write("{} ids, {} processes x {} threads: {:.0f} ids/s, {} collisions".format(
+            total, processes, threads, total / elapsed, collisions))
+
+        start = time.perf_counter()
+        generate(size, options['raw'])
+        self.stdout.write("single thread: {:.0f} ids/s".format(size / (time.perf_counter() - start)))
+
+        if options['users']:
+            collisions += self.bulk_create_users(options['users'], processes)
+        if collisions:
+            raise CommandError("{} collisions".format(collisions))
+
+    def bulk_create_users(self, size, processes) -> int:
+        """
+        Every process inserts its users in the same database, the unique username is
+        checked by the database and the hash here. The users are deleted at the end.
+        :return int: collisions of the hash
+        """
+        from django.db import IntegrityError, connections
+        from profiles.models import CustomUser
+
+        users = CustomUser._base_manager.filter(email__endswith=EMAIL.split('@')[1])
+        # the forked processes open their own connections
+        connections.close_all()
+        start = time.perf_counter()
+        try:
+            with multiprocessing.get_context('fork').Pool(processes) as pool:
+                total = sum(pool.map(create_users, [(process, size) for process in range(processes)]))
+            elapsed = time.perf_counter() - start
+            counts = users.aggregate(
+                usernames=Count('username', distinct=True), hashes=Count('hash', distinct=True))
+        except IntegrityError as exception:
+            raise CommandError("Duplicated username: {}".format(exception))
+        finally:
+            users.delete()
+        self.stdout.write("{} users, {} processes with default username and hash: {:.0f} users/s, "
+                          "{} distinct usernames, {} distinct hashes".format(
+                              total, processes, total / elapsed, counts['usernames'], counts['hashes']))
+        return (total - counts['usernames']) + (total - counts['hashes'])
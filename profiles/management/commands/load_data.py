@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+"""
+Bulk import of the organization: jobs, users and hits from JSONL or CSV files.
+
+Every row has a type column (job, user or hit), the rows are streamed and inserted in
+batches with bulk_create, so save() is never called and the rules of the models are
+validated here in memory:
+* job: id (key used by the other rows), name, report_to (id of a job of the import
+  or the primary key of an existing Job, the ids of the import go first: a numeric
+  report_to is looked up in the Job table with the batch, when no row read so far has
+  that id, and a later row can't take an id already resolved to an existing Job)
+* user: email (key used by the other rows), password, first_name, last_name, gender,
+  birthday, country, state, is_superuser, is_active (an inactive user is deleted
+  now), job, report_to (email of a user of the import or of an existing user)
+* hit: target_name, description, status, assigned_to, created_by (emails)
+
+A row waits until the rows it references are inserted, so the file doesn't need to be
+sorted. The whole import is a single transaction.
+"""
+import csv
+import json
+import os
+import time
+from collections import defaultdict
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from hit import work_list
+from hit.models import ASSIGNED, Hit, STATES, UNASSIGNED
+from profiles import org_chart
+from profiles.models import CustomUser, Job, PATH_SEPARATOR
+from profiles.passwords import create_pool
+
+USER_FIELDS = ('first_name', 'last_name', 'gender', 'birthday', 'country', 'state')
+TRUE_VALUES = ('1', 'true', 'yes', 'y')
+
+
+def read_rows(path, file_format=None):
+    """
+    Stream the rows of a JSONL or CSV file, empty CSV values are None
+    """
+    file_format = file_format or os.path.splitext(path)[1].lstrip('.').lower()
+    with open(path, newline='', encoding='utf-8') as stream:
+        if file_format == 'csv':
+            for row in csv.DictReader(stream):
+                yield {key: (value if value != '' else None) for key, value in row.items()}
+        elif file_format in ('jsonl', 'json', 'ndjson'):
+            for line in stream:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise CommandError("Unknown format of {}, use jsonl or csv".format(path))
+
+
+def to_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in TRUE_VALUES
+    return bool(value)
+
+
+def to_key(value) -> str:
+    return str(value) if value is not None else None
+
+
+def subtree_path(path, pk) -> str:
+    return "{}{}{}".format(path, pk, PATH_SEPARATOR)
+
+
+class Loader:
+    """
+    Topological bulk loader, a row is ready when every job and user it references is
+    already inserted, otherwise it waits in pending until the reference is inserted.
+    """
+
+    def __init__(self, batch_size, pool, stdout):
+        self.batch_size = batch_size
+        self.pool = pool
+        self.stdout = stdout
+        self.start = time.perf_counter()
+        self.counts = defaultdict(int)
+        self.ready = {'job': [], 'user': [], 'hit': []}
+        self.pending = defaultdict(list)
+        self.lookup = set()
+        self.job_lookup = set()
+        # ('import', id of the row) or ('pk', primary key of an existing job): (id, report_to_id, path)
+        self.jobs = {}
+        # ids of the job rows, inserted or pending
+        self.job_ids = set()
+        # email: (id, job_id, path, is_active, is_superuser)
+        self.users = {}
+        self.superusers = CustomUser._base_manager.filter(is_superuser=True).count()
+
+    def dependencies(self, kind, row) -> list:
+        if kind == 'job':
+            return [('job', to_key(row.get('report_to')))]
+        if kind == 'user':
+            return [('job', to_key(row.get('job'))), ('user', row.get('report_to'))]
+        if kind == 'hit':
+            return [('user', row.get('assigned_to')), ('user', row.get('created_by'))]
+        raise CommandError("Unknown row type: {}".format(kind))
+
+    def job(self, key):
+        """
+        (id, report_to_id, path) of the job of a reference or None
+        """
+        job = self.jobs.get(('import', key))
+        if job is None and key not in self.job_ids:
+            job = self.jobs.get(('pk', key))
+        return job
+
+    def add(self, row) -> None:
+        if row.get('type') == 'job':
+            key = to_key(row.get('id'))
+            if key is None or key in self.job_ids:
+                raise CommandError("The job id is required and unique: {}".format(row))
+            if ('pk', key) in self.jobs:
+                raise CommandError("The job id is already used as an existing job: {}".format(row))
+            self.job_ids.add(key)
+            self.job_lookup.discard(key)
+        self.schedule(row)
+
+    def schedule(self, row) -> None:
+        kind = row.get('type')
+        for dependency, key in self.dependencies(kind, row):
+            found = self.job(key) if dependency == 'job' else self.users.get(key)
+            if key is not None and found is None:
+                self.pending[(dependency, key)].append(row)
+                if dependency == 'user':
+                    self.lookup.add(key)
+                    if len(self.lookup) >= self.batch_size:
+                        self.lookup_users()
+                elif key not in self.job_ids and key.isdigit():
+                    self.job_lookup.add(key)
+                    if len(self.job_lookup) >= self.batch_size:
+                        self.lookup_jobs()
+                return
+        self.ready[kind].append(row)
+        if len(self.ready[kind]) >= self.batch_size:
+            self.flush(kind)
+
+    def release(self, kind, key) -> None:
+        for row in self.pending.pop((kind, key), []):
+            self.schedule(row)
+
+    def lookup_users(self) -> None:
+        """
+        The references to users that are not in the import are existing users
+        """
+        emails, self.lookup = list(self.lookup), set()
+        for index in range(0, len(emails), self.batch_size):
+            for email, *values in CustomUser._base_manager.filter(
+                    email__in=emails[index:index + self.batch_size]).values_list(
+                    'email', 'id', 'job_id', 'path', 'is_active', 'is_superuser'):
+                if email not in self.users:
+                    self.users[email] = tuple(values)
+                    self.release('user', email)
+
+    def lookup_jobs(self) -> None:
+        """
+        The references to jobs that are not ids of the import are existing jobs
+        """
+        keys, self.job_lookup = list(self.job_lookup), set()
+        for index in range(0, len(keys), self.batch_size):
+            for pk, report_to_id, path in Job.objects.filter(pk__in=keys[index:index + self.batch_size]).values_list(
+                    'id', 'report_to_id', 'path'):
+                if str(pk) not in self.job_ids:
+                    self.jobs[('pk', str(pk))] = (pk, report_to_id, path)
+                    self.release('job', str(pk))
+
+    def flush(self, kind) -> None:
+        rows, self.ready[kind] = self.ready[kind], []
+        if rows:
+            getattr(self, 'flush_' + kind + 's')(rows)
+            self.counts[kind] += len(rows)
+            elapsed = time.perf_counter() - self.start
+            self.stdout.write("{}: {} rows, {:.0f} rows/s".format(
+                kind, self.counts[kind], sum(self.counts.values()) / elapsed))
+
+    def flush_jobs(self, rows) -> None:
+        jobs = []
+        for row in rows:
+            parent = self.job(to_key(row.get('report_to')))
+            jobs.append(Job(
+                name=row.get('name'),
+                report_to_id=parent[0] if parent else None,
+                path=subtree_path(parent[2], parent[0]) if parent else PATH_SEPARATOR
+            ))
+        # the database assigns the ids, a concurrent insert can't take them
+        if connection.features.can_return_rows_from_bulk_insert:
+            Job.objects.bulk_create(jobs)
+        else:
+            # one INSERT per job to read its id, a few rows per level of the organization
+            for job in jobs:
+                job.save()
+        for row, job in zip(rows, jobs):
+            self.jobs[('import', to_key(row['id']))] = (job.pk, job.report_to_id, job.path)
+            self.release('job', to_key(row['id']))
+
+    def flush_users(self, rows) -> None:
+        users = []
+        now = timezone.now()
+        for row in rows:
+            email = row.get('email')
+            if not email or email in self.users:
+                raise CommandError("The email is required and unique: {}".format(row))
+            is_superuser = to_bool(row.get('is_superuser'))
+            if is_superuser:
+                self.superusers += 1
+                if self.superusers > 1:
+                    raise CommandError("Only exist one Big Boss")
+            job = self.job(to_key(row.get('job')))
+            boss = self.users.get(row.get('report_to'))
+            if boss and not is_superuser and (job is None or job[1] is None or job[1] != boss[1]):
+                # same rule than Job.validate_chain_of_command
+                raise CommandError("It's an Enterprise organization Error: {}".format(email))
+            is_active = to_bool(row['is_active']) if row.get('is_active') is not None else True
+            user = CustomUser(
+                email=email,
+                is_superuser=is_superuser,
+                is_staff=to_bool(row.get('is_staff')) or is_superuser,
+                is_active=is_active,
+                # like CustomUserQuerySet.deactivate
+                deleted_at=None if is_active else now,
+                job_id=job[0] if job else None,
+                report_to_id=boss[0] if boss else None,
+                path=subtree_path(boss[2], boss[0]) if boss else PATH_SEPARATOR,
+                **{field: row.get(field) for field in USER_FIELDS if row.get(field) is not None}
+            )
+            if 'terms_and_conditions' in row:
+                user.terms_and_conditions = to_bool(row['terms_and_conditions'])
+            users.append(user)
+        passwords = [row.get('password') for row in rows]
+        for user, password in zip(users, self.pool.map(make_password, passwords, chunksize=64)):
+            user.password = password
+        CustomUser.objects.bulk_create(users)
+        if not connection.features.can_return_rows_from_bulk_insert:
+            ids = dict(CustomUser._base_manager.filter(
+                email__in=[user.email for user in users]).values_list('email', 'id'))
+            for user in users:
+                user.pk = ids[user.email]
+        for user in users:
+            self.users[user.email] = (user.pk, user.job_id, user.path, user.is_active, user.is_superuser)
+            self.release('user', user.email)
+
+    def flush_hits(self, rows) -> None:
+        hits = []
+        for row in rows:
+            assigned_to = self.users.get(row.get('assigned_to'))
+            created_by = self.users.get(row.get('created_by'))
+            status = int(row.get('status') or (ASSIGNED if assigned_to else UNASSIGNED))
+            if status not in dict(STATES):
+                raise CommandError("Unknown hit status: {}".format(row))
+            if assigned_to and assigned_to[4]:
+                raise CommandError("You can assign a hit to Big boss: {}".format(row))
+            if assigned_to and not assigned_to[3] and status == ASSIGNED:
+                raise CommandError("You can't assign a hit to an inactive user: {}".format(row))
+            hits.append(Hit(
+                target_name=row.get('target_name'),
+                description=row.get('description') or '',
+                status=status,
+                assigned_to_id=assigned_to[0] if assigned_to else None,
+                created_by_id=created_by[0] if created_by else None
+            ))
+        # the counters of HitStat are added by bulk_create
+        Hit.objects.bulk_create(hits)
+
+    def finish(self) -> None:
+        """
+        Flush the buffers until every reference is resolved
+        """
+        while any(self.ready.values()) or self.lookup or self.job_lookup:
+            self.lookup_users()
+            self.lookup_jobs()
+            for kind in ('job', 'user', 'hit'):
+                self.flush(kind)
+        if self.pending:
+            missing = ", ".join("{} {}".format(*key) for key in list(self.pending)[:10])
+            raise CommandError("Unknown references (or cycles): {}".format(missing))
+
+
+class Command(BaseCommand):
+    help = "Import jobs, users and hits from JSONL or CSV files, see profiles.management.commands.load_data"
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+')
+        parser.add_argument('--format', choices=['jsonl', 'csv'], help="by default the file extension")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help="processes to hash passwords")
+
+    def handle(self, *args, **options):
+        with create_pool(options['workers']) as pool:
+            with transaction.atomic():
+                loader = Loader(options['batch_size'], pool, self.stdout)
+                for path in options['files']:
+                    for row in read_rows(path, options['format']):
+                        loader.add(row)
+                loader.finish()
+                # bulk_create doesn't send signals
+                org_chart.invalidate()
+                work_list.invalidate_all()
+        self.stdout.write(self.style.SUCCESS("Imported {}".format(dict(loader.counts))))
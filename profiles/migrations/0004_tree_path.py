@@ -0,0 +1,61 @@
+# Generated by Django 3.2.3 on 2026-10-18 15:26
+
+from django.db import migrations, models
+import profiles.models
+
+
+def build_paths(apps, schema_editor):
+    """
+    Materialize the path of the existing Job and CustomUser trees, every row through
+    _base_manager: the managers of the migration state are the classes of the models
+    module, a filter added to them later would skip rows here
+    """
+    db_alias = schema_editor.connection.alias
+    for model_name in ('Job', 'CustomUser'):
+        model = apps.get_model('profiles', model_name)
+        manager = model._base_manager.db_manager(db_alias)
+        parents = dict(manager.values_list('id', 'report_to_id'))
+        paths = {}
+
+        def path_of(pk):
+            if pk not in paths:
+                ancestors, parent, seen = [], parents.get(pk), {pk}
+                while parent is not None and parent not in seen:
+                    ancestors.append(parent)
+                    seen.add(parent)
+                    parent = parents.get(parent)
+                paths[pk] = '/' + ''.join('{}/'.format(item) for item in reversed(ancestors))
+            return paths[pk]
+
+        manager.bulk_update(
+            [model(id=pk, path=path_of(pk)) for pk in parents],
+            ['path'],
+            batch_size=1000
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0003_auto_20210601_0333'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='customuser',
+            managers=[
+                ('objects', profiles.models.CustomUserManager()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='path',
+            field=models.CharField(db_index=True, default='/', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='path',
+            field=models.CharField(db_index=True, default='/', editable=False, max_length=255),
+        ),
+        migrations.RunPython(build_paths, migrations.RunPython.noop),
+    ]
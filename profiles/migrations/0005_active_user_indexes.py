@@ -0,0 +1,25 @@
+# Generated by Django 3.2.3 on 2026-10-18 15:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0004_tree_path'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='customuser',
+            index=models.Index(fields=['is_active', 'report_to'], name='profiles_cu_is_acti_22cb90_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customuser',
+            index=models.Index(fields=['is_active', 'job'], name='profiles_cu_is_acti_c5e14c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customuser',
+            index=models.Index(fields=['is_active', 'path'], name='profiles_cu_is_acti_fe848f_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.3 on 2026-10-18 16:58
+
+from django.db import migrations
+import django.db.models.manager
+import profiles.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0005_active_user_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='customuser',
+            options={'base_manager_name': 'all_users', 'default_manager_name': 'objects', 'permissions': [('can_change_to_inactivate', 'Can deactivate users'), ('can_edit_hitman', 'Can edit hitman data')], 'verbose_name': 'User', 'verbose_name_plural': 'Users'},
+        ),
+        migrations.AlterModelManagers(
+            name='customuser',
+            managers=[
+                ('objects', django.db.models.manager.Manager()),
+                ('all_users', profiles.models.CustomUserManager()),
+            ],
+        ),
+    ]
@@ -1,17 +1,136 @@
 from django.db import models, transaction
+from django.db.models.functions import Concat, Substr
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import (AbstractUser, UserManager)
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 from profiles.utils import create_hash
+from agencyGiuseppi.db_router import write_db
 
 GENDER_OPTIONS = (
     ('M', _('Male')),
     ('F', _('Female'))
 )
+PATH_SEPARATOR = '/'
 
 
-class Job(models.Model):
+class TreeQuerySet(models.QuerySet):
+    """
+    Hierarchy queries over the materialized path of a TreeModel,
+    every query is a prefix search over the indexed path column.
+    """
+
+    def subordinates_of(self, node):
+        """
+        Everybody under the node, at any depth.
+        :param TreeModel node: the boss of the subtree
+        """
+        return self.filter(path__startswith=node.subtree_path)
+
+    def is_subordinate(self, node, boss) -> bool:
+        """
+        Check if node is under boss at any depth, without queries when both
+        parameters are instances, one query by primary key when node is an id.
+        :param node: TreeModel instance or id
+        :param boss: TreeModel instance or id
+        """
+        boss_id = getattr(boss, 'pk', boss)
+        if hasattr(node, 'path'):
+            if hasattr(boss, 'path'):
+                return node.path.startswith(boss.subtree_path)
+            return "{0}{1}{0}".format(PATH_SEPARATOR, boss_id) in node.path
+        return self.filter(
+            pk=node,
+            path__contains="{0}{1}{0}".format(PATH_SEPARATOR, boss_id)
+        ).exists()
+
+
+class TreeModel(models.Model):
+    """
+    Self referenced tree by report_to, it keeps a materialized path with the ids of
+    all the ancestors, e.g. '/1/5/' for a node who reports to 5 and 5 reports to 1.
+    The path of the subtree is updated in one UPDATE when report_to changes.
+    """
+    path = models.CharField(
+        max_length=255,
+        default=PATH_SEPARATOR,
+        editable=False,
+        db_index=True
+    )
+
+    class Meta:
+        abstract = True
+
+    @property
+    def subtree_path(self) -> str:
+        """
+        prefix of the path of every subordinate
+        """
+        return "{}{}{}".format(self.path, self.pk, PATH_SEPARATOR)
+
+    @property
+    def path_parent_id(self) -> int:
+        """
+        report_to id according to the path, None for a root
+        """
+        parent = self.path.rstrip(PATH_SEPARATOR).rsplit(PATH_SEPARATOR, 1)[-1]
+        return int(parent) if parent else None
+
+    def build_path(self) -> str:
+        if self.report_to_id is None:
+            return PATH_SEPARATOR
+        return self.report_to.subtree_path
+
+    def update_path(self) -> str:
+        """
+        Calculate the path from report_to, it must be called before the save.
+        :raise ValidationError: the new boss is a subordinate
+        :return str: the previous prefix of the subtree or None if it didn't change
+        """
+        if self.path_parent_id == self.report_to_id:
+            return None
+        path = self.build_path()
+        if path == self.path:
+            return None
+        if self.pk and self.report_to_id is not None and path.startswith(self.subtree_path):
+            raise ValidationError("A subordinate can't be the boss")
+        old_subtree_path = self.subtree_path if self.pk else None
+        self.path = path
+        return old_subtree_path
+
+    def move_subtree(self, old_subtree_path, new_subtree_path=None) -> int:
+        """
+        Replace the prefix of the path of every subordinate in one UPDATE.
+        :param str old_subtree_path: previous prefix
+        :param str new_subtree_path: new prefix, by default the current subtree_path
+        :return int: number of subordinates
+        """
+        new_subtree_path = new_subtree_path or self.subtree_path
+        return type(self)._base_manager.filter(path__startswith=old_subtree_path).update(
+            path=Concat(models.Value(new_subtree_path), Substr('path', len(old_subtree_path) + 1))
+        )
+
+    def save_tree(self, save, *args, **kwargs) -> None:
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and not {'report_to', 'report_to_id'} & set(update_fields):
+            return save(*args, **kwargs)
+        with transaction.atomic():
+            old_subtree_path = self.update_path()
+            if old_subtree_path and kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = set(kwargs['update_fields']) | {'path'}
+            elif not old_subtree_path and not self._state.adding and not args and not kwargs:
+                # the path is maintained by move_subtree, an old instance must not write it back
+                kwargs['update_fields'] = [
+                    field.name for field in self._meta.concrete_fields
+                    if not field.primary_key and field.name != 'path'
+                ]
+            result = save(*args, **kwargs)
+            if old_subtree_path:
+                self.move_subtree(old_subtree_path)
+            return result
+
+
+class Job(TreeModel):
     """
     Generic tree of jobs, if the organization grows, we can diagram it here
     """
@@ -26,6 +145,7 @@ class Job(models.Model):
         blank=True,
         null=True,
         on_delete=models.SET_NULL)
+    objects = TreeQuerySet.as_manager()
 
     def __unicode__(self) -> str:  # pragma: no cover
         return self.name
@@ -41,11 +161,69 @@ class Job(models.Model):
         :raise ValidationError: the job parameter is not a son of the job
         :return:
         """
-        if self.report_to.pk != job.pk:
+        if self.report_to_id != job.pk:
             raise ValidationError("It's an Enterprise organization Error")
 
+    def save(self, *args, **kwargs) -> None:
+        return self.save_tree(super(Job, self).save, *args, **kwargs)
+
+    def delete(self, using=None, keep_parents=False):
+        with transaction.atomic():
+            # the team will report to nobody (SET_NULL), so their subtrees become roots
+            self.move_subtree(self.subtree_path, PATH_SEPARATOR)
+            return super(Job, self).delete(using, keep_parents)
+
+
+class CustomUserManager(UserManager.from_queryset(TreeQuerySet)):
+    """
+    Every user, the deleted ones (see deactivate) too: the base manager of CustomUser
+    (related objects, the unique checks of the deleted users), see ActiveUserManager.
+    """
+
+    def deactivate(self, queryset, replacement=None) -> dict:
+        """
+        Soft delete many users at once: one UPDATE stamps the users and one UPDATE moves
+        their ASSIGNED hits back to UNASSIGNED or to the replacement, in one transaction.
+        :param queryset: users to deactivate
+        :param CustomUser replacement: user who receives the open hits
+        :raise ValidationError: the replacement can't receive hits
+        :return dict: number of users deactivated and hits moved
+        """
+        # import here, the hit models reference this module
+        from hit.models import BIG_BOSS_ERROR, INACTIVE_USER_ERROR, Hit
+
+        using = write_db(self)
+        with transaction.atomic(using=using):
+            ids = list(queryset.using(using).filter(is_active=True).values_list('pk', flat=True))
+            if replacement is not None:
+                if replacement.is_superuser:
+                    raise ValidationError(BIG_BOSS_ERROR)
+                if not replacement.is_active or replacement.pk in ids:
+                    raise ValidationError(INACTIVE_USER_ERROR)
+            now = timezone.now()
+            users = self.model._base_manager.using(using).filter(pk__in=ids).update(
+                is_active=False, deleted_at=now, updated_at=now)
+            hits = Hit.objects.using(using).release(ids, replacement) if ids else 0
+        return {'users': users, 'hits': hits}
+
+
+class ActiveUserManager(CustomUserManager):
+    """
+    The active users only, over the (is_active, ...) indexes: the default manager, so
+    the admin lists, the choices of the forms and the authentication never read the
+    deleted users. all_with_deleted is the escape hatch.
+    """
+    # the data migrations see every user
+    use_in_migrations = False
+
+    def get_queryset(self):
+        return super(ActiveUserManager, self).get_queryset().filter(is_active=True)
 
-class CustomUser(AbstractUser):
+    def all_with_deleted(self):
+        return super(ActiveUserManager, self).get_queryset()
+
+
+class CustomUser(AbstractUser, TreeModel):
     """
     custom user model
     """
@@ -124,11 +302,14 @@ class CustomUser(AbstractUser):
         null=True,
         on_delete=models.SET_NULL
     )
-    objects = UserManager()
+    objects = ActiveUserManager()
+    all_users = CustomUserManager()
 
     class Meta:
         verbose_name = _("User")
         verbose_name_plural = _("Users")
+        default_manager_name = 'objects'
+        base_manager_name = 'all_users'
         permissions = [
             ("can_change_to_inactivate", _("Can deactivate users")),
             ("can_edit_hitman", _("Can edit hitman data"))
@@ -139,7 +320,11 @@ class CustomUser(AbstractUser):
             models.Index(fields=['email']),
             models.Index(fields=['gender']),
             models.Index(fields=['country', 'state']),
-            models.Index(fields=['created_at'])
+            models.Index(fields=['created_at']),
+            # the candidates to receive a hit: the active team of a boss
+            models.Index(fields=['is_active', 'report_to']),
+            models.Index(fields=['is_active', 'job']),
+            models.Index(fields=['is_active', 'path']),
         ]
 
     def __unicode__(self) -> str:  # pragma: no cover
@@ -162,17 +347,45 @@ class CustomUser(AbstractUser):
             return self.username
         return out_name
 
+    def validate_unique(self, exclude=None):
+        """
+        The default manager checks the active users, the deleted ones keep their
+        username and email too (the unique indexes see them)
+        """
+        super(CustomUser, self).validate_unique(exclude)
+        errors = {}
+        for field in self._meta.fields:
+            value = getattr(self, field.attname)
+            if not field.unique or field.primary_key or field.name in (exclude or ()) or value in (None, ''):
+                continue
+            deleted = CustomUser._base_manager.filter(is_active=False, **{field.name: value})
+            if not self._state.adding:
+                deleted = deleted.exclude(pk=self.pk)
+            if deleted.exists():
+                errors[field.name] = [self.unique_error_message(CustomUser, (field.name,))]
+        if errors:
+            raise ValidationError(errors)
+
     def delete(self, using=None, keep_parents=False) -> None:
+        """
+        Soft delete, the open hits of the user go back to UNASSIGNED, see CustomUserManager.deactivate
+        """
+        CustomUser.objects.deactivate(CustomUser._base_manager.filter(pk=self.pk))
         self.is_active = False
-        self.deleted_at = timezone.now()
-        return self.save()
+        self.deleted_at = CustomUser._base_manager.values_list('deleted_at', flat=True).get(pk=self.pk)
 
     def save(self, *args, **kwargs) -> None:
+        update_fields = kwargs.get('update_fields')
         with transaction.atomic():
+            if update_fields is not None and not {'is_superuser', 'job', 'report_to'} & set(update_fields):
+                # e.g. the profile edition or the last login, the organization rules don't change
+                return self.save_tree(super(CustomUser, self).save, *args, **kwargs)
             if not self.is_superuser:
-                if self.report_to:
-                    self.job.validate_chain_of_command(self.report_to.job)
-                return super(CustomUser, self).save(*args, **kwargs)
-            elif CustomUser.objects.exclude(id=self.pk).filter(is_superuser=True).exists():
+                if self.report_to_id:
+                    # import here, the org chart module imports this one
+                    from profiles.org_chart import get_org_chart
+                    get_org_chart().validate_chain_of_command(self)
+                return self.save_tree(super(CustomUser, self).save, *args, **kwargs)
+            elif CustomUser._base_manager.exclude(id=self.pk).filter(is_superuser=True).exists():
                 raise ValidationError("Only exist one Big Boss")
-            return super(CustomUser, self).save(*args, **kwargs)
+            return self.save_tree(super(CustomUser, self).save, *args, **kwargs)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+"""
+In memory snapshot of the organization: the Job tree and the user to manager map.
+
+The org chart changes a few times a day but it's read in every CustomUser.save, so each
+process keeps a compact copy (arrays indexed by id) and validates the chain of command
+without SQL. A version number in the django cache keeps the processes consistent, when
+a Job or a CustomUser changes its place in the organization the local copy is dropped
+and the shared version is increased on commit, so every other process reloads it.
+The default cache is local memory, in production CACHES must be a shared backend.
+"""
+import random
+import threading
+from array import array
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from profiles.models import CustomUser, Job
+
+VERSION_KEY = 'profiles:org_chart:version'
+# values of the arrays, any other value is an id
+UNKNOWN = -1
+NOBODY = 0
+
+_lock = threading.Lock()
+_chart = None
+
+
+def _set(values, pk, value) -> None:
+    if pk >= len(values):
+        values.extend([UNKNOWN] * (pk + 1 - len(values)))
+    values[pk] = value
+
+
+class OrgChart:
+    """
+    Versioned snapshot, the arrays map an id to its parent id (NOBODY for None)
+    or UNKNOWN when the id was created after the snapshot.
+    """
+
+    def __init__(self, version, job_parents, user_bosses, user_jobs):
+        self.version = version
+        self.job_parents = job_parents
+        self.user_bosses = user_bosses
+        self.user_jobs = user_jobs
+
+    @classmethod
+    def load(cls, version):
+        job_parents, user_bosses, user_jobs = array('q'), array('q'), array('q')
+        for pk, report_to_id in Job.objects.values_list('id', 'report_to_id').iterator():
+            _set(job_parents, pk, report_to_id or NOBODY)
+        for pk, report_to_id, job_id in CustomUser._base_manager.values_list(
+                'id', 'report_to_id', 'job_id').iterator():
+            _set(user_bosses, pk, report_to_id or NOBODY)
+            _set(user_jobs, pk, job_id or NOBODY)
+        return cls(version, job_parents, user_bosses, user_jobs)
+
+    @staticmethod
+    def _get(values, pk) -> int:
+        if pk is None:
+            return NOBODY
+        return values[pk] if pk < len(values) else UNKNOWN
+
+    def job_parent(self, job_id) -> int:
+        return self._get(self.job_parents, job_id)
+
+    def user_boss(self, user_id) -> int:
+        return self._get(self.user_bosses, user_id)
+
+    def user_job(self, user_id) -> int:
+        return self._get(self.user_jobs, user_id)
+
+    def add_job(self, job) -> None:
+        _set(self.job_parents, job.pk, job.report_to_id or NOBODY)
+
+    def add_user(self, user) -> None:
+        _set(self.user_bosses, user.pk, user.report_to_id or NOBODY)
+        _set(self.user_jobs, user.pk, user.job_id or NOBODY)
+
+    def validate_chain_of_command(self, user) -> None:
+        """
+        Same rule than Job.validate_chain_of_command, the job of the user must report
+        to the job of his boss. It only goes to the database when the boss or the job
+        are newer than the snapshot.
+        :param CustomUser user: user with report_to
+        :raise ValidationError: the boss is not in the chain of command
+        """
+        job_parent = self.job_parent(user.job_id)
+        boss_job = self.user_job(user.report_to_id)
+        if UNKNOWN in (job_parent, boss_job):
+            return user.job.validate_chain_of_command(user.report_to.job)
+        if job_parent == NOBODY or job_parent != boss_job:
+            raise ValidationError("It's an Enterprise organization Error")
+
+
+def get_version() -> int:
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # a random start, so a lost key is never confused with an old version
+        cache.add(VERSION_KEY, random.randint(1, 2 ** 31), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def get_org_chart() -> OrgChart:
+    """
+    Current snapshot of the process, it's reloaded when the shared version changed
+    """
+    global _chart
+    version = get_version()
+    chart = _chart
+    if chart is None or chart.version != version:
+        with _lock:
+            chart = _chart
+            if chart is None or chart.version != version:
+                chart = _chart = OrgChart.load(version)
+    return chart
+
+
+def _bump_version() -> None:
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        get_version()
+
+
+def invalidate() -> None:
+    """
+    Drop the snapshot of this process now and the snapshot of the others on commit
+    """
+    global _chart
+    _chart = None
+    transaction.on_commit(_bump_version)
+
+
+def _node_changed(instance, values) -> None:
+    """
+    Before the UPDATE of a node, if it changed its parent or its job every snapshot is
+    invalidated, it's compared before the UPDATE because a snapshot loaded after it
+    would already have the new values.
+    :param list values: [(OrgChart getter, new value)]
+    """
+    if instance._state.adding:
+        return
+    chart = get_org_chart()
+    if any(getter(chart, instance.pk) != (value or NOBODY) for getter, value in values):
+        invalidate()
+
+
+def _node_created(instance, created, add) -> None:
+    """
+    A new node is only added to the snapshot of this process, the others don't know
+    the id yet and they go to the database for it.
+    """
+    chart = _chart
+    if created and chart is not None:
+        add(chart, instance)
+
+
+@receiver(pre_save, sender=Job, dispatch_uid='org_chart_job_changed')
+def job_changed(sender, instance, **kwargs):
+    _node_changed(instance, [(OrgChart.job_parent, instance.report_to_id)])
+
+
+@receiver(post_save, sender=Job, dispatch_uid='org_chart_job_created')
+def job_created(sender, instance, created, **kwargs):
+    _node_created(instance, created, OrgChart.add_job)
+
+
+@receiver(pre_save, sender=CustomUser, dispatch_uid='org_chart_user_changed')
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not {'report_to', 'report_to_id', 'job', 'job_id'} & set(update_fields):
+        return
+    _node_changed(instance, [(OrgChart.user_boss, instance.report_to_id), (OrgChart.user_job, instance.job_id)])
+
+
+@receiver(post_save, sender=CustomUser, dispatch_uid='org_chart_user_created')
+def user_created(sender, instance, created, **kwargs):
+    _node_created(instance, created, OrgChart.add_user)
+
+
+@receiver(post_delete, sender=Job, dispatch_uid='org_chart_job_deleted')
+@receiver(post_delete, sender=CustomUser, dispatch_uid='org_chart_user_deleted')
+def node_deleted(sender, instance, **kwargs):
+    invalidate()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+"""
+Password hashing service, PBKDF2 takes tens of milliseconds of CPU so the hashes and
+the verifications run in a bounded pool of processes instead of the request thread.
+
+* sync API: make_password, check_password and set_password, for the WSGI views and forms
+* async API: amake_password and acheck_password, for the ASGI views
+
+When the pool is disabled (PASSWORD_HASHING_WORKERS = 0) or the queue is full
+(PASSWORD_HASHING_QUEUE tasks waiting) the work is done in the caller thread.
+"""
+import asyncio
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+def create_pool(workers) -> ProcessPoolExecutor:
+    """
+    Pool of processes ready to use django, they are spawned because a forked worker
+    would share the database connections of the parent.
+    """
+    return ProcessPoolExecutor(workers, multiprocessing.get_context('spawn'), initializer=django.setup)
+
+
+class PasswordHasherPool:
+
+    def __init__(self, workers=None, max_queue=None):
+        self.workers = workers if workers is not None else getattr(settings, 'PASSWORD_HASHING_WORKERS', 2)
+        self.max_queue = max_queue if max_queue is not None else getattr(settings, 'PASSWORD_HASHING_QUEUE', 64)
+        self._pool = None
+        self._lock = threading.Lock()
+        self.queue_depth = 0
+        self.completed = 0
+        self.inline = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def start(self) -> None:
+        with self._lock:
+            if self._pool is None and self.workers:
+                self._pool = create_pool(self.workers)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+    def stats(self) -> dict:
+        """
+        queue depth and latency (seconds, from the submit to the result) metrics
+        """
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queue_depth': self.queue_depth,
+                'completed': self.completed,
+                'inline': self.inline,
+                'avg_latency': self.total_latency / self.completed if self.completed else 0.0,
+                'max_latency': self.max_latency,
+            }
+
+    def _record(self, start, inline=False) -> None:
+        latency = time.perf_counter() - start
+        with self._lock:
+            if inline:
+                self.inline += 1
+            else:
+                self.queue_depth -= 1
+            self.completed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def submit(self, function, *args):
+        """
+        :return Future: the future of the pool or None when it must run in the caller
+        """
+        if self._pool is None:
+            self.start()
+        with self._lock:
+            if self._pool is None or self.queue_depth >= self.max_queue:
+                return None
+            self.queue_depth += 1
+        start = time.perf_counter()
+        try:
+            future = self._pool.submit(function, *args)
+        except RuntimeError:
+            # the pool is shutting down
+            self._record(start)
+            return None
+        future.add_done_callback(lambda _: self._record(start))
+        return future
+
+    def run(self, function, *args):
+        future = self.submit(function, *args)
+        if future is None:
+            start = time.perf_counter()
+            result = function(*args)
+            self._record(start, inline=True)
+            return result
+        return future.result()
+
+    async def arun(self, function, *args):
+        future = self.submit(function, *args)
+        if future is None:
+            start = time.perf_counter()
+            result = await asyncio.get_running_loop().run_in_executor(None, function, *args)
+            self._record(start, inline=True)
+            return result
+        return await asyncio.wrap_future(future)
+
+
+hasher = PasswordHasherPool()
+
+
+def make_password(password) -> str:
+    return hasher.run(hashers.make_password, password)
+
+
+def check_password(password, encoded) -> bool:
+    return hasher.run(hashers.check_password, password, encoded)
+
+
+async def amake_password(password) -> str:
+    return await hasher.arun(hashers.make_password, password)
+
+
+async def acheck_password(password, encoded) -> bool:
+    return await hasher.arun(hashers.check_password, password, encoded)
+
+
+def set_password(user, password) -> None:
+    """
+    Same as AbstractBaseUser.set_password with the hash of the pool
+    """
+    user.password = make_password(password)
+    user._password = password
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Sergio Dzul'
+
+from rest_framework import serializers
+
+from profiles.models import CustomUser
+
+
+class UserSummarySerializer(serializers.ModelSerializer):
+    full_name = serializers.CharField(source='get_full_name', read_only=True)
+
+    class Meta:
+        model = CustomUser
+        fields = ('id', 'email', 'full_name', 'is_active')
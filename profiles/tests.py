@@ -1,6 +1,25 @@
-from django.test import TestCase
+import asyncio
+import json
+import tempfile
+from io import StringIO
+from urllib.parse import urlencode
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.hashers import check_password, make_password
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import AsyncClient, TestCase, TransactionTestCase
+from django.urls import reverse
+from django.test.utils import CaptureQueriesContext
 from django.core.exceptions import ValidationError
+from hit.models import ASSIGNED, Hit, HitStat, UNASSIGNED
+from profiles.froms import CustomUserForm, EditProfileForm
+from profiles.management.commands.load_data import Loader
 from profiles.models import CustomUser, Job
+from profiles.org_chart import get_org_chart
+from profiles import passwords
+from profiles.passwords import PasswordHasherPool
 from profiles.utils import create_hash
 from django.utils import timezone
 
@@ -55,6 +74,29 @@ class ProfileTest(TestCase):
             front_end_dev.validate_chain_of_command(seller_manager)
         self.assertRaises(ValidationError, tmp, "It's supposed to raise a ValidationError but it doesn't")
 
+    def test_job_hierarchy_index(self) -> None:
+        general_manager = Job.objects.create(name="General Manager")
+        it_manager = Job.objects.create(name="IT Manager", report_to=general_manager)
+        seller_manager = Job.objects.create(name="Seller Manager", report_to=general_manager)
+        front_end_dev = Job.objects.create(name="Front-end Developer", report_to=it_manager)
+
+        with self.assertNumQueries(1):
+            subordinates = set(Job.objects.subordinates_of(general_manager))
+        self.assertEqual(subordinates, {it_manager, seller_manager, front_end_dev}, "wrong subordinates")
+        self.assertTrue(Job.objects.is_subordinate(front_end_dev, general_manager))
+        self.assertFalse(Job.objects.is_subordinate(front_end_dev.pk, seller_manager.pk))
+
+        # the IT team moves under the seller manager with all its subordinates
+        it_manager.report_to = seller_manager
+        it_manager.save()
+        front_end_dev.refresh_from_db()
+        self.assertTrue(Job.objects.is_subordinate(front_end_dev.pk, seller_manager.pk), "the subtree wasn't moved")
+
+        def tmp(*args, **kwargs):
+            seller_manager.report_to = front_end_dev
+            seller_manager.save()
+        self.assertRaises(ValidationError, tmp, "A subordinate can't be the boss")
+
 
 class CustomUSerTestCase(TestCase):
 
@@ -165,6 +207,9 @@ class CustomUSerTestCase(TestCase):
             base_hitman.update({"report_to": manager2, "email": "hitman2@test.com"})
             CustomUser.objects.create(**base_hitman)
         self.assertRaises(ValidationError, tmp, "it's suppose to raise a ValidationError")
+        hitman = CustomUser.objects.get(email="hitman@test.com")
+        self.assertEqual(list(CustomUser.objects.subordinates_of(manager1)), [hitman], "wrong subordinates")
+        self.assertFalse(CustomUser.objects.is_subordinate(hitman.pk, manager2.pk))
 
     def test_logic_deletion(self) -> None:
         manager_job = Job.objects.create(**{"name": "Manager"})
@@ -179,7 +224,274 @@ class CustomUSerTestCase(TestCase):
             "job": manager_job,
         })
         tmp.delete()
-        self.assertEqual(CustomUser.objects.count(), 1, "It's suppose to do an update, not a delete action")
-        from_db = CustomUser.objects.get(email="managager3@test.com")
+        self.assertEqual(CustomUser.objects.all_with_deleted().count(), 1, "It's suppose to do an update, not a delete action")
+        self.assertEqual(CustomUser.objects.count(), 0, "the deleted users must be out of the default manager")
+        from_db = CustomUser.objects.all_with_deleted().get(email="managager3@test.com")
         self.assertFalse(from_db.is_active, "it's suppose to be False")
         self.assertIsNotNone(from_db.deleted_at, "it's suppose to not to be None")
+
+    def test_active_user_manager(self) -> None:
+        manager_job = Job.objects.create(name="Manager")
+        hitman_job = Job.objects.create(name="Hitman", report_to=manager_job)
+        boss = CustomUser.objects.create_user("boss", "boss@test.com", job=manager_job)
+        hitman = CustomUser.objects.create_user("hitman", "hitman@test.com", "pass", job=hitman_job, report_to=boss)
+        self.assertTrue(self.client.login(username="hitman", password="pass"))
+        hitman.delete()
+        self.assertEqual(list(CustomUser.objects.subordinates_of(boss)), [])
+        self.assertEqual(list(CustomUser.objects.all_with_deleted().subordinates_of(boss)), [hitman])
+        self.assertEqual(CustomUser._base_manager.get(pk=hitman.pk), hitman, "the base manager sees every user")
+        self.assertFalse(self.client.login(username="hitman", password="pass"), "a deleted user can't log in")
+        form = CustomUserForm(data={
+            'email': 'hitman@test.com', 'first_name': 'Hit', 'last_name': 'Man', 'gender': 'M',
+            'password1': 'zxczxc.123', 'password2': 'zxczxc.123', 'birthday': '1990-01-01',
+            'terms_and_conditions': True,
+        })
+        self.assertFalse(form.is_valid(), "the email of a deleted user is taken")
+        self.assertIn('email', form.errors)
+
+    def test_deactivate_team(self) -> None:
+        manager_job = Job.objects.create(name="Manager")
+        hitman_job = Job.objects.create(name="Hitman", report_to=manager_job)
+        manager = CustomUser.objects.create_user("manager", "manager@test.com", job=manager_job)
+        hitmen = [
+            CustomUser.objects.create_user(
+                "hitman{}".format(index), "hitman{}@test.com".format(index), job=hitman_job, report_to=manager)
+            for index in range(11)
+        ]
+        team, replacement = hitmen[:10], hitmen[10]
+        Hit.objects.bulk_create([
+            Hit(target_name="Target", description="Test", status=ASSIGNED, assigned_to=team[index % 10])
+            for index in range(100000)
+        ], batch_size=5000)
+        HitStat.objects.rebuild()
+
+        with CaptureQueriesContext(connection) as queries:
+            result = CustomUser.objects.deactivate(CustomUser.objects.filter(report_to=manager).exclude(
+                pk=replacement.pk))
+        self.assertEqual(result, {'users': 10, 'hits': 100000})
+        updates = [query for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertLess(len(queries), 30, "the queries must not depend on the number of hits")
+        self.assertEqual(len([query for query in updates if 'hit_hit"' in query['sql']]), 1)
+        self.assertFalse(CustomUser.objects.filter(pk__in=[user.pk for user in team]).exists())
+        self.assertFalse(CustomUser.objects.all_with_deleted().filter(
+            pk__in=[user.pk for user in team], deleted_at=None).exists())
+        self.assertEqual(Hit.objects.filter(status=UNASSIGNED, assigned_to=None).count(), 100000)
+        self.assertEqual(HitStat.objects.verify(), {}, "the counters must follow the hits")
+
+        Hit.objects.filter(id__lte=10).update(status=ASSIGNED, assigned_to=replacement)
+        HitStat.objects.rebuild()
+        result = CustomUser.objects.deactivate(CustomUser.objects.filter(pk=replacement.pk), replacement=manager)
+        self.assertEqual(result, {'users': 1, 'hits': 10})
+        self.assertEqual(Hit.objects.filter(status=ASSIGNED, assigned_to=manager).count(), 10)
+        self.assertRaises(ValidationError, CustomUser.objects.deactivate, CustomUser.objects.all(), manager)
+
+    def test_chain_of_command_from_org_chart(self) -> None:
+        manager_job = Job.objects.create(name="Manager")
+        hitman_job = Job.objects.create(name="Hitman", report_to=manager_job)
+        base = {
+            "gender": "F",
+            "birthday": timezone.now(),
+            "terms_and_conditions": True,
+            "country": "MX",
+            "state": "YUC",
+        }
+        manager = CustomUser.objects.create(email="manager@test.com", job=manager_job, **base)
+        hitman = CustomUser(email="hitman@test.com", job_id=hitman_job.pk, report_to_id=manager.pk, **base)
+        chart = get_org_chart()
+        with self.assertNumQueries(0):
+            chart.validate_chain_of_command(hitman)
+        hitman.save()
+
+        # the manager changes his job, the snapshot is invalidated
+        manager.job = hitman_job
+        manager.save()
+
+        def tmp(*args, **kwargs):
+            CustomUser.objects.create(
+                email="hitman2@test.com", job_id=hitman_job.pk, report_to_id=manager.pk, **base)
+        self.assertRaises(ValidationError, tmp, "it's suppose to raise a ValidationError")
+
+    def test_bulk_create_with_default_username(self) -> None:
+        users = CustomUser.objects.bulk_create(
+            [CustomUser(email="hitman{}@test.com".format(index)) for index in range(1000)])
+        self.assertEqual(len({user.username for user in users}), 1000, "the usernames must be unique")
+        self.assertEqual(len({user.hash for user in users}), 1000, "the hashes must be unique")
+        self.assertEqual(len(create_hash(max_size=15)), 15, "create_hash must keep the max size")
+
+
+class LoadDataTestCase(TestCase):
+
+    def test_load_unsorted_file(self) -> None:
+        rows = [
+            {"type": "hit", "target_name": "Target", "assigned_to": "hitman@test.com", "created_by": "manager@test.com"},
+            {"type": "user", "email": "hitman@test.com", "password": "pass", "job": "hitman",
+             "report_to": "manager@test.com"},
+            {"type": "job", "id": "hitman", "name": "Hitman", "report_to": "manager"},
+            {"type": "user", "email": "manager@test.com", "password": "pass", "job": "manager"},
+            {"type": "user", "email": "boss@test.com", "is_superuser": True},
+            {"type": "job", "id": "manager", "name": "Manager"},
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as stream:
+            stream.write("\n".join(json.dumps(row) for row in rows))
+            stream.flush()
+            call_command('load_data', stream.name, workers=1, stdout=StringIO())
+        manager = CustomUser.objects.get(email="manager@test.com")
+        hitman = CustomUser.objects.get(email="hitman@test.com")
+        self.assertEqual(hitman.report_to_id, manager.pk, "wrong report to")
+        self.assertTrue(hitman.check_password("pass"), "the password must be hashed")
+        self.assertEqual(list(CustomUser.objects.subordinates_of(manager)), [hitman], "wrong path")
+        self.assertEqual(Hit.objects.get().assigned_to_id, hitman.pk, "wrong assignment")
+
+    def load(self, rows) -> None:
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as stream:
+            stream.write("\n".join(json.dumps(row) for row in rows))
+            stream.flush()
+            call_command('load_data', stream.name, workers=1, stdout=StringIO())
+
+    def test_job_keys(self) -> None:
+        existing = Job.objects.create(name="Existing")
+        other = Job.objects.create(name="Other")
+        self.load([
+            {"type": "job", "id": "child", "name": "Child", "report_to": str(existing.pk)},
+            {"type": "job", "id": str(existing.pk), "name": "Imported", "report_to": str(other.pk)},
+            {"type": "user", "email": "inactive@test.com", "job": str(other.pk), "is_active": False},
+        ])
+        imported = Job.objects.get(name="Imported")
+        self.assertEqual(imported.report_to_id, other.pk, "a report_to that isn't an import id is an existing job")
+        self.assertEqual(Job.objects.get(name="Child").report_to_id, imported.pk,
+                         "the ids of the import must go before the primary keys")
+        inactive = CustomUser.objects.all_with_deleted().get(email="inactive@test.com")
+        self.assertEqual(inactive.job_id, other.pk)
+        self.assertIsNotNone(inactive.deleted_at, "an inactive user must be deleted")
+
+    def test_existing_jobs_are_resolved_per_batch(self) -> None:
+        existing = Job.objects.create(name="Existing")
+        loader = Loader(1, None, StringIO())
+        loader.add({"type": "job", "id": "child", "name": "Child", "report_to": str(existing.pk)})
+        self.assertEqual(Job.objects.get(name="Child").report_to_id, existing.pk,
+                         "a row that depends on an existing job must be flushed with its batch")
+        self.assertRaises(CommandError, loader.add, {"type": "job", "id": str(existing.pk), "name": "Imported"})
+
+    def test_load_keeps_the_chain_of_command(self) -> None:
+        rows = "type,id,name,email,job,report_to\n" \
+               "job,manager,Manager,,,\n" \
+               "job,hitman,Hitman,,,\n" \
+               "user,,,manager@test.com,manager,\n" \
+               "user,,,hitman@test.com,hitman,manager@test.com\n"
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as stream:
+            stream.write(rows)
+            stream.flush()
+            self.assertRaises(
+                CommandError, call_command, 'load_data', stream.name, workers=1, stdout=StringIO())
+        self.assertEqual(CustomUser.objects.count(), 0, "The import is a single transaction")
+
+
+class PasswordHasherPoolTestCase(TestCase):
+
+    def test_pool(self) -> None:
+        hasher = PasswordHasherPool(workers=1)
+        try:
+            encoded = hasher.run(make_password, "zxczxc.123")
+            self.assertTrue(check_password("zxczxc.123", encoded), "wrong hash")
+            self.assertTrue(asyncio.run(hasher.arun(check_password, "zxczxc.123", encoded)), "wrong async check")
+            stats = hasher.stats()
+            self.assertEqual(stats['completed'], 2, "the metrics must count the hashes")
+            self.assertEqual(stats['queue_depth'], 0, "the queue must be empty")
+            self.assertEqual(stats['inline'], 0, "it must run in the pool")
+        finally:
+            hasher.shutdown()
+
+    def test_inline_fallback(self) -> None:
+        hasher = PasswordHasherPool(workers=0)
+        encoded = hasher.run(make_password, "zxczxc.123")
+        self.assertTrue(check_password("zxczxc.123", encoded), "wrong hash")
+        self.assertEqual(hasher.stats()['inline'], 1, "without workers it runs in the caller")
+
+
+class AsyncPasswordTestCase(TransactionTestCase):
+    """
+    The async view reads and writes in other threads, so the data must be committed
+    """
+
+    def setUp(self) -> None:
+        self.user = CustomUser.objects.create_user(
+            username="hitman", email="hitman@test.com", password="zxczxc.123")
+        # the pool itself is tested in PasswordHasherPoolTestCase
+        patcher = mock.patch.object(passwords.hasher, 'workers', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.async_client = AsyncClient()
+        self.async_client.force_login(self.user)
+
+    def post(self, **data):
+        # the multipart body of the AsyncClient of Django 3.2 can't be parsed by ASGIRequest
+        return self.async_client.post(reverse('async-password'), urlencode(data),
+                                      content_type='application/x-www-form-urlencoded')
+
+    async def test_change_password(self) -> None:
+        response = await self.post(password="wrong", password1="Qwerty.4567", password2="Qwerty.4567")
+        self.assertEqual(response.status_code, 400, "the current password must be checked")
+        self.assertIn('password', response.json())
+        response = await self.post(password="zxczxc.123", password1="Qwerty.4567", password2="Other")
+        self.assertIn('password2', response.json())
+        response = await self.post(password="zxczxc.123", password1="Qwerty.4567", password2="Qwerty.4567")
+        self.assertEqual(response.status_code, 200, response.content)
+        user = await sync_to_async(CustomUser.objects.get)(pk=self.user.pk)
+        self.assertTrue(check_password("Qwerty.4567", user.password), "the new hash wasn't saved")
+        response = await self.async_client.get(reverse('async-profile'))
+        self.assertEqual(response.status_code, 200, "the session must stay logged in")
+
+
+class EditProfileFormTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.user = CustomUser.objects.create_user(
+            username="hitman", email="hitman@test.com", password="zxczxc.123")
+
+    def test_one_read_and_one_write(self) -> None:
+        form = EditProfileForm(username="hitman", data={
+            "first_name": "Sergio",
+            "last_name": "Dzul",
+            "password": "zxczxc.123",
+            "password1": "Giuseppi.2021",
+            "password2": "Giuseppi.2021",
+        })
+        with CaptureQueriesContext(connection) as context:
+            self.assertTrue(form.is_valid(), form.errors)
+            form.save()
+        queries = [query['sql'].split()[0] for query in context.captured_queries]
+        self.assertEqual(queries.count('SELECT'), 1, "the user must be loaded only once")
+        self.assertEqual(queries.count('UPDATE'), 1, "the user must be saved in one UPDATE")
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.first_name, "Sergio", "wrong name")
+        self.assertTrue(self.user.check_password("Giuseppi.2021"), "the password wasn't changed")
+
+    def test_the_user_is_not_shared(self) -> None:
+        other = EditProfileForm(user=self.user, data={"password": "wrong"})
+        form = EditProfileForm(username="nobody", data={})
+        self.assertIs(other.user, self.user, "every form has its own user")
+        self.assertFalse(other.is_valid(), "the current password is wrong")
+        self.assertEqual(form.username, "nobody")
+
+
+class CustomUserAdminTestCase(TestCase):
+
+    def test_changelist_and_deactivate(self) -> None:
+        big_boss = CustomUser.objects.create_superuser(email="sergio@test.com", username="bigboss", password="pass")
+        hitman = CustomUser.objects.create_user("hitman", "hitman@test.com")
+        hit = Hit.objects.create(target_name="Target", description="Test")
+        hit.assign(hitman)
+        self.client.force_login(big_boss)
+        url = reverse('admin:profiles_customuser_changelist')
+        response = self.client.post(url, {'action': 'deactivate', '_selected_action': [hitman.pk]})
+        self.assertEqual(response.status_code, 302)
+        hit.refresh_from_db()
+        self.assertEqual((hit.status, hit.assigned_to_id), (UNASSIGNED, None))
+        self.assertNotContains(self.client.get(url), "hitman@test.com",
+                               msg_prefix="the list must read the active users only")
+        response = self.client.get(url, {'is_active__exact': 0})
+        self.assertContains(response, "hitman@test.com", msg_prefix="the deleted users must be in the admin")
+        response = self.client.get(reverse('admin:profiles_customuser_change', args=[hitman.pk]))
+        self.assertEqual(response.status_code, 200, "a deleted user can be opened")
+        self.assertNotContains(response, 'value="delete_selected"', msg_prefix="the users are never deleted")
+
@@ -0,0 +1,8 @@
+from django.urls import path
+
+from profiles import views
+
+urlpatterns = [
+    path('profile/', views.async_profile, name="async-profile"),
+    path('password/', views.async_password, name="async-password"),
+]
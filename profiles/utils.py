@@ -7,7 +7,7 @@ from logger import log
 from django.conf import settings
 # from django.template.loader import render_to_string
 # from mailer import send_html_mail
-from django.utils import timezone
+from profiles.identifiers import get_id_generator
 
 
 def get_brand():
@@ -18,20 +18,21 @@ def get_brand():
 def create_hash(algorithm=None, max_size=None) -> str:
     """
     Create a new unique hash or string value to use as username or token
-    by default create a sha1 string with 15 characters long.
+    by default create a sha1 string with 40 characters long.
+    The seed is a unique id of profiles.identifiers, never the current time, so two
+    calls in the same microsecond (or in other thread or process) don't collide.
 
     :param function algorithm: algorithm you can pass as hashlib.sha1 or an uuid function.
     :param int max_size: in the case you want truck the string pass the max size.
     :return string: encrypted data
     """
     encrypted_data = ''
+    seed = get_id_generator().next_bytes()
     if algorithm is None:
-        _hash = hashlib.sha1()
-        _hash.update(str(timezone.now()).encode('utf-8'))
-        encrypted_data = _hash.hexdigest()
+        encrypted_data = hashlib.sha1(seed).hexdigest()
     else:
         try:
-            encrypted_data = algorithm(str(timezone.now()).encode('utf-8'))
+            encrypted_data = algorithm(seed)
         except Exception as exception:
             log.error(exception)
     if max_size is not None and isinstance(max_size, int):
@@ -1,4 +1,85 @@
+from django.contrib.auth import password_validation, update_session_auth_hash
+from django.core.exceptions import ValidationError
+from django.http import JsonResponse
 from django.shortcuts import render
+from django.utils.translation import ugettext as _
 
+from base.async_db import gather, get_user, run_query
+from hit.models import HitStat
+from hit.work_list import get_work_list
+from profiles.froms import ChangePasswordForm
+from profiles.models import CustomUser
+from profiles.passwords import acheck_password, amake_password
+from profiles.serializers import UserSummarySerializer
 
-# Create your views here.
+
+def _stats(user_id) -> list:
+    return list(HitStat.objects.dashboard(users=[user_id], group_by=('status',)))
+
+
+def _team_size(user) -> int:
+    return CustomUser.objects.subordinates_of(user).count()
+
+
+async def async_profile(request):
+    """
+    Profile of the current user with his upcoming work, his counters and the size of
+    his team, the three reads are independent so they run at the same time.
+    """
+    user = await get_user(request)
+    if user is None:
+        return JsonResponse({'detail': 'Authentication required'}, status=401)
+    work_list, stats, team_size = await gather(
+        (get_work_list, user.pk),
+        (_stats, user.pk),
+        (_team_size, user),
+    )
+    return JsonResponse({
+        'user': UserSummarySerializer(user).data,
+        'upcoming': work_list,
+        'stats': stats,
+        'team_size': team_size,
+    })
+
+
+def _validate_password(password, user) -> list:
+    try:
+        password_validation.validate_password(password, user)
+    except ValidationError as error:
+        return error.messages
+    return []
+
+
+def _save_password(request, user, password, encoded) -> None:
+    user.password = encoded
+    # password_changed of the validators, like set_password
+    user._password = password
+    user.save(update_fields=['password', 'updated_at'])
+    # the session of the request stays logged in
+    update_session_auth_hash(request, user)
+
+
+async def async_password(request):
+    """
+    Change the password of the current user, POST: password (the current one),
+    password1 and password2. The check of the current password and the new hash run in
+    the processes of profiles.passwords, the event loop only awaits them.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'detail': 'Method not allowed'}, status=405)
+    user = await get_user(request)
+    if user is None:
+        return JsonResponse({'detail': 'Authentication required'}, status=401)
+    form = ChangePasswordForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse(form.errors, status=400)
+    if not await acheck_password(request.POST.get('password', ''), user.password):
+        return JsonResponse({'password': [_("Wrong password")]}, status=400)
+    password = form.cleaned_data['password1']
+    if password != form.cleaned_data['password2']:
+        return JsonResponse({'password2': [_("The two passwords must match")]}, status=400)
+    errors = await run_query(_validate_password, password, user)
+    if errors:
+        return JsonResponse({'password1': errors}, status=400)
+    await run_query(_save_password, request, user, password, await amake_password(password))
+    return JsonResponse({'detail': _("The password was changed")})